@@ -1,4 +1,3 @@
-import sqlite3
 import os
 from flask import Flask, jsonify, request, session
 from flask_cors import CORS
@@ -6,17 +5,33 @@ from flask_socketio import SocketIO, emit, join_room
 import datetime
 import traceback
 import asyncio
-from threading import Thread
-import shutil
 from werkzeug.utils import secure_filename
-import tempfile
 
 # Pyrogram imports only
 from pyrogram import Client, filters
 from pyrogram.types import ChatJoinRequest
 from pyrogram import filters as pyro_filters
+from pyrogram.handlers import ChatJoinRequestHandler, MessageHandler
 
-from db import init_db, add_user as db_add_user
+from db import (
+    init_db,
+    mark_conversation_read as db_mark_conversation_read
+)
+import bot_runtime
+import db_pool
+import hydrator
+import message_cache
+import migrations
+import replicator
+import stats
+import storage
+import timeutil
+from telegram_scheduler import scheduler as telegram_scheduler, PRIORITY_WELCOME
+from db_writer import writer as db_writer, WRITE_TIMEOUT
+from delivery import DeliveryQueue
+from inbound import InboundMessages
+from join_backlog import JoinBacklog
+from join_pipeline import JoinPipeline, approve_request
 import config
 
 # Firebase imports
@@ -28,11 +43,7 @@ try:
         save_message_to_firebase,
         get_messages_for_user_from_firebase,
         get_all_messages_from_firebase,
-        get_total_users_from_firebase,
-        get_total_messages_from_firebase,
-        get_active_users_from_firebase,
-        get_new_joins_today_from_firebase,
-        update_user_label as update_user_label_firebase
+        seed_counters_in_background
     )
     FIREBASE_AVAILABLE = True
     print("✅ Firebase integration available")
@@ -48,17 +59,7 @@ except ImportError as e:
         print("⚠️ Firebase not available - message not saved to Firebase")
         return False
     def get_messages_for_user_from_firebase(*args, **kwargs):
-        return []
-    def get_total_users_from_firebase(*args, **kwargs):
-        return 0
-    def get_total_messages_from_firebase(*args, **kwargs):
-        return 0
-    def get_active_users_from_firebase(*args, **kwargs):
-        return 0
-    def get_new_joins_today_from_firebase(*args, **kwargs):
-        return 0
-    def update_user_label_firebase(*args, **kwargs):
-        return False
+        return [], False
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'change_this_secret_key')
@@ -120,34 +121,23 @@ except Exception as e:
     DB_NAME = ':memory:'
     print(f"📝 Note: In-memory database will reset when server restarts")
 
+# Route every helper (and db.py) through the shared connection pool
+db_pool.configure(DB_NAME)
+
 # Ensure DB tables exist
 init_db()
 print(f"🗄️ Database initialized: {DB_NAME}")
 print(f"📁 Database file location: {os.path.abspath(DB_PATH) if DB_NAME != ':memory:' else 'In-memory'}")
 print(f"⚠️ IMPORTANT: SQLite database will reset on server restart!")
 
-# Initialize Firebase if available
-if FIREBASE_AVAILABLE:
-    try:
-        firebase_success = initialize_firebase()
-        if firebase_success:
-            print("🔥 Firebase initialized successfully")
-        else:
-            print("⚠️ Firebase initialization failed - using SQLite only")
-            FIREBASE_AVAILABLE = False
-    except Exception as e:
-        print(f"❌ Firebase initialization failed: {e}")
-        FIREBASE_AVAILABLE = False
-else:
-    print("📝 Firebase not available - using SQLite database only")
-
 # Database backup and restore functions
 def backup_database():
     """Backup database to persistent storage"""
     try:
         if os.path.exists(DB_NAME) and DB_NAME != ':memory:':
             backup_path = f"{DB_NAME}.backup"
-            shutil.copy2(DB_NAME, backup_path)
+            # Online backup so pages still in the WAL file are included
+            db_pool.backup_to(backup_path)
             print(f"✅ Database backed up to: {backup_path}")
             return True
     except Exception as e:
@@ -160,8 +150,19 @@ def restore_database():
         if DB_NAME != ':memory:':
             backup_path = f"{DB_NAME}.backup"
             if os.path.exists(backup_path):
-                shutil.copy2(backup_path, DB_NAME)
+                db_writer.flush()
+                db_pool.restore_from(backup_path)
+                # Backups may predate newer schema steps
+                migrations.migrate()
+                stats.cache.invalidate()
+                message_cache.cache.clear()
                 print(f"✅ Database restored from: {backup_path}")
+                # The backup's id sequence may be behind messages already replicated
+                if replicator.ENABLED:
+                    try:
+                        hydrator.reserve_message_ids()
+                    except Exception as e:
+                        print(f"❌ Could not reserve message ids above Firestore's: {e}")
                 return True
             else:
                 print(f"⚠️ No backup found at: {backup_path}")
@@ -170,17 +171,67 @@ def restore_database():
         print(f"❌ Restore failed: {e}")
         return False
 
-# Try to restore database on startup
+# Try to restore database on startup, before hydration or replication touch it
 if restore_database():
     print("🔄 Database restored from backup")
 else:
     print("📝 Starting with fresh database")
 
+# Initialize Firebase if available
+if FIREBASE_AVAILABLE:
+    try:
+        firebase_success = initialize_firebase()
+        if firebase_success:
+            print("🔥 Firebase initialized successfully")
+        else:
+            print("⚠️ Firebase initialization failed - using SQLite only")
+            FIREBASE_AVAILABLE = False
+    except Exception as e:
+        print(f"❌ Firebase initialization failed: {e}")
+        FIREBASE_AVAILABLE = False
+else:
+    print("📝 Firebase not available - using SQLite database only")
+
+# Users, messages and stats go through one backend (STORAGE_BACKEND)
+storage.configure(FIREBASE_AVAILABLE)
+SQLITE_BACKEND = storage.BACKEND == 'sqlite'
+
+# Firestore writes go through the SQLite outbox, drained in the background
+replicator.configure(FIREBASE_AVAILABLE and SQLITE_BACKEND)
+
+# Message document ids are SQLite row ids: start new ones above Firestore's
+# (a stale local database would otherwise reuse ids already replicated)
+if replicator.ENABLED:
+    try:
+        hydrator.reserve_message_ids()
+    except Exception as e:
+        print(f"❌ Could not reserve message ids above Firestore's: {e}")
+
+# Cold start: warm SQLite from Firestore while requests are already served
+try:
+    hydrator.loader.start(FIREBASE_AVAILABLE, hydrator.HYDRATE_MODE if SQLITE_BACKEND else 'never')
+except Exception as e:
+    print(f"❌ Could not start hydration: {e}")
+    hydrator.loader.skip(f"start failed: {e}")
+
+# Chat history cache, invalidated by Firestore writes from any instance
+try:
+    message_cache.cache.start_watch(FIREBASE_AVAILABLE)
+except Exception as e:
+    print(f"❌ Could not start the message cache listener: {e}")
+
+# Sharded counters only see writes made since they were added: backfill them
+# once so count() fallbacks don't return partial totals
+if FIREBASE_AVAILABLE:
+    seed_counters_in_background()
+
 # Pyrogram Bot Setup
 BOT_TOKEN = os.environ.get('BOT_TOKEN', config.BOT_TOKEN)
 API_ID = int(os.environ.get('API_ID', config.API_ID))
 API_HASH = os.environ.get('API_HASH', config.API_HASH)
 CHAT_ID = int(os.environ.get('CHAT_ID', config.CHAT_ID))
+# Admin user session for draining join requests that arrived while the bot was down (optional)
+BACKLOG_SESSION_STRING = os.environ.get('BACKLOG_SESSION_STRING', getattr(config, 'BACKLOG_SESSION_STRING', ''))
 
 # Check if required environment variables are set
 if not BOT_TOKEN or BOT_TOKEN == 'your_bot_token_here':
@@ -202,220 +253,210 @@ if not os.path.exists(SESSION_DIR):
         print(f"⚠️ Could not create session directory: {e}")
         SESSION_DIR = "/tmp/pyrogram_sessions"  # Fallback to temp directory
 
-pyro_app = Client(
-    "AutoApproveBot_v2",  # Changed session name to avoid conflicts
-    bot_token=BOT_TOKEN,
-    api_id=API_ID,
-    api_hash=API_HASH,
-    workdir=SESSION_DIR  # Use separate directory for sessions
-)
+def emit_incoming_message(user_id, sender, message):
+    # Late-bound: emit_message_to_all_rooms is defined further down
+    emit_message_to_all_rooms(user_id, sender, message)
+
+# Private messages users send the bot, stored in batches and fanned out off the bot loop (see inbound.py)
+incoming_messages = InboundMessages(emit=emit_incoming_message)
+
+def create_pyro_client():
+    """Build the bot client; called on the bot loop thread (see bot_runtime.py)"""
+    client = Client(
+        "AutoApproveBot_v2",  # Changed session name to avoid conflicts
+        bot_token=BOT_TOKEN,
+        api_id=API_ID,
+        api_hash=API_HASH,
+        workdir=SESSION_DIR,  # Use separate directory for sessions
+        sleep_threshold=0  # FloodWait goes to the TelegramScheduler, not a silent sleep in the call
+    )
+    client.add_handler(ChatJoinRequestHandler(approve_and_dm, pyro_filters.chat(CHAT_ID)))
+    client.add_handler(MessageHandler(incoming_messages.handle, pyro_filters.private & pyro_filters.incoming
+                                      & ~pyro_filters.service & ~pyro_filters.bot))
+    return client
 
 WELCOME_TEXT = getattr(config, "WELCOME_TEXT", "🎉 Hi {mention}, you are now a member of {title}!")
 
-@pyro_app.on_chat_join_request(pyro_filters.chat(CHAT_ID))
-async def approve_and_dm(client: Client, join_request: ChatJoinRequest):
-    try:
-        user = join_request.from_user
-        chat = join_request.chat
-        
-        print(f"🎯 Join request received from: {user.first_name} ({user.id}) in {chat.title}")
-        print(f"🔍 User details: ID={user.id}, Name={user.first_name}, Username={user.username}")
+async def approve_join(client, join_request):
+    """Approve stage; False (nothing to save or welcome) if the request was withdrawn"""
+    user = join_request.from_user
+    chat = join_request.chat
+    if not await approve_request(client, telegram_scheduler, chat.id, user.id):
+        return False
+    print(f"✅ Approved: {user.first_name} ({user.id}) in {chat.title}")
 
-        await client.approve_chat_join_request(chat.id, user.id)
-        print(f"✅ Approved: {user.first_name} ({user.id}) in {chat.title}")
+def _user_row(user):
+    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Pyrogram does not provide invite_link in join request
+    return user.id, full_name, user.username or '', join_date, None
 
-        # Add user to DB with better error handling
-        try:
-            full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-            username = user.username or ''
-            join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            invite_link = None  # Pyrogram does not provide invite_link in join request
-            
-            print(f"💾 Saving user to database: {user.id} - {full_name}")
-            
-            # Save to SQLite
-            db_add_user(user.id, full_name, username, join_date, invite_link)
-            print(f"✅ User {user.id} saved to SQLite successfully")
-            
-            # Save to Firebase if available
-            if FIREBASE_AVAILABLE:
-                firebase_success = add_user_to_firebase(user.id, full_name, username, join_date, invite_link)
-                if firebase_success:
-                    print(f"✅ User {user.id} saved to Firebase successfully")
-                else:
-                    print(f"⚠️ User {user.id} failed to save to Firebase")
-            else:
-                print(f"⚠️ Firebase not available, user {user.id} saved to SQLite only")
-            
-            # Backup database after adding user
-            backup_database()
-            
-        except Exception as db_error:
-            print(f"❌ Database error saving user {user.id}: {db_error}")
-            import traceback
-            traceback.print_exc()
+async def persist_join(client, join_request):
+    """Save the joined user without blocking the event loop; the outbox
+    replicates it to Firebase"""
+    await asyncio.wrap_future(storage.backend.queue_user(*_user_row(join_request.from_user)))
 
-        try:
-            await client.send_message(
-                user.id,
-                WELCOME_TEXT.format(mention=user.mention, title=chat.title)
-            )
-            print(f"📨 DM sent to {user.first_name} ({user.id})")
-        except Exception as e:
-            print(f"❌ Failed to send DM to {user.first_name} ({user.id}): {e}")
-    except Exception as e:
-        print(f"❌ Error in approve_and_dm: {e}")
-        import traceback
-        traceback.print_exc()
+async def persist_users(users):
+    """Save many joined users in one batched write"""
+    await asyncio.wrap_future(storage.backend.queue_users([_user_row(user) for user in users]))
 
-# Alternative: Start Pyrogram bot without async
-def run_pyrogram_bot_simple():
-    """Start the Pyrogram bot using the simple run method"""
-    try:
-        print("🔥 Starting Pyrogram bot (simple method)...")
-        # Use the simple run method without async
-        pyro_app.run()
-        print("✅ Pyrogram bot started successfully")
-    except Exception as e:
-        print(f"❌ Pyrogram bot error: {e}")
-        import traceback
-        traceback.print_exc()
+async def welcome_user(client, user, chat_title):
+    text = WELCOME_TEXT.format(mention=user.mention, title=chat_title)
+    await telegram_scheduler.call(lambda: client.send_message(user.id, text),
+                                  chat_id=user.id, priority=PRIORITY_WELCOME)
+    print(f"📨 DM sent to {user.first_name} ({user.id})")
 
-# Test Pyrogram connection
-def test_pyrogram_connection():
-    """Test if Pyrogram can connect to Telegram"""
-    try:
-        print("🔍 Testing Pyrogram connection...")
-        print(f"🔑 Using API_ID: {API_ID}")
-        print(f"🔑 Using API_HASH: {API_HASH[:10]}...")
-        print(f"🔑 Using BOT_TOKEN: {BOT_TOKEN[:10]}...")
-        print(f"🔑 Using CHAT_ID: {CHAT_ID}")
-        
-        # Try to get bot info
-        with pyro_app:
-            me = pyro_app.get_me()
-            print(f"✅ Pyrogram connected successfully: {me.first_name} (@{me.username})")
-            print(f"🆔 Bot ID: {me.id}")
-            return True
-    except Exception as e:
-        print(f"❌ Pyrogram connection failed: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+async def welcome_join(client, join_request):
+    await welcome_user(client, join_request.from_user, join_request.chat.title)
+
+# Approve, save and welcome in separate stages (backups coalesced, see join_pipeline.py)
+join_requests = JoinPipeline(approve_join, persist_join, welcome_join, backup=backup_database)
+
+async def approve_and_dm(client: Client, join_request: ChatJoinRequest):
+    user = join_request.from_user
+    print(f"🎯 Join request received from: {user.first_name} ({user.id}) in {join_request.chat.title}")
+    await join_requests.submit(client, join_request)
+
+def create_backlog_client():
+    """Admin user client for listing and bulk-approving pending requests (bots can't)"""
+    return Client(
+        "AutoApproveBacklog",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        session_string=BACKLOG_SESSION_STRING,
+        in_memory=True,
+        no_updates=True,
+        sleep_threshold=0  # FloodWait goes to the TelegramScheduler
+    )
+
+# Requests that arrived while the bot was down: drained on connect and then periodically
+join_backlog = JoinBacklog(CHAT_ID, persist_users, welcome_user,
+                           user_client_factory=create_backlog_client if BACKLOG_SESSION_STRING else None,
+                           pipeline=join_requests)
+bot_runtime.bot.on_connect(join_backlog.run)
 
 # Start Pyrogram bot in background thread
 def start_pyrogram_bot():
-    """Start Pyrogram bot in background thread"""
-    try:
-        print("🔥 Starting Pyrogram bot in background...")
-        # Create new event loop for this thread
-        import asyncio
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # For Render deployment, use start() instead of run() or idle() to avoid signal issues
-        try:
-            # Use start() which doesn't require signal handling
-            pyro_app.start()
-            print("✅ Pyrogram bot started successfully with start()")
-        except Exception as start_error:
-            print(f"⚠️ Start failed: {start_error}")
-            # Don't try idle() or run() as they cause signal issues
-            print("⚠️ Skipping bot startup due to signal issues")
-    except Exception as e:
-        print(f"❌ Pyrogram bot error: {e}")
-        import traceback
-        traceback.print_exc()
-
-# Test connection and start bot in background
-if test_pyrogram_connection():
+    """Connect the long-lived bot client on its own event-loop thread"""
+    print("🔥 Starting Pyrogram bot in background...")
+    print(f"🔑 Using API_ID: {API_ID}")
+    print(f"🔑 Using API_HASH: {API_HASH[:10]}...")
+    print(f"🔑 Using BOT_TOKEN: {BOT_TOKEN[:10]}...")
+    print(f"🔑 Using CHAT_ID: {CHAT_ID}")
+    return bot_runtime.bot.start(create_pyro_client)
+
+# Connect once at startup; HTTP handlers reuse the session via bot_runtime.bot.submit()
+if start_pyrogram_bot():
     print("🚀 Pyrogram bot connection successful")
     print("📝 Bot will handle join requests automatically")
-    print("⚠️ Note: Bot runs in main thread to avoid signal issues")
 else:
     print("⚠️ Pyrogram bot connection failed")
-    print("📝 Bot will still work for manual operations but auto-approve may not work")
+    print("📝 Retrying in the background; bot calls fail until it connects")
 
-# --- Database helpers ---
+# --- Database helpers (served by storage.backend) ---
 def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
+    return storage.backend.get_all_users()
 
 def get_total_users():
-    """Get total users count from database (SQLite and Firebase if available)"""
+    """Total users from the backend's maintained counts (no per-request scans)"""
     try:
-        # Get from SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users')
-        sqlite_count = c.fetchone()[0]
-        conn.close()
-        
-        # Get from Firebase if available
-        if FIREBASE_AVAILABLE:
-            firebase_count = get_total_users_from_firebase()
-            # Use Firebase count if available, otherwise use SQLite
-            if firebase_count > 0:
-                return firebase_count
-        
-        return sqlite_count
+        return storage.backend.get_stats()['total_users']
     except Exception as e:
         print(f"❌ Error getting total users: {e}")
         return 0
 
-def get_messages_for_user(user_id, limit=100):
-    """Get messages for user from database (SQLite and Firebase if available)"""
+def get_messages_for_user(user_id, limit=100, before_id=None, after_id=None):
+    """Get a keyset page of messages for user from the storage backend.
+
+    Returns (messages, has_more); messages are (id, sender, message, timestamp,
+    delivery_status, delivery_error), newest first.
+    """
     try:
-        # Get from Firebase if available (prioritize Firebase)
-        if FIREBASE_AVAILABLE:
-            firebase_messages = get_messages_for_user_from_firebase(user_id, limit)
-            if firebase_messages:
-                print(f"✅ Retrieved {len(firebase_messages)} messages from Firebase for user {user_id}")
-                return firebase_messages
-            else:
-                print(f"⚠️ No messages found in Firebase for user {user_id}, trying SQLite")
-        
-        # Fallback to SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-        sqlite_messages = c.fetchall()
-        conn.close()
-        
-        print(f"✅ Retrieved {len(sqlite_messages)} messages from SQLite for user {user_id}")
-        return sqlite_messages
-        
+        return storage.backend.get_message_page(user_id, limit, before_id, after_id)
     except Exception as e:
         print(f"❌ Error getting messages for user {user_id}: {e}")
         import traceback
         traceback.print_exc()
-        return []
+        return [], False
+
+def parse_message_page_args(args, default_limit=100):
+    """Read limit/before_id/after_id/order query parameters for chat history routes;
+    raises ValueError when one of the numbers isn't an integer"""
+    for name in ('limit', 'before_id', 'after_id'):
+        if name in args and args.get(name, type=int) is None:
+            raise ValueError(f"{name} must be an integer")
+    limit = min(max(args.get('limit', default_limit, type=int), 1), 500)
+    before_id = args.get('before_id', type=int)
+    after_id = args.get('after_id', type=int)
+    order = 'asc' if args.get('order', 'desc').lower() == 'asc' else 'desc'
+    return limit, before_id, after_id, order
+
+def message_page_cursors(messages, has_more, before_id=None, after_id=None):
+    """Cursors for the page after `messages` (newest first) in either direction"""
+    if messages:
+        oldest_id, newest_id = messages[-1][0], messages[0][0]
+    else:
+        oldest_id, newest_id = before_id, after_id
+    paging_forward = after_id is not None
+    return {
+        # Older history: only when this page stopped early going backwards
+        'next_before_id': oldest_id if (has_more and not paging_forward) else None,
+        # Newer messages: resume from the newest id seen
+        'next_after_id': newest_id,
+        'has_more': has_more
+    }
+
+def get_messages_since(user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+    """Delta sync: messages newer than the client's high-water mark, oldest first.
+
+    Returns a dict with the new messages, has_more and the new high-water
+    mark ({'id', 'ts', 'ts_id'}) the client should send on its next sync
+    (as since_id, or as since_ts plus since_ts_id).
+    """
+    messages, has_more = storage.backend.get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)
+    
+    # (ts, ts_id) is the newest (ts_ms, id) seen, so a page cut inside a run of equal timestamps resumes there
+    newest_ts, newest_ts_id = max(((m[4], m[0]) for m in messages if m[4] is not None and m[0] is not None),
+                                  default=(since_ts, since_ts_id))
+    high_water_mark = {
+        'id': max((m[0] for m in messages if m[0] is not None), default=since_id),
+        'ts': newest_ts,
+        'ts_id': newest_ts_id
+    }
+    
+    return {
+        'user_id': user_id,
+        'messages': [{
+            'id': message_id,
+            'sender': sender,
+            'message': message,
+            'timestamp': timestamp,
+            'ts_ms': ts_ms,
+            'delivery_status': delivery_status,
+            'delivery_error': delivery_error,
+            'user_id': user_id
+        } for message_id, sender, message, timestamp, ts_ms, delivery_status, delivery_error in messages],
+        'has_more': has_more,
+        'high_water_mark': high_water_mark
+    }
+
+def parse_sync_args(args):
+    """Read since_id/since_ts/since_ts_id/limit from query parameters or a Socket.IO payload"""
+    def as_int(value):
+        return int(value) if value not in (None, '') else None
+    since_id = as_int(args.get('since_id'))
+    since_ts = as_int(args.get('since_ts'))
+    since_ts_id = as_int(args.get('since_ts_id'))
+    limit = min(max(as_int(args.get('limit')) or 500, 1), 1000)
+    return since_id, since_ts, since_ts_id, limit
 
 def save_message(user_id, sender, message):
-    """Save message to database (SQLite and Firebase if available)"""
+    """Save message through the storage backend"""
     try:
-        # Save to SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
-                  (user_id, sender, message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        conn.commit()
-        conn.close()
-        print(f"✅ Message saved to SQLite for user {user_id}")
-        
-        # Save to Firebase if available
-        if FIREBASE_AVAILABLE:
-            firebase_success = save_message_to_firebase(user_id, sender, message)
-            if firebase_success:
-                print(f"✅ Message saved to Firebase for user {user_id}")
-            else:
-                print(f"⚠️ Message failed to save to Firebase for user {user_id}")
-        else:
-            print(f"⚠️ Firebase not available, message saved to SQLite only for user {user_id}")
+        # With SQLite this is group-committed by the writer thread, and the
+        # same transaction queues the Firebase copy in the replication outbox
+        storage.backend.save_message(user_id, sender, message)
+        print(f"✅ Message saved ({storage.BACKEND}) for user {user_id}")
         
         return True
     except Exception as e:
@@ -424,84 +465,109 @@ def save_message(user_id, sender, message):
         traceback.print_exc()
         return False
 
-def get_active_users(minutes=60):
-    """Get active users count from database (SQLite and Firebase if available)"""
+def get_active_users(minutes=stats.ACTIVE_MINUTES):
+    """Users with a message in the last N minutes, from the conversations summary"""
     try:
-        # Get from SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-        c.execute('SELECT COUNT(DISTINCT user_id) FROM messages WHERE timestamp >= ?', (since,))
-        sqlite_count = c.fetchone()[0]
-        conn.close()
-        
-        # Get from Firebase if available
-        if FIREBASE_AVAILABLE:
-            firebase_count = get_active_users_from_firebase(minutes)
-            # Use Firebase count if available, otherwise use SQLite
-            if firebase_count > 0:
-                return firebase_count
-        
-        return sqlite_count
+        if minutes == stats.ACTIVE_MINUTES:
+            return storage.backend.get_stats()['active_users']
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*) FROM conversations WHERE last_ts_ms >= ?', (timeutil.minutes_ago_ms(minutes),))
+            return c.fetchone()[0]
     except Exception as e:
         print(f"❌ Error getting active users: {e}")
         return 0
 
 def get_total_messages():
-    """Get total messages count from database (SQLite and Firebase if available)"""
+    """Total messages from the incrementally maintained counter (no Firebase reads)"""
     try:
-        # Get from SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM messages')
-        sqlite_count = c.fetchone()[0]
-        conn.close()
-        
-        # Get from Firebase if available
-        if FIREBASE_AVAILABLE:
-            firebase_count = get_total_messages_from_firebase()
-            # Use Firebase count if available, otherwise use SQLite
-            if firebase_count > 0:
-                return firebase_count
-        
-        return sqlite_count
+        return storage.backend.get_stats()['total_messages']
     except Exception as e:
         print(f"❌ Error getting total messages: {e}")
         return 0
 
 def get_new_joins_today():
-    """Get new joins today count from database (SQLite and Firebase if available)"""
+    """Today's joins from the daily_joins rollup (no Firebase reads)"""
     try:
-        # Get from SQLite
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users WHERE join_date LIKE ?', (f'{today}%',))
-        sqlite_count = c.fetchone()[0]
-        conn.close()
-        
-        # Get from Firebase if available
-        if FIREBASE_AVAILABLE:
-            firebase_count = get_new_joins_today_from_firebase()
-            # Use Firebase count if available, otherwise use SQLite
-            if firebase_count > 0:
-                return firebase_count
-        
-        return sqlite_count
+        return storage.backend.get_stats()['new_joins_today']
     except Exception as e:
         print(f"❌ Error getting new joins today: {e}")
         return 0
 
 def get_user_online_status(user_id, minutes=5):
     """Check if user has been active in the last N minutes"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('SELECT 1 FROM messages WHERE user_id = ? AND timestamp >= ? LIMIT 1', (user_id, since))
-    is_online = c.fetchone() is not None
-    conn.close()
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT 1 FROM messages WHERE user_id = ? AND ts_ms >= ? LIMIT 1', (user_id, timeutil.minutes_ago_ms(minutes)))
+        is_online = c.fetchone() is not None
     return is_online
 
+# Sortable columns for /admin/users (query value -> SQL expression)
+USER_SORT_COLUMNS = {
+    'join_date': 'join_ts_ms',
+    'full_name': 'full_name COLLATE NOCASE',
+    'username': 'username COLLATE NOCASE',
+    'user_id': 'user_id',
+    'message_count': 'message_count',
+    'last_active': 'last_ts_ms',
+}
+
+def query_users_with_activity(page=1, page_size=50, sort='join_date', order='desc',
+                              search=None, label=None, online=None, online_minutes=5):
+    """Fetch one page of users with message count, last activity and online flag in a single query"""
+    sort_sql = USER_SORT_COLUMNS.get(sort, USER_SORT_COLUMNS['join_date'])
+    direction = 'ASC' if str(order).lower() == 'asc' else 'DESC'
+    online_since = timeutil.minutes_ago_ms(online_minutes)
+
+    where, params = [], []
+    if search:
+        where.append('(u.full_name LIKE ? OR u.username LIKE ? OR CAST(u.user_id AS TEXT) = ?)')
+        params += [f'%{search}%', f'%{search}%', search]
+    if label:
+        where.append('u.label = ?')
+        params.append(label)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+
+    online_sql = ''
+    if online is not None:
+        online_sql = 'WHERE COALESCE(last_ts_ms, 0) >= ?' if online else 'WHERE COALESCE(last_ts_ms, 0) < ?'
+        params.append(online_since)
+
+    # Per-user aggregates come from the conversations summary (a primary-key
+    # join); the window count returns the filtered total in the same round trip.
+    sql = f'''
+        SELECT *, COUNT(*) OVER () AS total FROM (
+            SELECT u.user_id, u.full_name, u.username, u.join_ts_ms, u.join_date,
+                   u.invite_link, u.photo_url, u.label,
+                   COALESCE(c.message_count, 0) AS message_count,
+                   c.last_ts_ms AS last_ts_ms,
+                   COALESCE(c.unread_count, 0) AS unread_count
+            FROM users u LEFT JOIN conversations c ON c.user_id = u.user_id {where_sql}
+        ) {online_sql}
+        ORDER BY {sort_sql} {direction}, user_id {direction}
+        LIMIT ? OFFSET ?
+    '''
+    params += [page_size, (page - 1) * page_size]
+
+    with db_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    users = [{
+        'user_id': r[0],
+        'full_name': r[1],
+        'username': r[2],
+        'join_date': timeutil.format_ms(r[3], r[4]),
+        'invite_link': r[5],
+        'photo_url': r[6],
+        'label': r[7],
+        'message_count': r[8],
+        'last_active': timeutil.format_ms(r[9]),
+        'unread_count': r[10],
+        'is_online': r[9] is not None and r[9] >= online_since
+    } for r in rows]
+    total = rows[0][11] if rows else 0
+    return users, total
+
 # --- Flask API Endpoints ---
 @app.route('/dashboard-users')
 def dashboard_users():
@@ -512,30 +578,34 @@ def dashboard_users():
 
         print(f"🔍 Fetching users: page={page}, page_size={page_size}, offset={offset}")
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users')
-        total = c.fetchone()[0]
-        print(f"📊 Total users in database: {total}")
-        
-        c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?', (page_size, offset))
-        users = c.fetchall()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*) FROM users')
+            total = c.fetchone()[0]
+            print(f"📊 Total users in database: {total}")
+        
+            # Online flag is resolved in the same query instead of once per row
+            c.execute('''
+                SELECT u.user_id, u.full_name, u.username, u.join_ts_ms, u.join_date, u.invite_link, u.photo_url, u.label,
+                       COALESCE(cv.last_ts_ms, 0) >= ?
+                FROM users u LEFT JOIN conversations cv ON cv.user_id = u.user_id
+                ORDER BY u.join_ts_ms DESC LIMIT ? OFFSET ?
+            ''', (timeutil.minutes_ago_ms(5), page_size, offset))
+            users = c.fetchall()
 
         print(f"�� Found {len(users)} users for this page")
 
         users_with_status = []
         for u in users:
-            is_online = get_user_online_status(u[0], 5)
             users_with_status.append({
                 'user_id': u[0],
                 'full_name': u[1],
                 'username': u[2],
-                'join_date': u[3],
-                'invite_link': u[4],
-                'photo_url': u[5],
-                'is_online': is_online,
-                'label': u[6]
+                'join_date': timeutil.format_ms(u[3], u[4]),
+                'invite_link': u[5],
+                'photo_url': u[6],
+                'is_online': bool(u[8]),
+                'label': u[7]
             })
 
         return jsonify({
@@ -559,15 +629,13 @@ def dashboard_users():
 @app.route('/dashboard-stats')
 def dashboard_stats():
     try:
-        total_users = get_total_users()
-        active_users = get_active_users()
-        total_messages = get_total_messages()
-        new_joins_today = get_new_joins_today()
+        # One cached snapshot of the backend's counts; no per-request scans
+        snapshot = storage.backend.get_stats()
         return jsonify({
-            'total_users': total_users,
-            'active_users': active_users,
-            'total_messages': total_messages,
-            'new_joins_today': new_joins_today
+            'total_users': snapshot['total_users'],
+            'active_users': snapshot['active_users'],
+            'total_messages': snapshot['total_messages'],
+            'new_joins_today': snapshot['new_joins_today']
         })
     except Exception as e:
         print(f"Error in dashboard-stats: {e}")
@@ -581,33 +649,76 @@ def dashboard_stats():
 
 @app.route('/chat/<int:user_id>/messages')
 def chat_messages(user_id):
-    messages = get_messages_for_user(user_id)
-    return jsonify([
-        [sender, message, timestamp] for sender, message, timestamp in messages
+    try:
+        limit, before_id, after_id, order = parse_message_page_args(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    messages, has_more = get_messages_for_user(user_id, limit, before_id, after_id)
+    cursors = message_page_cursors(messages, has_more, before_id, after_id)
+    if order == 'asc':
+        messages = messages[::-1]
+    response = jsonify([
+        [sender, message, timestamp, message_id, delivery_status]
+        for message_id, sender, message, timestamp, delivery_status, _delivery_error in messages
     ])
+    # This route returns a bare list, so the cursors travel in headers
+    for header, value in (('X-Next-Before-Id', cursors['next_before_id']),
+                          ('X-Next-After-Id', cursors['next_after_id'])):
+        if value is not None:
+            response.headers[header] = str(value)
+    response.headers['X-Has-More'] = 'true' if has_more else 'false'
+    return response
+
+def chat_history_response(user_id):
+    """Shared body of the paginated chat history routes"""
+    try:
+        limit, before_id, after_id, order = parse_message_page_args(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e), 'messages': [], 'user_id': user_id}), 400
+    messages, has_more = get_messages_for_user(user_id, limit, before_id, after_id)
+    cursors = message_page_cursors(messages, has_more, before_id, after_id)
+    if order == 'asc':
+        messages = messages[::-1]
+    
+    # Format messages for frontend
+    formatted_messages = []
+    for message_id, sender, message, timestamp, delivery_status, delivery_error in messages:
+        formatted_messages.append({
+            'id': message_id,
+            'sender': sender,
+            'message': message,
+            'timestamp': timestamp,
+            'delivery_status': delivery_status,
+            'delivery_error': delivery_error,
+            'user_id': user_id
+        })
+    
+    return jsonify({
+        'status': 'success',
+        'messages': formatted_messages,
+        'user_id': user_id,
+        'total_messages': len(formatted_messages),
+        'order': order,
+        **cursors
+    })
+
+@app.route('/chat/<int:user_id>/sync')
+def chat_sync(user_id):
+    """Only the messages newer than ?since_id= (or ?since_ts= epoch ms with ?since_ts_id=), plus a high-water mark"""
+    try:
+        since_id, since_ts, since_ts_id, limit = parse_sync_args(request.args)
+        return jsonify({'status': 'success', **get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)})
+    except ValueError:
+        return jsonify({'status': 'error', 'error': 'since_id, since_ts, since_ts_id and limit must be integers'}), 400
+    except Exception as e:
+        print(f"❌ Error syncing messages for user {user_id}: {e}")
+        return jsonify({'status': 'error', 'error': str(e)}), 500
 
 @app.route('/chat/<int:user_id>', methods=['GET'])
 def get_chat_messages(user_id):
-    """Get messages for a specific user"""
+    """Get messages for a specific user (?before_id=&after_id=&limit=&order=)"""
     try:
-        messages = get_messages_for_user(user_id, limit=100)
-        
-        # Format messages for frontend
-        formatted_messages = []
-        for sender, message, timestamp in messages:
-            formatted_messages.append({
-                'sender': sender,
-                'message': message,
-                'timestamp': timestamp,
-                'user_id': user_id
-            })
-        
-        return jsonify({
-            'status': 'success',
-            'messages': formatted_messages,
-            'user_id': user_id,
-            'total_messages': len(formatted_messages)
-        })
+        return chat_history_response(user_id)
         
     except Exception as e:
         print(f"❌ Error getting messages for user {user_id}: {e}")
@@ -620,26 +731,9 @@ def get_chat_messages(user_id):
 
 @app.route('/messages/<int:user_id>')
 def get_user_messages(user_id):
-    """Get messages for a specific user"""
+    """Get messages for a specific user (?before_id=&after_id=&limit=&order=)"""
     try:
-        messages = get_messages_for_user(user_id, limit=100)
-        
-        # Format messages for frontend
-        formatted_messages = []
-        for sender, message, timestamp in messages:
-            formatted_messages.append({
-                'sender': sender,
-                'message': message,
-                'timestamp': timestamp,
-                'user_id': user_id
-            })
-        
-        return jsonify({
-            'status': 'success',
-            'messages': formatted_messages,
-            'user_id': user_id,
-            'total_messages': len(formatted_messages)
-        })
+        return chat_history_response(user_id)
         
     except Exception as e:
         print(f"❌ Error getting messages for user {user_id}: {e}")
@@ -654,20 +748,19 @@ def get_user_messages(user_id):
 def get_all_messages():
     """Get all messages (for admin dashboard)"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT user_id, sender, message, timestamp FROM messages ORDER BY timestamp DESC LIMIT 100')
-        messages = c.fetchall()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT user_id, sender, message, ts_ms, timestamp FROM messages ORDER BY ts_ms DESC LIMIT 100')
+            messages = c.fetchall()
         
         # Format messages for frontend
         formatted_messages = []
-        for user_id, sender, message, timestamp in messages:
+        for user_id, sender, message, ts_ms, timestamp in messages:
             formatted_messages.append({
                 'user_id': user_id,
                 'sender': sender,
                 'message': message,
-                'timestamp': timestamp
+                'timestamp': timeutil.format_ms(ts_ms, timestamp)
             })
         
         return jsonify({
@@ -763,8 +856,8 @@ def send_admin_message():
         if not user_id or not message:
             return jsonify({'error': 'User ID and message required'}), 400
         
-        # Save message to database as from admin
-        save_message(int(user_id), 'admin', message)
+        # Save it with its Telegram delivery queued; the bot sends it in the background
+        message_id = deliveries.send(int(user_id), message)
         
         # Emit message to all rooms (user room + admin notification)
         emit_message_to_all_rooms(int(user_id), 'admin', message)
@@ -774,7 +867,9 @@ def send_admin_message():
             'message': 'Admin message sent successfully',
             'user_id': user_id,
             'sender': 'admin',
-            'message': message
+            'message': message,
+            'message_id': message_id,
+            'delivery_status': 'queued'
         })
         
     except Exception as e:
@@ -958,8 +1053,11 @@ def send_all():
     if not message:
         return {'status': 'error', 'msg': 'Missing message'}, 400
     users = get_all_users()
-    for u in users:
-        save_message(u[0], 'admin', message)
+    # Queue every insert first so the writer commits them in a few batches
+    timestamp = timeutil.format_ms(timeutil.now_ms())
+    futures = [storage.backend.queue_message(u[0], 'admin', message, timestamp) for u in users]
+    for u, future in zip(users, futures):
+        future.result(timeout=WRITE_TIMEOUT)
         socketio.emit('new_message', {'user_id': u[0]}, room='chat_' + str(u[0]))
     return {'status': 'ok', 'count': len(users)}
 
@@ -969,16 +1067,8 @@ def set_user_label(user_id):
     try:
         label = request.json.get('label')
         
-        # Update SQLite
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('UPDATE users SET label = ? WHERE user_id = ?', (label, user_id))
-        conn.commit()
-        conn.close()
-        
-        # Update Firebase if available
-        if FIREBASE_AVAILABLE:
-            update_user_label_firebase(user_id, label)
+        # With SQLite, Firebase follows via the replication outbox
+        storage.backend.set_user_label(user_id, label)
         
         return jsonify({'status': 'ok', 'user_id': user_id, 'label': label})
     except Exception as e:
@@ -998,7 +1088,7 @@ def add_test_user():
             return jsonify({'error': 'user_id is required'}), 400
             
         join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        db_add_user(user_id, full_name, username, join_date, None)
+        storage.backend.add_user(user_id, full_name, username, join_date, None)
         
         return jsonify({
             'status': 'success',
@@ -1028,12 +1118,8 @@ def manual_join():
             
         join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        # Add user to database
-        db_add_user(user_id, full_name, username, join_date, None)
-        
-        # Save to Firebase if available
-        if FIREBASE_AVAILABLE:
-            add_user_to_firebase(user_id, full_name, username, join_date, None)
+        # Add user to database (replicated to Firebase in the background)
+        storage.backend.add_user(user_id, full_name, username, join_date, None)
         
         # Send welcome message (simulated)
         welcome_message = f"🎉 Welcome {full_name}! You have been added to our group."
@@ -1041,12 +1127,12 @@ def manual_join():
         
         # Try to send DM via bot if available
         try:
-            with pyro_app:
-                pyro_app.send_message(
-                    user_id,
-                    f"🎉 Hi {full_name}, you are now a member of our group!"
-                )
-                print(f"📨 DM sent to {full_name} ({user_id})")
+            text = f"🎉 Hi {full_name}, you are now a member of our group!"
+            bot_runtime.bot.submit(lambda client: telegram_scheduler.call(
+                lambda: client.send_message(user_id, text),
+                chat_id=user_id, priority=PRIORITY_WELCOME
+            ))
+            print(f"📨 DM sent to {full_name} ({user_id})")
         except Exception as dm_error:
             print(f"⚠️ Could not send DM: {dm_error}")
             print("📝 User added to database but DM not sent")
@@ -1085,6 +1171,10 @@ def on_admin_join(data=None):
         'message': 'Admin connected successfully',
         'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }, room='admin_room')
+    
+    # Full stats once; the shared broadcaster pushes deltas from here on
+    stats.broadcaster.admin_joined(socketio, request.sid)
+    emit('stats_update', stats.broadcaster.full_update())
 
 @socketio.on('user_join')
 def on_user_join(data=None):
@@ -1104,6 +1194,19 @@ def on_user_join(data=None):
     else:
         print("⚠️ User join: no data provided")
 
+@socketio.on('sync')
+def on_sync(data=None):
+    """Client reconnected: reply with the messages it missed since its high-water mark"""
+    try:
+        user_id = int((data or {}).get('user_id'))
+        since_id, since_ts, since_ts_id, limit = parse_sync_args(data)
+        emit('sync', {'status': 'success', **get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)})
+    except (TypeError, ValueError):
+        emit('sync', {'status': 'error', 'error': 'user_id is required'})
+    except Exception as e:
+        print(f"❌ Error in sync for {data}: {e}")
+        emit('sync', {'status': 'error', 'error': str(e)})
+
 @socketio.on('connect')
 def on_connect():
     """Handle client connection"""
@@ -1113,21 +1216,23 @@ def on_connect():
 def on_disconnect():
     """Handle client disconnection"""
     print(f"🔌 Client disconnected: {request.sid}")
+    stats.broadcaster.admin_left(request.sid)
 
 @socketio.on('error')
 def on_error(error):
     """Handle Socket.io errors"""
     print(f"❌ Socket.io error: {error}")
 
-def notify_admin_new_message(user_id, sender, message):
+def notify_admin_new_message(user_id, sender, message, timestamp=None):
     """Notify admin about new message"""
     try:
+        timestamp = timestamp or timeutil.format_ms(timeutil.now_ms())
+        
         # Get user info for admin notification
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT full_name, username FROM users WHERE user_id = ?', (user_id,))
-        user_info = c.fetchone()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT full_name, username FROM users WHERE user_id = ?', (user_id,))
+            user_info = c.fetchone()
         
         user_name = user_info[0] if user_info else f"User {user_id}"
         username = user_info[1] if user_info else "Unknown"
@@ -1140,7 +1245,7 @@ def notify_admin_new_message(user_id, sender, message):
             'username': username,
             'sender': sender,
             'message': message,
-            'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'timestamp': timestamp
         }, room='admin_room')
         
         # Also emit to all admin rooms for redundancy
@@ -1148,7 +1253,7 @@ def notify_admin_new_message(user_id, sender, message):
             'user_id': user_id,
             'sender': sender,
             'message': message,
-            'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'timestamp': timestamp
         }, room='admin_room')
         
         print(f"📢 Admin notified: {user_name} ({user_id}) sent message")
@@ -1161,24 +1266,27 @@ def notify_admin_new_message(user_id, sender, message):
 def emit_message_to_all_rooms(user_id, sender, message):
     """Emit message to both user room and admin room"""
     try:
+        # Format once for every event below
+        timestamp = timeutil.format_ms(timeutil.now_ms())
+        
         # Emit to user's chat room
         socketio.emit('new_message', {
             'user_id': user_id,
             'sender': sender,
             'message': message,
-            'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'timestamp': timestamp
         }, room='chat_' + str(user_id))
         
         # If message is from user, notify admin
         if sender == 'user':
-            notify_admin_new_message(user_id, sender, message)
+            notify_admin_new_message(user_id, sender, message, timestamp)
         elif sender == 'admin':
             # If message is from admin, also emit to admin room for confirmation
             socketio.emit('admin_message_sent', {
                 'user_id': user_id,
                 'sender': sender,
                 'message': message,
-                'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                'timestamp': timestamp
             }, room='admin_room')
         
         print(f"📤 Message emitted: {sender} -> {user_id}")
@@ -1188,6 +1296,15 @@ def emit_message_to_all_rooms(user_id, sender, message):
         import traceback
         traceback.print_exc()
 
+def emit_delivery_status(event):
+    """Tell the chat and the admin dashboard how a Telegram delivery went"""
+    socketio.emit('delivery_status', event, room='chat_' + str(event['user_id']))
+    socketio.emit('delivery_status', event, room='admin_room')
+
+# Admin messages bound for Telegram, sent from the bot loop (see delivery.py)
+deliveries = DeliveryQueue(emit=emit_delivery_status)
+bot_runtime.bot.on_connect(deliveries.run)
+
 @app.route('/')
 def health_check():
     return jsonify({
@@ -1200,22 +1317,36 @@ def health_check():
 def health():
     try:
         # Test database connection
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users')
-        user_count = c.fetchone()[0]
-        c.execute('SELECT COUNT(*) FROM messages')
-        message_count = c.fetchone()[0]
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*) FROM users')
+            user_count = c.fetchone()[0]
+            c.execute('SELECT COUNT(*) FROM messages')
+            message_count = c.fetchone()[0]
         
         return jsonify({
             'status': 'healthy',
             'api': 'running',
+            'ready': hydrator.loader.is_ready(),
+            'hydration': hydrator.loader.status(),
             'database': 'connected',
             'database_path': DB_NAME,
             'user_count': user_count,
             'message_count': message_count,
-            'database_file_exists': os.path.exists(DB_PATH) if DB_NAME != ':memory:' else True
+            'database_file_exists': os.path.exists(DB_PATH) if DB_NAME != ':memory:' else True,
+            'connection_pool': db_pool.pool_status(),
+            'write_queue': db_writer.status(),
+            'stats_cache': stats.cache.status(),
+            'stats_broadcaster': stats.broadcaster.status(),
+            'message_cache': message_cache.cache.status(),
+            'storage': storage.backend.status(),
+            'bot': bot_runtime.bot.status(),
+            'join_pipeline': join_requests.status(),
+            'join_backlog': join_backlog.status(),
+            'delivery': deliveries.status(),
+            'incoming_messages': incoming_messages.status(),
+            'telegram_scheduler': telegram_scheduler.status(),
+            'replication': replicator.worker.status()
         })
     except Exception as e:
         return jsonify({
@@ -1237,14 +1368,13 @@ def test_database():
         test_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         print(f"🧪 Testing database with user: {test_user_id}")
-        db_add_user(test_user_id, test_name, test_username, test_date, None)
+        storage.backend.add_user(test_user_id, test_name, test_username, test_date, None)
         
         # Verify user was added
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE user_id = ?', (test_user_id,))
-        user = c.fetchone()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT * FROM users WHERE user_id = ?', (test_user_id,))
+            user = c.fetchone()
         
         if user:
             print(f"✅ Test user added successfully: {user}")
@@ -1277,26 +1407,28 @@ def test_database():
 def database_status():
     """Show current database status and users"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        
-        # Get total users
-        c.execute('SELECT COUNT(*) FROM users')
-        total_users = c.fetchone()[0]
+        with db_pool.connection() as conn:
+            c = conn.cursor()
         
-        # Get total messages
-        c.execute('SELECT COUNT(*) FROM messages')
-        total_messages = c.fetchone()[0]
+            # Get total users
+            c.execute('SELECT COUNT(*) FROM users')
+            total_users = c.fetchone()[0]
         
-        # Get recent users (last 10)
-        c.execute('SELECT user_id, full_name, username, join_date FROM users ORDER BY join_date DESC LIMIT 10')
-        recent_users = c.fetchall()
+            # Get total messages
+            c.execute('SELECT COUNT(*) FROM messages')
+            total_messages = c.fetchone()[0]
         
-        conn.close()
+            # Get recent users (last 10)
+            c.execute('SELECT user_id, full_name, username, join_date FROM users ORDER BY join_ts_ms DESC LIMIT 10')
+            recent_users = c.fetchall()
+            
+            schema_version = migrations.current_version(conn)
         
         return jsonify({
             'status': 'success',
             'database_path': DB_NAME,
+            'schema_version': schema_version,
+            'query_plans': migrations.verify_query_plans(),
             'total_users': total_users,
             'total_messages': total_messages,
             'recent_users': [
@@ -1340,6 +1472,12 @@ def backup_database_endpoint():
 def restore_database_endpoint():
     """Manually restore database"""
     try:
+        if not hydrator.loader.is_ready():
+            # Copying a backup over the database mid-hydration would mix the two
+            return jsonify({
+                'status': 'error',
+                'message': 'Hydration from Firebase is still running; try again once it is ready'
+            }), 409
         if restore_database():
             return jsonify({
                 'status': 'success',
@@ -1368,16 +1506,15 @@ def test_add_user():
         join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         # Add user to database
-        db_add_user(user_id, full_name, username, join_date, None)
+        storage.backend.add_user(user_id, full_name, username, join_date, None)
         
         # Verify user was added
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users')
-        total_users = c.fetchone()[0]
-        c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = c.fetchone()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*) FROM users')
+            total_users = c.fetchone()[0]
+            c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            user = c.fetchone()
         
         return jsonify({
             'status': 'success',
@@ -1604,25 +1741,21 @@ def send_telegram_message():
         if not user_id or not message:
             return jsonify({'error': 'User ID and message required'}), 400
         
-        # Save message to database
-        save_message(int(user_id), 'admin', message)
-        
-        # Try to send through Telegram bot (if available)
-        try:
-            # This would require the bot to be properly configured
-            # For now, just save to database
-            print(f"📨 Message saved for user {user_id}: {message}")
-        except Exception as bot_error:
-            print(f"⚠️ Bot send failed: {bot_error}")
+        # Save it with its Telegram delivery queued (sent as text); progress
+        # arrives as delivery_status events
+        message_id = deliveries.send(int(user_id), message)
+        print(f"📨 Message queued for Telegram delivery to {user_id}")
         
         # Emit socket event
         socketio.emit('new_message', {'user_id': int(user_id)}, room='chat_' + str(user_id))
         
         return jsonify({
             'status': 'success',
-            'message': 'Message sent successfully',
+            'message': 'Message queued for delivery',
             'user_id': user_id,
-            'message': message
+            'message': message,
+            'message_id': message_id,
+            'delivery_status': 'queued'
         })
         
     except Exception as e:
@@ -1661,11 +1794,10 @@ def get_user_files(user_id):
 def get_user_info(user_id):
     """Get specific user information"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users WHERE user_id = ?', (user_id,))
-        user = c.fetchone()
-        conn.close()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users WHERE user_id = ?', (user_id,))
+            user = c.fetchone()
         
         if user:
             return jsonify({
@@ -1697,29 +1829,28 @@ def get_user_info(user_id):
 def admin_messages():
     """Get all recent messages for admin dashboard"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
+        with db_pool.connection() as conn:
+            c = conn.cursor()
         
-        # Get recent messages with user info
-        c.execute('''
-            SELECT m.user_id, m.sender, m.message, m.timestamp, 
-                   u.full_name, u.username
-            FROM messages m
-            LEFT JOIN users u ON m.user_id = u.user_id
-            ORDER BY m.timestamp DESC
-            LIMIT 100
-        ''')
-        messages = c.fetchall()
-        conn.close()
+            # Get recent messages with user info
+            c.execute('''
+                SELECT m.user_id, m.sender, m.message, m.ts_ms, m.timestamp, 
+                       u.full_name, u.username
+                FROM messages m
+                LEFT JOIN users u ON m.user_id = u.user_id
+                ORDER BY m.ts_ms DESC
+                LIMIT 100
+            ''')
+            messages = c.fetchall()
         
         # Format messages for admin
         formatted_messages = []
-        for user_id, sender, message, timestamp, full_name, username in messages:
+        for user_id, sender, message, ts_ms, timestamp, full_name, username in messages:
             formatted_messages.append({
                 'user_id': user_id,
                 'sender': sender,
                 'message': message,
-                'timestamp': timestamp,
+                'timestamp': timeutil.format_ms(ts_ms, timestamp),
                 'user_name': full_name or f"User {user_id}",
                 'username': username or "Unknown"
             })
@@ -1740,39 +1871,34 @@ def admin_messages():
 
 @app.route('/admin/users')
 def admin_users():
-    """Get all users for admin dashboard"""
+    """Get users for admin dashboard (paginated, sortable, filterable)"""
     try:
-        users = get_all_users()
-        
-        # Add online status and message count for each user
-        users_with_stats = []
-        for user in users:
-            user_id = user[0]
-            is_online = get_user_online_status(user_id, 5)
-            
-            # Get message count for this user
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
-            message_count = c.fetchone()[0]
-            conn.close()
-            
-            users_with_stats.append({
-                'user_id': user[0],
-                'full_name': user[1],
-                'username': user[2],
-                'join_date': user[3],
-                'invite_link': user[4],
-                'photo_url': user[5],
-                'label': user[6],
-                'is_online': is_online,
-                'message_count': message_count
-            })
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 50)), 1), 500)
+        sort = request.args.get('sort', 'join_date')
+        order = request.args.get('order', 'desc')
+        online = request.args.get('online')
+        if online is not None:
+            online = online.lower() in ('1', 'true', 'yes')
+        
+        users_with_stats, total = query_users_with_activity(
+            page=page,
+            page_size=page_size,
+            sort=sort,
+            order=order,
+            search=request.args.get('q'),
+            label=request.args.get('label'),
+            online=online
+        )
         
         return jsonify({
             'status': 'success',
             'users': users_with_stats,
-            'total_users': len(users_with_stats)
+            'total_users': total,
+            'page': page,
+            'page_size': page_size,
+            'sort': sort if sort in USER_SORT_COLUMNS else 'join_date',
+            'order': 'asc' if order.lower() == 'asc' else 'desc'
         })
         
     except Exception as e:
@@ -1783,23 +1909,84 @@ def admin_users():
             'users': []
         }), 500
 
+@app.route('/conversations')
+def conversations():
+    """Admin inbox sorted by last activity, keyset-paginated with ?cursor=&limit="""
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        cursor = request.args.get('cursor')
+        params = []
+        if cursor:
+            # Cursor is '<last_ts_ms>:<user_id>' of the last row already shown
+            cursor_ts, cursor_user = (int(part) for part in cursor.split(':', 1))
+            params += [cursor_ts, cursor_user]
+        unread = request.args.get('unread') in ('1', 'true', 'yes')
+        params.append(limit + 1)
+        
+        with db_pool.connection() as conn:
+            rows = conn.execute(migrations.conversations_page_sql(bool(cursor), unread), params).fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        online_since = timeutil.minutes_ago_ms(5)
+        items = [{
+            'user_id': r[0],
+            'last_message_id': r[1],
+            'last_message': r[2],
+            'last_sender': r[3],
+            'last_activity': timeutil.format_ms(r[4]),
+            'message_count': r[5],
+            'unread_count': r[6],
+            'user_name': r[7] or f"User {r[0]}",
+            'username': r[8] or "Unknown",
+            'photo_url': r[9],
+            'label': r[10],
+            'is_online': r[4] >= online_since
+        } for r in rows]
+        
+        return jsonify({
+            'status': 'success',
+            'conversations': items,
+            'next_cursor': f'{rows[-1][4]}:{rows[-1][0]}' if has_more else None,
+            'has_more': has_more
+        })
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor or limit', 'conversations': []}), 400
+    except Exception as e:
+        print(f"❌ Error getting conversations: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e),
+            'conversations': []
+        }), 500
+
+@app.route('/conversations/<int:user_id>/read', methods=['POST'])
+def mark_conversation_read(user_id):
+    """Reset the unread-by-admin counter for a conversation"""
+    try:
+        db_mark_conversation_read(user_id)
+        return jsonify({'status': 'ok', 'user_id': user_id, 'unread_count': 0})
+    except Exception as e:
+        print(f"❌ Error marking conversation read: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/bot-status')
 def bot_status():
     """Check bot status and connection"""
     try:
-        # Test bot connection
-        with pyro_app:
-            me = pyro_app.get_me()
-            bot_info = {
-                'bot_id': me.id,
-                'bot_name': me.first_name,
-                'bot_username': me.username,
-                'is_bot': me.is_bot,
-                'status': 'connected'
-            }
+        # Test bot connection (one RPC on the persistent session)
+        me = bot_runtime.bot.submit(lambda client: client.get_me())
+        bot_info = {
+            'bot_id': me.id,
+            'bot_name': me.first_name,
+            'bot_username': me.username,
+            'is_bot': me.is_bot,
+            'status': 'connected'
+        }
         return jsonify({
             'status': 'success',
             'bot_info': bot_info,
+            'runtime': bot_runtime.bot.status(),
             'chat_id': CHAT_ID,
             'firebase_available': FIREBASE_AVAILABLE
         })
@@ -1807,6 +1994,7 @@ def bot_status():
         return jsonify({
             'status': 'error',
             'message': str(e),
+            'runtime': bot_runtime.bot.status(),
             'firebase_available': FIREBASE_AVAILABLE
         }), 500
 
@@ -1824,12 +2012,8 @@ def test_join_request():
             
         join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        # Add user to database
-        db_add_user(user_id, full_name, username, join_date, None)
-        
-        # Save to Firebase if available
-        if FIREBASE_AVAILABLE:
-            add_user_to_firebase(user_id, full_name, username, join_date, None)
+        # Add user to database (replicated to Firebase in the background)
+        storage.backend.add_user(user_id, full_name, username, join_date, None)
         
         # Send welcome message
         welcome_message = f"🎉 Welcome {full_name}! You have been added to our group."
@@ -1884,7 +2068,7 @@ def test_firebase():
         message_success = save_message_to_firebase(test_user_id, 'admin', 'Firebase test message')
         
         # Test message retrieval
-        messages = get_messages_for_user_from_firebase(test_user_id, 10)
+        messages, _has_more = get_messages_for_user_from_firebase(test_user_id, 10)
         
         return jsonify({
             'status': 'success',
@@ -1907,11 +2091,27 @@ def test_firebase():
             'firebase_available': FIREBASE_AVAILABLE
         }), 500
 
-@app.route('/migrate-to-firebase', methods=['POST'])
+@app.route('/replication-status')
+def replication_status():
+    """Outbox depth and lag of the SQLite -> Firebase replicator"""
+    try:
+        return jsonify({'status': 'success', 'replication': replicator.worker.status()})
+    except Exception as e:
+        print(f"❌ Error getting replication status: {e}")
+        return jsonify({'status': 'error', 'error': str(e)}), 500
+
+@app.route('/migrate-to-firebase', methods=['GET', 'POST'])
 def migrate_to_firebase():
-    """Migrate SQLite data to Firebase"""
+    """Migrate SQLite data to Firebase.
+
+    POST starts a background run (resuming from its checkpoint; {"restart": true}
+    starts over, ?wait=1 blocks until done). GET reports progress and rows/sec.
+    """
     try:
-        from firebase_config import migrate_sqlite_to_firebase
+        from firebase_migrator import migrator
+        
+        if request.method == 'GET':
+            return jsonify({'status': 'success', 'progress': migrator.status()})
         
         if not FIREBASE_AVAILABLE:
             return jsonify({
@@ -1919,18 +2119,26 @@ def migrate_to_firebase():
                 'message': 'Firebase not available'
             }), 500
         
-        success = migrate_sqlite_to_firebase()
-        
-        if success:
+        restart = bool((request.get_json(silent=True) or {}).get('restart'))
+        if request.args.get('wait') in ('1', 'true'):
+            success = migrator.run(restart=restart)
             return jsonify({
-                'status': 'success',
-                'message': 'Migration completed successfully'
-            })
-        else:
+                'status': 'success' if success else 'error',
+                'message': 'Migration completed successfully' if success else 'Migration failed',
+                'progress': migrator.status()
+            }), 200 if success else 500
+        
+        if not migrator.start(restart=restart):
             return jsonify({
                 'status': 'error',
-                'message': 'Migration failed'
-            }), 500
+                'message': 'Migration already running',
+                'progress': migrator.status()
+            }), 409
+        return jsonify({
+            'status': 'started',
+            'message': 'Migration started; GET /migrate-to-firebase for progress',
+            'progress': migrator.status()
+        }), 202
             
     except Exception as e:
         print(f"❌ Migration error: {e}")
@@ -1939,6 +2147,30 @@ def migrate_to_firebase():
             'message': f'Migration error: {str(e)}'
         }), 500
 
+@app.route('/migrate-realtime-db', methods=['POST'])
+def migrate_realtime_db():
+    """Move Realtime Database messages from the flat list to per-user paths (safe to rerun)"""
+    try:
+        from firebase_config import migrate_realtime_db_layout
+        
+        moved = migrate_realtime_db_layout()
+        if moved is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Realtime Database migration failed'
+            }), 500
+        return jsonify({
+            'status': 'success',
+            'message': f'Moved {moved} messages to per-user paths',
+            'moved': moved
+        })
+    except Exception as e:
+        print(f"❌ Realtime DB migration error: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Migration error: {str(e)}'
+        }), 500
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     print(f"🚀 Starting Simplified Telegram Bot API on port {port}")
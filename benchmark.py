@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the storage layer (no Telegram or Firebase needed)
+
+Usage: python benchmark.py inserts [--rows N] [--threads T]
+       python benchmark.py firestore-counts [--users N]
+       python benchmark.py hydrate [--users N] [--messages M]
+       python benchmark.py realtime-db [--users N] [--messages M]
+       python benchmark.py storage [--backend sqlite|firestore|memory|all] [--users N] [--messages M]
+       python benchmark.py firestore-endpoints [--sizes 1000,10000] [--latency-ms MS]
+       python benchmark.py joins [--joins N] [--rpc-ms MS]
+       python benchmark.py telegram-limits [--joins N] [--rate R]
+       python benchmark.py join-backlog [--pending N] [--rpc-ms MS]
+       python benchmark.py inbound [--messages N] [--users U]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import datetime
+from collections import deque
+from types import SimpleNamespace
+
+import db_pool
+import db
+from db_writer import writer
+
+
+def _timestamp():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _run_threads(threads, rows, work):
+    """Split rows across threads, run work(start, count) in each, return seconds"""
+    per_thread = rows // threads
+    workers = [threading.Thread(target=work, args=(i * per_thread, per_thread)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - started
+
+
+def bench_inserts(rows, threads):
+    """Compare per-row connect/commit inserts with the WAL group-commit writer"""
+    workdir = tempfile.mkdtemp(prefix='joingroup-bench-')
+
+    # Before: every save opens a connection, inserts one row and commits
+    legacy_db = os.path.join(workdir, 'legacy.db')
+    db_pool.configure(legacy_db)
+    db.init_db()
+    with db_pool.connection() as conn:
+        conn.execute('PRAGMA journal_mode = DELETE')
+    db_pool.close_all()
+
+    errors = []
+
+    def legacy_work(start, count):
+        for i in range(start, start + count):
+            try:
+                conn = sqlite3.connect(legacy_db, timeout=30)
+                conn.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+                             (i % 100, 'user', f'message {i}', _timestamp()))
+                conn.commit()
+                conn.close()
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    legacy_seconds = _run_threads(threads, rows, legacy_work)
+
+    # After: WAL plus one writer thread batching queued inserts
+    wal_db = os.path.join(workdir, 'wal.db')
+    db_pool.configure(wal_db)
+    db.init_db()
+
+    def queued_work(start, count):
+        futures = [db.queue_message(i % 100, 'user', f'message {i}') for i in range(start, start + count)]
+        for future in futures:
+            future.result()
+
+    queued_seconds = _run_threads(threads, rows, queued_work)
+    status = writer.status()
+    writer.stop()
+
+    total = (rows // threads) * threads
+    print(f"📊 {total} inserts from {threads} threads")
+    print(f"   before (connect/commit per row): {total / legacy_seconds:10.0f} inserts/sec"
+          f"  ({len(errors)} 'database is locked' errors)")
+    print(f"   after  (WAL + group commit):     {total / queued_seconds:10.0f} inserts/sec"
+          f"  (avg {status['avg_batch_size']} rows per transaction)")
+    print(f"   speedup: {legacy_seconds / queued_seconds:.1f}x")
+
+
+def bench_firestore_counts(users):
+    """Document reads per dashboard count: streaming vs count() vs sharded counter vs cache"""
+    import firebase_config
+    from fake_firebase import FakeFirestore
+
+    client = FakeFirestore()
+    firebase_config.use_firestore_client(client)
+    today = datetime.date.today().isoformat()
+
+    # Seed users (half of them joined today) with their counter shards, 500 per batch
+    for start in range(0, users, 500):
+        batch = client.batch()
+        for user_id in range(start, min(start + 500, users)):
+            join_date = f"{today} 12:00:00" if user_id % 2 else '2020-01-01 12:00:00'
+            batch.set(client.collection('users').document(str(user_id)),
+                      {'user_id': user_id, 'join_date': join_date})
+            firebase_config._increment_counter(batch, client, 'total_users')
+            firebase_config._increment_counter(batch, client, firebase_config._joins_counter_name(join_date))
+        batch.commit()
+
+    def reads_for(fn):
+        client.reset_counters()
+        started = time.perf_counter()
+        value = fn()
+        return value, client.reads, (time.perf_counter() - started) * 1000
+
+    print(f"📊 Counting {users} Firestore users")
+    rows = [
+        ('stream every document (before)', lambda: len(list(client.collection('users').stream()))),
+        ('sharded counter', lambda: firebase_config.read_counter('total_users')),
+        ('count() aggregation', firebase_config.get_total_users_from_firebase),
+        ('cached count()', firebase_config.get_total_users_from_firebase),
+    ]
+    for label, fn in rows:
+        value, reads, ms = reads_for(fn)
+        print(f"   {label:32} value={value:<9} reads={reads:<9} {ms:8.1f} ms")
+    firebase_config.use_firestore_client(None)
+
+
+def bench_hydrate(users, messages):
+    """Cold-start hydration of an empty SQLite file from a populated Firestore stand-in"""
+    import firebase_config
+    import hydrator
+    import timeutil
+    from fake_firebase import FakeFirestore
+
+    client = FakeFirestore()
+    firebase_config.use_firestore_client(client)
+    now_ms = timeutil.now_ms()
+    for start in range(0, max(users, messages), 500):
+        batch = client.batch()
+        for i in range(start, min(start + 500, users)):
+            batch.set(client.collection('users').document(str(i)),
+                      firebase_config.user_document(i, f'User {i}', f'user{i}', _timestamp()))
+        for i in range(start + 1, min(start + 501, messages + 1)):
+            batch.set(client.collection('messages').document(str(i)),
+                      firebase_config.message_document(i % max(users, 1), 'user', f'message {i}',
+                                                       timeutil.format_ms(now_ms - i * 1000), i))
+        batch.commit()
+
+    db_pool.configure(os.path.join(tempfile.mkdtemp(prefix='joingroup-bench-'), 'cold.db'))
+    db.init_db()
+    loader = hydrator.Hydrator()
+    started = time.perf_counter()
+    loader.start(True)
+    loader._ready.wait()
+    seconds = time.perf_counter() - started
+    writer.stop()
+
+    status = loader.status()
+    print(f"📊 Hydrated {status['users']} users and {status['messages']} messages in {seconds:.2f}s"
+          f" ({(status['users'] + status['messages']) / seconds:.0f} rows/sec, state={status['state']})")
+    firebase_config.use_firestore_client(None)
+
+
+def bench_realtime_db(users, messages):
+    """Bytes transferred per chat read: flat /messages download vs per-user path query"""
+    import firebase_config
+    from fake_firebase import FakeRealtimeDB
+
+    rtdb = FakeRealtimeDB()
+    root = rtdb.reference()
+    firebase_config.use_realtime_db(root)
+
+    # Seed the legacy flat layout (messages/<push id>)
+    for start in range(0, messages, 1000):
+        root.update({f'messages/{rtdb._next_push_id()}': {
+            'user_id': i % max(users, 1), 'sender': 'user', 'message': f'message {i}', 'timestamp': _timestamp()
+        } for i in range(start, min(start + 1000, messages))})
+    user_id = 1 % max(users, 1)
+
+    def measure(fn):
+        rtdb.reset_counters()
+        started = time.perf_counter()
+        result = fn()
+        return result, rtdb.bytes_downloaded, (time.perf_counter() - started) * 1000
+
+    # Before: every call downloaded the whole tree and filtered it in Python
+    def legacy_read():
+        data = root.child('messages').get() or {}
+        return [m for m in data.values() if m.get('user_id') == user_id][:100]
+
+    print(f"📊 Reading one chat ({messages // max(users, 1)} messages) out of {messages} Realtime DB messages")
+    before, before_bytes, before_ms = measure(legacy_read)
+    print(f"   {'flat /messages download (before)':36} rows={len(before):<5} bytes={before_bytes:<11} {before_ms:8.1f} ms")
+
+    started = time.perf_counter()
+    moved = firebase_config.migrate_realtime_db_layout()
+    print(f"   migrated {moved} messages to per-user paths in {time.perf_counter() - started:.2f}s")
+
+    after, after_bytes, after_ms = measure(lambda: firebase_config.get_messages_for_user_from_realtime_db(user_id, 100))
+    print(f"   {'per-user path, limit_to_last (after)':36} rows={len(after):<5} bytes={after_bytes:<11} {after_ms:8.1f} ms")
+    print(f"   {before_bytes / max(after_bytes, 1):.0f}x fewer bytes per call")
+    firebase_config.use_realtime_db(None)
+
+
+def bench_storage(backends, users, messages):
+    """The same workload against each storage backend (Firestore via the in-process fake)"""
+    import firebase_config
+    import message_cache
+    import storage
+    from fake_firebase import FakeFirestore
+
+    print(f"📊 {users} users, {messages} messages, then 1000 page reads and 1000 stats reads per backend")
+    for name in backends:
+        if name == 'sqlite':
+            db_pool.configure(os.path.join(tempfile.mkdtemp(prefix='joingroup-bench-'), 'storage.db'))
+            db.init_db()
+        elif name == 'firestore':
+            firebase_config.use_firestore_client(FakeFirestore())
+        message_cache.cache.clear()
+        backend = storage.create(name, firebase_available=(name == 'firestore'))
+
+        started = time.perf_counter()
+        for future in [backend.queue_user(i, f'User {i}', f'user{i}', _timestamp()) for i in range(users)]:
+            future.result()
+        user_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for future in [backend.queue_message(i % max(users, 1), 'user', f'message {i}') for i in range(messages)]:
+            future.result()
+        message_seconds = time.perf_counter() - started
+
+        def per_call_ms(fn, calls=1000):
+            started = time.perf_counter()
+            for i in range(calls):
+                fn(i)
+            return (time.perf_counter() - started) * 1000 / calls
+
+        uncached_ms = per_call_ms(lambda i: backend.load_message_page(i % max(users, 1), 50))
+        cached_ms = per_call_ms(lambda i: backend.get_message_page(i % 10, 50))
+        stats_ms = per_call_ms(lambda i: backend.get_stats())
+
+        print(f"   {name:9} users {users / user_seconds:8.0f}/s  messages {messages / message_seconds:8.0f}/s  "
+              f"page {uncached_ms:6.3f} ms (cached {cached_ms:6.3f})  stats {stats_ms:6.3f} ms")
+    firebase_config.use_firestore_client(None)
+    writer.stop()
+
+
+def bench_firestore_endpoints(sizes, latency_ms):
+    """Firestore reads/writes/round trips per endpoint as the data grows (firestore backend)"""
+    import fake_firebase
+    import firebase_config
+    import storage
+    import timeutil
+
+    endpoints = [
+        ('GET /chat/<id>/messages', lambda s, n: s.load_message_page(1, 100)),
+        ('GET /chat/<id>/sync', lambda s, n: s.get_messages_since(1, since_id=n * 10 - n * 2)),
+        ('GET /dashboard-stats', lambda s, n: (firebase_config.invalidate_count_cache(), s.get_stats())),
+        ('GET /dashboard-stats (cached)', lambda s, n: s.get_stats()),
+        ('POST /send_all (user list)', lambda s, n: s.get_all_users()),
+        ('POST /send-admin-message', lambda s, n: s.save_message(1, 'admin', 'hello')),
+        ('POST /manual-join', lambda s, n: s.add_user(n + 1, 'New User', 'new', _timestamp())),
+        ('replicator batch (150 events)', lambda s, n: firebase_config.replicate_events([
+            ('message', {'message_id': n * 100 + i, 'user_id': i, 'sender': 'user', 'message': 'x',
+                         'timestamp': _timestamp()}) for i in range(150)])),
+    ]
+    results = {label: [] for label, _fn in endpoints}
+
+    for users in sizes:
+        client, _rtdb = fake_firebase.install(latency_ms=0)
+        now_ms = timeutil.now_ms()
+        messages = users * 10
+        # Seed with no latency: users, and 10 messages each spread over the last two days
+        for start in range(0, messages, 500):
+            batch = client.batch()
+            for i in range(start, min(start + 500, messages)):
+                if i < users:
+                    batch.set(client.collection('users').document(str(i)),
+                              firebase_config.user_document(i, f'User {i}', f'user{i}', _timestamp()))
+                ts = timeutil.format_ms(now_ms - (messages - i) * (172_800_000 // messages))
+                batch.set(client.collection('messages').document(str(i + 1)),
+                          firebase_config.message_document(i % users, 'user', f'message {i}', ts, i + 1))
+            batch.commit()
+        client.latency_ms = latency_ms
+        backend = storage.FirestoreStorage()
+
+        for label, fn in endpoints:
+            client.reset_counters()
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn(backend, users)
+            ms = (time.perf_counter() - started) * 1000
+            results[label].append((client.reads, client.writes, client.rpcs, ms))
+        fake_firebase.uninstall()
+
+    header = ''.join(f"{f'{n} users':>30}" for n in sizes)
+    print(f"📊 Firestore cost per call (reads/writes/round trips, ms) with {latency_ms} ms injected latency")
+    print(f"   {'endpoint':32}{header}")
+    for label, rows in results.items():
+        cells = ''.join(f"{f'{r}/{w}/{rpc} {ms:8.1f}ms':>30}" for r, w, rpc, ms in rows)
+        print(f"   {label:32}{cells}")
+
+
+class _FakeTelegram:
+    """Bot client stand-in: every call takes rpc_ms and approvals are timestamped"""
+
+    def __init__(self, rpc_ms):
+        self.rpc_ms = rpc_ms
+        self.approved = {}
+        self.sent = 0
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        await asyncio.sleep(self.rpc_ms / 1000)
+        self.approved[user_id] = time.perf_counter()
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.rpc_ms / 1000)
+        self.sent += 1
+
+
+def _fake_join(user_id):
+    user = SimpleNamespace(id=user_id, first_name=f'User{user_id}', last_name=None,
+                           username=f'user{user_id}', mention=f'User{user_id}')
+    return SimpleNamespace(from_user=user, chat=SimpleNamespace(id=-100, title='Bench group'))
+
+
+async def _dispatch(handler, client, joins, workers):
+    """Feed a burst of join updates to `workers` handler tasks, like Pyrogram's dispatcher"""
+    updates = asyncio.Queue()
+    for join in joins:
+        updates.put_nowait(join)
+
+    async def worker():
+        while not updates.empty():
+            await handler(client, updates.get_nowait())
+    await asyncio.gather(*[worker() for _ in range(workers)])
+
+
+def bench_joins(joins, rpc_ms):
+    """Approvals/sec and approval latency in a join storm: inline handler vs JoinPipeline"""
+    import storage
+    from join_pipeline import JoinPipeline
+
+    workdir = tempfile.mkdtemp(prefix='joingroup-bench-')
+    db_pool.configure(os.path.join(workdir, 'joins.db'))
+    db.init_db()
+    backend = storage.create('sqlite', firebase_available=False)
+    backup_path = os.path.join(workdir, 'joins.db.backup')
+    # Pyrogram's default handler worker count
+    workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def persist_args(join):
+        user = join.from_user
+        return user.id, user.first_name, user.username, _timestamp()
+
+    # Before: approve, blocking save, full backup and DM inline in each handler
+    async def inline(client, join):
+        await client.approve_chat_join_request(join.chat.id, join.from_user.id)
+        backend.add_user(*persist_args(join))
+        db_pool.backup_to(backup_path)
+        await client.send_message(join.from_user.id, 'welcome')
+
+    # After: the handler only queues; stages run with their own limits
+    async def approve(client, join):
+        await client.approve_chat_join_request(join.chat.id, join.from_user.id)
+
+    async def persist(client, join):
+        await asyncio.wrap_future(backend.queue_user(*persist_args(join)))
+
+    async def welcome(client, join):
+        await client.send_message(join.from_user.id, 'welcome')
+
+    async def run(label, first_id, use_pipeline):
+        client = _FakeTelegram(rpc_ms)
+        batch = [_fake_join(first_id + i) for i in range(joins)]
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if use_pipeline:
+                pipeline = JoinPipeline(approve, persist, welcome, backup=lambda: db_pool.backup_to(backup_path))
+                await _dispatch(pipeline.submit, client, batch, workers)
+                await pipeline.drain()
+                await pipeline.flush_backup()
+                await pipeline.stop()
+            else:
+                await _dispatch(inline, client, batch, workers)
+        done_seconds = time.perf_counter() - started
+
+        latencies = sorted(t - started for t in client.approved.values())
+        approve_seconds = latencies[-1]
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        print(f"   {label:34} {len(latencies) / approve_seconds:8.0f} approvals/s  "
+              f"p50 {p50:8.1f} ms  p99 {p99:8.1f} ms  all stages done in {done_seconds:6.2f}s")
+        return p99
+
+    print(f"📊 {joins} join requests at once, {rpc_ms} ms per Telegram call, {workers} handler workers")
+    before = asyncio.run(run('before (inline handler)', 1, False))
+    after = asyncio.run(run('after  (staged pipeline)', joins + 1, True))
+    print(f"   p99 approval latency {before / after:.1f}x lower")
+    writer.stop()
+
+
+class _FloodingTelegram(_FakeTelegram):
+    """_FakeTelegram that answers FloodWait past `rate` calls/s overall or one call/s per chat"""
+
+    def __init__(self, rpc_ms, rate):
+        super().__init__(rpc_ms)
+        self.rate = rate
+        self.recent = deque()
+        self.chat_last = {}
+        self.accepted = 0
+        self.floods = 0
+
+    def _check(self, chat_id):
+        from pyrogram.errors import FloodWait
+
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate or (chat_id is not None and now - self.chat_last.get(chat_id, -1) < 1):
+            self.floods += 1
+            raise FloodWait(value=1)
+        self.recent.append(now)
+        if chat_id is not None:
+            self.chat_last[chat_id] = now
+        self.accepted += 1
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        self._check(None)
+        await super().approve_chat_join_request(chat_id, user_id)
+
+    async def send_message(self, chat_id, text):
+        self._check(chat_id)
+        await super().send_message(chat_id, text)
+
+
+def bench_telegram_limits(joins, rate):
+    """Approvals, welcome DMs and a broadcast against rate limits: unpaced vs TelegramScheduler"""
+    from telegram_scheduler import TelegramScheduler, PRIORITY_APPROVAL, PRIORITY_WELCOME, PRIORITY_BROADCAST
+
+    async def run(label, scheduled):
+        client = _FloodingTelegram(rpc_ms=30, rate=rate)
+        scheduler = TelegramScheduler(rate=rate)
+        lost = []
+        limit = asyncio.Semaphore(16)
+
+        async def send(fn, chat_id, priority):
+            try:
+                if scheduled:
+                    await scheduler.call(fn, chat_id=chat_id, priority=priority)
+                else:
+                    async with limit:
+                        await fn()
+            except Exception as e:
+                lost.append(e)
+
+        # The broadcast is queued first; approvals must still go out ahead of it
+        calls = [send(lambda u=u: client.send_message(u, 'news'), u, PRIORITY_BROADCAST) for u in range(joins)]
+        for u in range(joins, 2 * joins):
+            calls.append(send(lambda u=u: client.approve_chat_join_request(-100, u), None, PRIORITY_APPROVAL))
+            calls.append(send(lambda u=u: client.send_message(u, 'welcome'), u, PRIORITY_WELCOME))
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*calls)
+        seconds = time.perf_counter() - started
+        approvals = sorted(client.approved.values())
+        last_approval = f"{approvals[-1] - started:.2f}s" if approvals else '-'
+        print(f"   {label:20} delivered {client.accepted:4}/{len(calls)}  lost {len(lost):4}  "
+              f"FloodWait {client.floods:4}  {client.accepted / seconds:5.1f} delivered/s over {seconds:5.2f}s  "
+              f"{len(approvals)}/{joins} approved, last at {last_approval}")
+
+    print(f"📊 {joins} joins (approve + welcome DM) and a {joins}-user broadcast, "
+          f"limits {rate:.0f} calls/s overall and 1/s per chat")
+    asyncio.run(run('before (unpaced)', False))
+    asyncio.run(run('after  (scheduler)', True))
+
+
+class _FakeAdminSession(_FakeTelegram):
+    """User-session stand-in holding `pending` join requests for one chat"""
+
+    def __init__(self, rpc_ms, user_ids):
+        super().__init__(rpc_ms)
+        self.pending = {u: _fake_join(u).from_user for u in user_ids}
+        self.list_calls = 0
+
+    async def get_chat_join_requests(self, chat_id):
+        users = list(self.pending.values())
+        for start in range(0, len(users), 100):
+            self.list_calls += 1
+            await asyncio.sleep(self.rpc_ms / 1000)
+            for user in users[start:start + 100]:
+                yield SimpleNamespace(user=user)
+
+    async def get_chat(self, chat_id):
+        return SimpleNamespace(id=chat_id, title='Bench group')
+
+
+class _FakeBacklogBot(_FakeTelegram):
+    """Bot stand-in that approves only requests still pending in `session`"""
+
+    def __init__(self, rpc_ms, session):
+        super().__init__(rpc_ms)
+        self.session = session
+        self.get_chat = session.get_chat
+        self.welcomed = []
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        from pyrogram.errors import BadRequest
+        await asyncio.sleep(self.rpc_ms / 1000)
+        if self.session.pending.pop(user_id, None) is None:
+            raise BadRequest('HIDE_REQUESTER_MISSING')
+        self.approved[user_id] = time.perf_counter()
+
+    async def get_chat_member(self, chat_id, user_id):
+        from pyrogram.enums import ChatMemberStatus
+        from pyrogram.errors import UserNotParticipant
+        await asyncio.sleep(self.rpc_ms / 1000)
+        if user_id not in self.approved:
+            raise UserNotParticipant()
+        return SimpleNamespace(status=ChatMemberStatus.MEMBER, is_member=None)
+
+
+def bench_join_backlog(pending, rpc_ms):
+    """Time to drain N pending join requests, alone and while the live pipeline holds some of them"""
+    import storage
+    from join_backlog import JoinBacklog
+    from join_pipeline import JoinPipeline
+    from telegram_scheduler import TelegramScheduler
+
+    db_pool.configure(os.path.join(tempfile.mkdtemp(prefix='joingroup-bench-'), 'backlog.db'))
+    db.init_db()
+    backend = storage.create('sqlite', firebase_available=False)
+
+    async def persist_users(users):
+        rows = [(u.id, u.first_name, u.username, _timestamp()) for u in users]
+        await asyncio.wrap_future(backend.queue_users(rows))
+
+    async def welcome(bot, user, chat_title):
+        await bot.send_message(user.id, 'welcome')
+        bot.welcomed.append(user.id)
+
+    async def run(label, first_id, in_flight, withdrawn):
+        user_ids = range(first_id + 1, first_id + pending + 1)
+        session = _FakeAdminSession(rpc_ms, user_ids)
+        session.start = lambda: asyncio.sleep(0)
+        bot = _FakeBacklogBot(rpc_ms, session)
+        pipeline = JoinPipeline(None, None, None)
+        backlog = JoinBacklog(-100, persist_users, welcome, user_client_factory=lambda: session,
+                              scheduler=TelegramScheduler(), pipeline=pipeline)
+        # Live requests the pipeline is handling, and requests withdrawn after the listing
+        for user_id in user_ids[:in_flight]:
+            pipeline.claim(user_id)
+        listing = session.get_chat_join_requests
+
+        async def list_then_withdraw(chat_id):
+            async for joiner in listing(chat_id):
+                yield joiner
+            for user_id in user_ids[in_flight:in_flight + withdrawn]:
+                session.pending.pop(user_id, None)
+        session.get_chat_join_requests = list_then_withdraw
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            drained = await backlog.drain(bot)
+            await asyncio.gather(*backlog._welcomes)
+        report = backlog.status()
+        with db_pool.connection() as conn:
+            saved = conn.execute('SELECT COUNT(*) FROM users WHERE user_id > ?', (first_id,)).fetchone()[0]
+        print(f"   {label:34} {drained} approved, {saved} saved, {len(bot.welcomed)} welcomed, "
+              f"{report['skipped_in_flight']} skipped, {report['withdrawn']} withdrawn in {report['seconds']:6.2f}s  "
+              f"(list {report['list_seconds']:.2f}s, approve {report['approve_seconds']:.2f}s, "
+              f"save {report['persist_seconds']:.2f}s); {len(pipeline._in_flight)} still claimed")
+
+    print(f"📊 Draining {pending} pending join requests, {rpc_ms} ms per Telegram call, default rate limits")
+    asyncio.run(run('listed requests only', 0, 0, 0))
+    asyncio.run(run('10% in flight live, 5% withdrawn', pending, pending // 10, pending // 20))
+    writer.stop()
+
+
+def bench_inbound(messages, users):
+    """Private-message ingestion: a handler that saves and emits inline vs InboundMessages"""
+    import storage
+    from inbound import InboundMessages
+
+    db_pool.configure(os.path.join(tempfile.mkdtemp(prefix='joingroup-bench-'), 'inbound.db'))
+    db.init_db()
+    backend = storage.create('sqlite', firebase_available=False)
+    workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def updates(first_user):
+        batch = [SimpleNamespace(id=i // users + 1, from_user=SimpleNamespace(id=first_user + i % users), date=None,
+                                 media=None, text=f'message {i // users + 1}', caption=None)
+                 for i in range(messages)]
+        # Parallel handler workers can swap a user's consecutive messages
+        for i in range(0, messages - users, 10 * users):
+            batch[i], batch[i + users] = batch[i + users], batch[i]
+        return batch
+
+    async def run(label, first_user, use_ingester):
+        emitted = []
+        emit = lambda user_id, sender, text: emitted.append((user_id, int(text.split()[1])))
+        stalls = []
+        last_beat = [time.perf_counter()]
+
+        async def heartbeat():
+            # Gaps between 1 ms ticks: how long other tasks on the loop were held up
+            while True:
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                stalls.append(now - last_beat[0] - 0.001)
+                last_beat[0] = now
+
+        # Before: each handler call blocks the loop until its own commit, then emits
+        async def inline(client, message):
+            backend.save_message(message.from_user.id, 'user', message.text)
+            emit(message.from_user.id, 'user', message.text)
+
+        beat = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0)
+        started = last_beat[0] = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if use_ingester:
+                ingester = InboundMessages(emit=emit, backend=backend)
+                await _dispatch(ingester.handle, None, updates(first_user), workers)
+                await ingester.drain()
+                await ingester.stop()
+            else:
+                await _dispatch(inline, None, updates(first_user), workers)
+        seconds = time.perf_counter() - started
+        stalls.append(time.perf_counter() - last_beat[0])
+        beat.cancel()
+
+        with db_pool.connection() as conn:
+            stored = conn.execute('SELECT user_id, message FROM messages WHERE user_id >= ? ORDER BY id',
+                                  (first_user,)).fetchall()
+        last = {}
+        out_of_order = 0
+        for user_id, text in stored:
+            number = int(text.split()[1])
+            out_of_order += number < last.get(user_id, 0)
+            last[user_id] = number
+        print(f"   {label:28} {len(stored) / seconds:8.0f} messages/s  stored {len(stored)}  emitted {len(emitted)}  "
+              f"out of order {out_of_order:3}  worst loop stall {max(stalls, default=0) * 1000:6.1f} ms")
+
+    print(f"📊 {messages} private messages from {users} users at once, {workers} handler workers")
+    asyncio.run(run('before (save + emit inline)', 1_000_000, False))
+    asyncio.run(run('after  (batched ingestion)', 2_000_000, True))
+    writer.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    inserts = sub.add_parser('inserts', help='message insert throughput before/after group commit')
+    inserts.add_argument('--rows', type=int, default=5000)
+    inserts.add_argument('--threads', type=int, default=8)
+
+    counts = sub.add_parser('firestore-counts', help='Firestore reads per stats count, against the in-process fake')
+    counts.add_argument('--users', type=int, default=100000)
+
+    hydrate = sub.add_parser('hydrate', help='cold-start SQLite hydration from the Firestore stand-in')
+    hydrate.add_argument('--users', type=int, default=100000)
+    hydrate.add_argument('--messages', type=int, default=100000)
+
+    realtime = sub.add_parser('realtime-db', help='bytes per chat read from the Realtime DB stand-in, before/after')
+    realtime.add_argument('--users', type=int, default=1000)
+    realtime.add_argument('--messages', type=int, default=100000)
+
+    backends = sub.add_parser('storage', help='one workload against the sqlite, firestore and memory backends')
+    backends.add_argument('--backend', choices=['sqlite', 'firestore', 'memory', 'all'], default='all')
+    backends.add_argument('--users', type=int, default=1000)
+    backends.add_argument('--messages', type=int, default=10000)
+
+    endpoints = sub.add_parser('firestore-endpoints', help='Firestore cost per endpoint as data grows, with injected latency')
+    endpoints.add_argument('--sizes', default='1000,10000', help='comma-separated user counts (10 messages per user)')
+    endpoints.add_argument('--latency-ms', type=float, default=20)
+
+    join_storm = sub.add_parser('joins', help='approval throughput and latency in a join storm, before/after the pipeline')
+    join_storm.add_argument('--joins', type=int, default=2000)
+    join_storm.add_argument('--rpc-ms', type=float, default=30)
+
+    limits = sub.add_parser('telegram-limits', help='FloodWaits and throughput against Telegram-style rate limits')
+    limits.add_argument('--joins', type=int, default=200)
+    limits.add_argument('--rate', type=float, default=30)
+
+    backlog = sub.add_parser('join-backlog', help='time to drain pending join requests, alone and beside live joins')
+    backlog.add_argument('--pending', type=int, default=300)
+    backlog.add_argument('--rpc-ms', type=float, default=30)
+
+    inbound = sub.add_parser('inbound', help='private-message ingestion throughput and ordering, before/after batching')
+    inbound.add_argument('--messages', type=int, default=5000)
+    inbound.add_argument('--users', type=int, default=50)
+
+    args = parser.parse_args()
+    if args.scenario == 'inserts':
+        bench_inserts(args.rows, args.threads)
+    elif args.scenario == 'firestore-counts':
+        bench_firestore_counts(args.users)
+    elif args.scenario == 'hydrate':
+        bench_hydrate(args.users, args.messages)
+    elif args.scenario == 'realtime-db':
+        bench_realtime_db(args.users, args.messages)
+    elif args.scenario == 'storage':
+        names = ['sqlite', 'firestore', 'memory'] if args.backend == 'all' else [args.backend]
+        bench_storage(names, args.users, args.messages)
+    elif args.scenario == 'firestore-endpoints':
+        bench_firestore_endpoints([int(n) for n in args.sizes.split(',')], args.latency_ms)
+    elif args.scenario == 'joins':
+        bench_joins(args.joins, args.rpc_ms)
+    elif args.scenario == 'telegram-limits':
+        bench_telegram_limits(args.joins, args.rate)
+    elif args.scenario == 'join-backlog':
+        bench_join_backlog(args.pending, args.rpc_ms)
+    elif args.scenario == 'inbound':
+        bench_inbound(args.messages, args.users)
+
+
+if __name__ == '__main__':
+    main()
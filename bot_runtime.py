@@ -0,0 +1,170 @@
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+
+import timeutil
+
+# Seconds an HTTP handler waits for a bot call before giving up
+BOT_CALL_TIMEOUT = float(os.environ.get('BOT_CALL_TIMEOUT', 15))
+# Seconds start() waits for the first connection attempt
+BOT_START_TIMEOUT = float(os.environ.get('BOT_START_TIMEOUT', 30))
+# Delay between connection attempts after a failure
+BOT_RETRY_SECONDS = float(os.environ.get('BOT_RETRY_SECONDS', 30))
+
+
+class BotRuntime:
+    """One long-lived Pyrogram client on a dedicated event-loop thread.
+
+    The client is built on that thread (Pyrogram binds its dispatcher to the
+    loop that is current at construction), connects once and stays
+    connected, so update handlers run there and other threads reach it
+    through submit() for the cost of a single RPC.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.me = None
+        self._loop = None
+        self._thread = None
+        self._connected = threading.Event()
+        self._attempted = threading.Event()
+        self._stopping = False
+        self._status = {'state': 'stopped'}
+        self._on_connect = []
+        self._hooks = []
+        self._hooks_lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def on_connect(self, callback):
+        """Run `await callback(client)` on the loop thread once the client is connected
+        (right away if it already is)"""
+        with self._hooks_lock:
+            self._on_connect.append(callback)
+            if self.is_connected():
+                self._hooks.append(asyncio.run_coroutine_threadsafe(callback(self.client), self._loop))
+
+    def start(self, factory, wait=BOT_START_TIMEOUT):
+        """Start the loop thread, where factory() builds the Client.
+
+        Waits up to `wait` seconds for the first connection attempt and
+        returns whether it succeeded; failed attempts keep retrying in the
+        background.
+        """
+        if self._thread is None:
+            self._status = {'state': 'connecting', 'attempts': 0}
+            self._thread = threading.Thread(target=self._run, args=(factory,), name='pyrogram-bot', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        self._attempted.wait(wait)
+        return self.is_connected()
+
+    def _run(self, factory):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.create_task(self._connect(factory))
+        try:
+            self._loop.run_forever()
+        finally:
+            # Let a pending reconnect (or call) unwind before the loop goes away
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._loop.close()
+
+    async def _connect(self, factory):
+        while not self._stopping:
+            self._status['attempts'] += 1
+            try:
+                if self.client is None:
+                    self.client = factory()
+                await self.client.start()
+                self.me = await self.client.get_me()
+            except Exception as e:
+                self._status.update({'state': 'retrying', 'error': str(e)})
+                print(f"❌ Pyrogram connection failed: {e} (retrying in {BOT_RETRY_SECONDS:.0f}s)")
+                if self.client is not None and self.client.is_connected:
+                    try:
+                        await self.client.stop()
+                    except Exception:
+                        pass
+                self._attempted.set()
+                await asyncio.sleep(BOT_RETRY_SECONDS)
+                continue
+
+            self._status = {
+                'state': 'connected',
+                'attempts': self._status['attempts'],
+                'connected_ms': timeutil.now_ms(),
+                'bot_id': self.me.id,
+                'bot_username': self.me.username
+            }
+            with self._hooks_lock:
+                self._connected.set()
+                # Keep references: the loop only holds tasks weakly
+                self._hooks += [self._loop.create_task(callback(self.client)) for callback in self._on_connect]
+            self._attempted.set()
+            print(f"✅ Pyrogram connected successfully: {self.me.first_name} (@{self.me.username})")
+            return
+
+    def submit(self, call, timeout=BOT_CALL_TIMEOUT):
+        """Run a bot call on the loop thread and return its result, waiting up to `timeout` seconds.
+
+        `call` is a coroutine, or a function taking the client and returning
+        one, e.g. submit(lambda client: client.send_message(user_id, text)).
+        Pyrogram methods must be passed the second way: invoked from another
+        thread they would run synchronously instead of returning a coroutine.
+        Raises RuntimeError while the bot is not connected and TimeoutError
+        (after cancelling the call) when it takes too long.
+        """
+        if not self.is_connected():
+            if asyncio.iscoroutine(call):
+                call.close()
+            raise RuntimeError(f"Telegram bot is not connected ({self._status['state']})")
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("submit() called on the bot loop thread; await the call instead")
+
+        self.calls += 1
+        future = asyncio.run_coroutine_threadsafe(self._call(call), self._loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            raise TimeoutError(f"Telegram call timed out after {timeout}s")
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def _call(self, call):
+        if asyncio.iscoroutine(call):
+            return await call
+        return await call(self.client)
+
+    def stop(self, timeout=10):
+        """Disconnect the client and stop the loop thread"""
+        self._stopping = True
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self.is_connected():
+            try:
+                asyncio.run_coroutine_threadsafe(self._call(lambda client: client.stop()), self._loop).result(timeout)
+            except Exception as e:
+                print(f"⚠️ Error stopping Pyrogram client: {e}")
+            self._connected.clear()
+        self._status = {'state': 'stopped'}
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def status(self):
+        return dict(self._status, calls=self.calls, failures=self.failures, timeouts=self.timeouts)
+
+
+# Shared runtime used by api_simple.py
+bot = BotRuntime()
@@ -1,78 +1,281 @@
-import sqlite3
-import datetime
 import os
 
+import db_pool
+import message_cache
+import migrations
+import replicator
+import stats
+import timeutil
+from db_writer import writer, WRITE_TIMEOUT
+
 # Use writable directory for database
 DB_PATH = os.environ.get('DB_PATH', os.path.join(os.getcwd(), 'users.db'))
 DB_NAME = DB_PATH
+# Larger than any rowid: a (ts_ms, MAX_ID) cursor skips everything at ts_ms
+MAX_ID = 2 ** 63 - 1
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    version = migrations.migrate()
+    print(f"🗄️ Database tables created/verified in: {db_pool.DB_NAME} (schema v{version})")
+    migrations.verify_query_plans()
+
+def _upsert_user(conn, user_id, full_name, username, join_date, invite_link, photo_url):
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        username TEXT,
-        join_date TEXT,
-        invite_link TEXT,
-        photo_url TEXT,
-        label TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        sender TEXT,
-        message TEXT,
-        timestamp TEXT
-    )''')
-    conn.commit()
-    conn.close()
-    print(f"🗄️ Database tables created/verified in: {DB_NAME}")
+    join_ts_ms = timeutil.to_ms(join_date)
+    c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, join_ts_ms, invite_link, photo_url) VALUES (?, ?, ?, ?, ?, ?, ?)', 
+              (user_id, full_name, username, join_date, join_ts_ms, invite_link, photo_url))
+    if c.rowcount == 1:
+        stats.record_join(conn, join_ts_ms)
+        replicator.enqueue(conn, 'user', {'user_id': user_id, 'full_name': full_name, 'username': username,
+                                          'join_date': join_date, 'invite_link': invite_link, 'photo_url': photo_url})
+    else:
+        replicator.enqueue(conn, 'user_update', {'user_id': user_id, 'invite_link': invite_link, 'photo_url': photo_url})
+    c.execute('UPDATE users SET invite_link = ?, photo_url = ? WHERE user_id = ?', 
+              (invite_link, photo_url, user_id))
+
+def queue_user(user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+    """Queue a user upsert on the group-commit writer and return its Future"""
+    return writer.submit(_upsert_user, user_id, full_name, username, join_date, invite_link, photo_url)
+
+def _upsert_users(conn, rows):
+    for row in rows:
+        _upsert_user(conn, *row)
+
+def queue_users(rows):
+    """Upsert (user_id, full_name, username, join_date, invite_link, photo_url) rows in one transaction"""
+    return writer.submit(_upsert_users, rows)
 
 def add_user(user_id, full_name, username, join_date, invite_link=None, photo_url=None):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url) VALUES (?, ?, ?, ?, ?, ?)', 
-                  (user_id, full_name, username, join_date, invite_link, photo_url))
-        c.execute('UPDATE users SET invite_link = ?, photo_url = ? WHERE user_id = ?', 
-                  (invite_link, photo_url, user_id))
-        conn.commit()
-        conn.close()
+        queue_user(user_id, full_name, username, join_date, invite_link, photo_url).result(timeout=WRITE_TIMEOUT)
         print(f"✅ User saved: {user_id} - {full_name}")
     except Exception as e:
         print(f"❌ DB error (add_user): {e}")
 
 
 def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
+    return stats.get_stats()['total_users']
 
 def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url FROM users').fetchall()
 
-def save_message(user_id, sender, message, timestamp=None):
+def insert_message(conn, user_id, sender, message, timestamp, ts_ms):
+    """Insert a message and fold it into the user's conversation summary; returns the row id"""
+    message_id = conn.execute('INSERT INTO messages (user_id, sender, message, timestamp, ts_ms) VALUES (?, ?, ?, ?, ?)',
+                              (user_id, sender, message, timestamp, ts_ms)).lastrowid
+    # An admin reply marks the conversation as read
+    conn.execute('''
+        INSERT INTO conversations (user_id, last_message_id, last_message, last_sender, last_ts_ms, message_count, unread_count)
+        VALUES (?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_message = excluded.last_message,
+            last_sender = excluded.last_sender,
+            last_ts_ms = excluded.last_ts_ms,
+            message_count = message_count + 1,
+            unread_count = CASE WHEN excluded.last_sender = 'user' THEN unread_count + 1 ELSE 0 END
+    ''', (user_id, message_id, message, sender, ts_ms or 0, 1 if sender == 'user' else 0))
+    stats.record_message(conn)
+    message_cache.cache.note_write(user_id)
+    replicator.enqueue(conn, 'message', {'message_id': message_id, 'user_id': user_id, 'sender': sender,
+                                         'message': message, 'timestamp': timestamp})
+    return message_id
+
+def queue_message(user_id, sender, message, timestamp=None):
+    """Queue a message insert on the group-commit writer; the Future yields the row id"""
+    ts_ms = timeutil.now_ms() if timestamp is None else timeutil.to_ms(timestamp)
     if timestamp is None:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', (user_id, sender, message, timestamp))
-    conn.commit()
-    conn.close()
+        timestamp = timeutil.format_ms(ts_ms)
+    return writer.submit(insert_message, user_id, sender, message, timestamp, ts_ms)
+
+def _insert_messages(conn, rows):
+    return [insert_message(conn, *row) for row in rows]
+
+def queue_messages(rows):
+    """Insert (user_id, sender, message, timestamp) rows in order in one transaction; the Future yields their ids"""
+    now_ms = timeutil.now_ms()
+    prepared = []
+    for user_id, sender, message, timestamp in rows:
+        ts_ms = now_ms if timestamp is None else timeutil.to_ms(timestamp)
+        prepared.append((user_id, sender, message, timestamp or timeutil.format_ms(ts_ms), ts_ms))
+    return writer.submit(_insert_messages, prepared)
+
+# --- Outbound Telegram deliveries (delivery.py) ---
+
+def insert_delivery(conn, message_id, user_id, text):
+    now_ms = timeutil.now_ms()
+    conn.execute('INSERT INTO deliveries (message_id, user_id, text, created_ms, next_attempt_ms) VALUES (?, ?, ?, ?, ?)',
+                 (message_id, user_id, text, now_ms, now_ms))
+
+def set_delivery_status(conn, message_id, user_id, status, error=None):
+    conn.execute('UPDATE messages SET delivery_status = ?, delivery_error = ? WHERE id = ?', (status, error, message_id))
+    message_cache.cache.note_write(user_id)
+    replicator.enqueue(conn, 'message_update', {'message_id': message_id, 'delivery_status': status,
+                                                'delivery_error': error})
+
+def _insert_outbound_message(conn, user_id, message, timestamp, ts_ms):
+    message_id = insert_message(conn, user_id, 'admin', message, timestamp, ts_ms)
+    set_delivery_status(conn, message_id, user_id, 'queued')
+    insert_delivery(conn, message_id, user_id, message)
+    return message_id
+
+def queue_outbound_message(user_id, message, timestamp=None):
+    """Queue an admin message and its Telegram delivery in one transaction; the Future yields the row id"""
+    ts_ms = timeutil.now_ms() if timestamp is None else timeutil.to_ms(timestamp)
+    if timestamp is None:
+        timestamp = timeutil.format_ms(ts_ms)
+    return writer.submit(_insert_outbound_message, user_id, message, timestamp, ts_ms)
+
+def queue_delivery(message_id, user_id, text):
+    """Queue a Telegram delivery for a message stored elsewhere (non-SQLite backends)"""
+    return writer.submit(insert_delivery, message_id, user_id, text)
+
+def _finish_delivery(conn, delivery_id, message_id, user_id, status, error, retry_at_ms):
+    if retry_at_ms is None:
+        conn.execute('DELETE FROM deliveries WHERE id = ?', (delivery_id,))
+    else:
+        conn.execute('UPDATE deliveries SET attempts = attempts + 1, last_error = ?, next_attempt_ms = ? WHERE id = ?',
+                     (error, retry_at_ms, delivery_id))
+    if message_id is not None:
+        set_delivery_status(conn, message_id, user_id, status, error)
+
+def queue_delivery_result(delivery_id, message_id, user_id, status, error=None, retry_at_ms=None):
+    """Record an attempt: drop the delivery (sent or given up) or reschedule it, and set the
+    message's status and error (pass message_id=None when the storage backend holds the message)"""
+    return writer.submit(_finish_delivery, delivery_id, message_id, user_id, status, error, retry_at_ms)
+
+def due_deliveries(now_ms, limit=100):
+    """Deliveries whose next attempt is due: (id, message_id, user_id, text, attempts)"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT id, message_id, user_id, text, attempts FROM deliveries WHERE next_attempt_ms <= ? '
+                            'ORDER BY next_attempt_ms, id LIMIT ?', (now_ms, limit)).fetchall()
+
+def delivery_backlog():
+    """(pending, retrying, oldest created_ms) for /health"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0), MIN(created_ms) FROM deliveries').fetchone()
+
+# --- Bulk loads from Firestore (hydrator.py); these skip the outbox ---
+
+def reserve_message_ids(conn, above):
+    """Make new local message ids start after `above` so they can't reuse a Firestore id"""
+    if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (above,)).rowcount == 0:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (above,))
+
+def insert_hydrated_users(conn, rows):
+    """Insert (user_id, full_name, username, join_date, invite_link, photo_url, label) rows not present locally"""
+    conn.executemany('''
+        INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, join_ts_ms, invite_link, photo_url, label)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(user_id, full_name, username, join_date, timeutil.to_ms(join_date), invite_link, photo_url, label)
+          for user_id, full_name, username, join_date, invite_link, photo_url, label in rows])
+
+def insert_hydrated_messages(conn, rows):
+    """Insert (message_id, user_id, sender, message, timestamp, ts_ms) rows, keeping Firestore's ids"""
+    conn.executemany('''
+        INSERT OR IGNORE INTO messages (id, user_id, sender, message, timestamp, ts_ms) VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(message_id, user_id, sender, message, timestamp, ts_ms if ts_ms is not None else timeutil.to_ms(timestamp))
+          for message_id, user_id, sender, message, timestamp, ts_ms in rows])
+
+def rebuild_summaries(conn):
+    """Recompute conversations and stats rollups from the base tables after a bulk load"""
+    conn.execute('DELETE FROM conversations')
+    conn.execute('''
+        INSERT INTO conversations (user_id, last_message_id, message_count)
+        SELECT user_id, MAX(id), COUNT(*) FROM messages WHERE user_id IS NOT NULL GROUP BY user_id
+    ''')
+    conn.execute('''
+        UPDATE conversations SET (last_message, last_sender, last_ts_ms) = (
+            SELECT message, sender, COALESCE(ts_ms, 0) FROM messages WHERE id = conversations.last_message_id
+        )
+    ''')
+    conn.execute('''
+        UPDATE conversations SET unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.user_id = conversations.user_id AND m.sender = 'user'
+              AND m.id > COALESCE((SELECT MAX(id) FROM messages a
+                                   WHERE a.user_id = conversations.user_id AND a.sender = 'admin'), 0)
+        )
+    ''')
+    stats.rebuild(conn)
+
+def _set_label(conn, user_id, label):
+    conn.execute('UPDATE users SET label = ? WHERE user_id = ?', (label, user_id))
+    replicator.enqueue(conn, 'user_update', {'user_id': user_id, 'label': label})
+
+def set_user_label(user_id, label):
+    """Update a user's label (and queue it for Firestore) in one transaction"""
+    return writer.submit(_set_label, user_id, label).result(timeout=WRITE_TIMEOUT)
+
+def _mark_read(conn, user_id):
+    conn.execute('UPDATE conversations SET unread_count = 0 WHERE user_id = ?', (user_id,))
+
+def mark_conversation_read(user_id):
+    """Reset the admin unread counter for a conversation"""
+    return writer.submit(_mark_read, user_id).result(timeout=WRITE_TIMEOUT)
+
+def save_message(user_id, sender, message, timestamp=None):
+    return queue_message(user_id, sender, message, timestamp).result(timeout=WRITE_TIMEOUT)
+
+def get_message_page(user_id, limit=100, before_id=None, after_id=None):
+    """Keyset page of a user's messages, newest first.
+
+    With after_id the page holds the oldest messages newer than after_id;
+    otherwise the newest messages older than before_id (or the latest ones).
+    Returns (rows, has_more) with rows as (id, sender, message, timestamp,
+    delivery_status, delivery_error); both delivery fields are None except
+    on admin messages sent to Telegram.
+    """
+    sql = ('SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+           'WHERE user_id = ?')
+    params = [user_id]
+    if before_id is not None:
+        sql += ' AND id < ?'
+        params.append(before_id)
+    if after_id is not None:
+        sql += ' AND id > ?'
+        params.append(after_id)
+    sql += ' ORDER BY id ASC LIMIT ?' if after_id is not None else ' ORDER BY id DESC LIMIT ?'
+    params.append(limit + 1)
+
+    with db_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is not None:
+        rows.reverse()
+    return [(message_id, sender, message, timeutil.format_ms(ts_ms, timestamp), status, error)
+            for message_id, sender, message, ts_ms, timestamp, status, error in rows], has_more
 
 def get_messages_for_user(user_id, limit=100):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-    messages = c.fetchall()
-    conn.close()
-    return messages 
+    """Latest `limit` messages for a user in chronological order"""
+    rows, _has_more = get_message_page(user_id, limit)
+    return [(sender, message, timestamp) for _id, sender, message, timestamp, _status, _error in reversed(rows)]
+
+def get_messages_since(user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+    """Messages newer than a client's high-water mark, oldest first.
+
+    since_id is exact and wins when both are given; since_ts (epoch ms) is for
+    clients that only remember a time. The ts path pages on (ts_ms, id):
+    since_ts_id is the id of the last message already seen at since_ts, so
+    a page that ends inside a run of equal timestamps resumes inside it
+    (without it, everything at since_ts is skipped). Returns (rows, has_more)
+    with rows as (id, sender, message, timestamp, ts_ms, delivery_status, delivery_error).
+    """
+    if since_id is not None:
+        sql = ('SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+               'WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?')
+        params = (user_id, since_id, limit + 1)
+    else:
+        sql = ('SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+               'WHERE user_id = ? AND (ts_ms, id) > (?, ?) ORDER BY ts_ms ASC, id ASC LIMIT ?')
+        params = (user_id, since_ts or 0, MAX_ID if since_ts_id is None else since_ts_id, limit + 1)
+
+    with db_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    has_more = len(rows) > limit
+    return [(message_id, sender, message, timeutil.format_ms(ts_ms, timestamp), ts_ms, status, error)
+            for message_id, sender, message, ts_ms, timestamp, status, error in rows[:limit]], has_more
@@ -0,0 +1,187 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default location matches db.py / api_simple.py until configure() is called
+DB_NAME = os.environ.get('DB_PATH', os.path.join(os.getcwd(), 'users.db'))
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+CHECKOUT_TIMEOUT = 30
+
+# Applied once per physical connection, not per query
+PRAGMAS = (
+    ('busy_timeout', 5000),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -8000),
+)
+
+_lock = threading.Lock()
+_local = threading.local()
+_idle = queue.LifoQueue()
+_created = 0
+_max_size = POOL_SIZE
+_generation = 0
+
+
+def is_memory_db(db_name=None):
+    """Check whether the configured database lives in memory"""
+    return (db_name or DB_NAME) == ':memory:'
+
+
+def configure(db_name, pool_size=None):
+    """Point the pool at a database file (or ':memory:') and drop old connections"""
+    global DB_NAME, _max_size, _generation
+    with _lock:
+        DB_NAME = db_name
+        # A ':memory:' database only exists inside the connection that created
+        # it, so every thread has to share that single connection.
+        _max_size = 1 if is_memory_db(db_name) else (pool_size or POOL_SIZE)
+        _generation += 1
+    _drain_idle()
+    if not is_memory_db(db_name):
+        enable_wal()
+    print(f"🗄️ Connection pool configured: {DB_NAME} (max {_max_size} connections)")
+
+
+def enable_wal():
+    """Switch the database file to WAL so readers never block the writer"""
+    try:
+        with connection() as conn:
+            mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if mode.lower() != 'wal':
+            print(f"⚠️ WAL not supported here, journal mode is: {mode}")
+        return mode
+    except Exception as e:
+        print(f"⚠️ Could not enable WAL: {e}")
+        return None
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection tagged with the pool configuration it belongs to"""
+    pool_generation = None
+
+
+def _open_connection():
+    """Open a new connection and apply the configured pragmas"""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, timeout=CHECKOUT_TIMEOUT,
+                           factory=PooledConnection)
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    conn.pool_generation = _generation
+    return conn
+
+
+def _drain_idle():
+    """Close every idle connection left over from a previous configuration"""
+    global _created
+    while True:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            return
+        with _lock:
+            _created -= 1
+        conn.close()
+
+
+def _checkout():
+    """Take an idle connection from the pool, opening one if there is room"""
+    global _created
+    while True:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            with _lock:
+                if _created < _max_size:
+                    _created += 1
+                    try:
+                        return _open_connection()
+                    except Exception:
+                        _created -= 1
+                        raise
+            conn = _idle.get(timeout=CHECKOUT_TIMEOUT)
+
+        if conn.pool_generation == _generation:
+            return conn
+        # Stale connection from before the last configure()
+        with _lock:
+            _created -= 1
+        conn.close()
+
+
+def _checkin(conn):
+    """Return a connection to the pool"""
+    global _created
+    if conn.pool_generation != _generation:
+        with _lock:
+            _created -= 1
+        conn.close()
+        return
+    _idle.put(conn)
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection for the current thread.
+
+    Nested calls on the same thread reuse the outer connection. The outermost
+    block commits on success and rolls back on error.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = _checkout()
+    _local.conn = conn
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        _local.conn = None
+        _checkin(conn)
+
+
+def backup_to(path):
+    """Copy the live database to path with SQLite's online backup API (WAL-safe)"""
+    dest = sqlite3.connect(path)
+    try:
+        with connection() as conn:
+            conn.backup(dest)
+    finally:
+        dest.close()
+
+
+def restore_from(path):
+    """Load a backup file into the live database in place"""
+    src = sqlite3.connect(path)
+    try:
+        with connection() as conn:
+            src.backup(conn)
+    finally:
+        src.close()
+
+
+def close_all():
+    """Close every idle connection (used on shutdown and reconfiguration)"""
+    global _generation
+    with _lock:
+        _generation += 1
+    _drain_idle()
+
+
+def pool_status():
+    """Return a snapshot of pool usage for health endpoints"""
+    return {
+        'database': DB_NAME,
+        'max_connections': _max_size,
+        'open_connections': _created,
+        'idle_connections': _idle.qsize()
+    }
@@ -0,0 +1,158 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import db_pool
+
+# Group-commit tuning: how long the writer keeps collecting after the first
+# queued write, and the most writes it will fold into one transaction.
+BATCH_WINDOW = float(os.environ.get('DB_BATCH_WINDOW_MS', 5)) / 1000
+MAX_BATCH = int(os.environ.get('DB_MAX_BATCH', 500))
+WRITE_TIMEOUT = 30
+
+_STOP = object()
+
+
+class WriteQueue:
+    """Single writer thread that batches queued writes into one transaction"""
+
+    def __init__(self, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self._commit_listeners = []
+
+    def start(self):
+        """Start the writer thread if it is not running yet"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(conn, *args, **kwargs) for the writer and return a Future.
+
+        The future resolves with fn's return value once the batch holding it
+        has been committed. Do not wait on it while holding a pooled
+        connection: with ':memory:' the writer needs that same connection.
+        """
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Nested write from inside a batch: run it in the open transaction
+            with db_pool.connection() as conn:
+                future.set_result(fn(conn, *args, **kwargs))
+            return future
+        self.start()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def execute(self, sql, params=()):
+        """Queue a single statement; the future resolves with its lastrowid"""
+        return self.submit(_execute, sql, params)
+
+    def on_commit(self, callback):
+        """Call callback() on the writer thread after every committed batch"""
+        self._commit_listeners.append(callback)
+
+    def flush(self, timeout=WRITE_TIMEOUT):
+        """Block until everything queued so far has been committed"""
+        if self._thread and self._thread.is_alive():
+            self.submit(_noop).result(timeout=timeout)
+
+    def stop(self, timeout=WRITE_TIMEOUT):
+        """Commit outstanding writes and stop the writer thread"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _collect(self):
+        """Wait for one write, then gather more until the window closes"""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if batch:
+                self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        """Run every queued write in one transaction, isolating failures with savepoints"""
+        results = []
+        try:
+            with db_pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute('SAVEPOINT queued_write')
+                    try:
+                        results.append((future, fn(conn, *args, **kwargs), None))
+                        conn.execute('RELEASE queued_write')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO queued_write')
+                        conn.execute('RELEASE queued_write')
+                        results.append((future, None, e))
+        except Exception as e:
+            print(f"❌ Write batch of {len(batch)} failed: {e}")
+            for future, _fn, _args, _kwargs in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.writes += len(results)
+        for callback in self._commit_listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f"❌ Commit listener failed: {e}")
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def status(self):
+        """Return queue depth and batching counters"""
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'writes': self.writes,
+            'avg_batch_size': round(self.writes / self.batches, 2) if self.batches else 0
+        }
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+
+def _noop(conn):
+    return None
+
+
+# Shared writer used by db.py and api_simple.py
+writer = WriteQueue()
+atexit.register(writer.stop)
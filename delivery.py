@@ -0,0 +1,171 @@
+"""
+Outbound Telegram delivery of admin messages.
+
+An admin message is stored with delivery_status 'queued' together with a
+row in the deliveries table (Storage.queue_outbound_message; one
+transaction on SQLite), so HTTP handlers return as soon as that commits.
+DeliveryQueue workers on the bot's event loop pick up due deliveries,
+send them through the Telegram scheduler and record the outcome:
+
+    sent      delivered; the delivery row is dropped
+    retrying  rescheduled with exponential backoff
+    failed    permanent error, or DELIVERY_MAX_ATTEMPTS used up
+
+Each change is written to messages.delivery_status (the last error, if
+any, to messages.delivery_error, so it outlives the dropped delivery row)
+and announced with a Socket.IO 'delivery_status' event. Pages and delta
+sync return both fields. Pending rows survive restarts.
+"""
+
+import asyncio
+import os
+
+from pyrogram.errors import (
+    InputUserDeactivated, MessageEmpty, MessageTooLong, PeerIdInvalid, UserDeactivated, UserIsBlocked, UserIsBot
+)
+
+import db
+import storage
+import timeutil
+from db_writer import WRITE_TIMEOUT
+from telegram_scheduler import scheduler as default_scheduler, PRIORITY_REPLY
+
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 8))
+# Due deliveries read per query, and how often to look for retries that came due
+DELIVERY_BATCH = int(os.environ.get('DELIVERY_BATCH', 100))
+DELIVERY_POLL_SECONDS = float(os.environ.get('DELIVERY_POLL_SECONDS', 5))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get('DELIVERY_MAX_ATTEMPTS', 5))
+DELIVERY_MAX_BACKOFF = 300
+
+# Errors no retry can fix
+PERMANENT_ERRORS = (InputUserDeactivated, MessageEmpty, MessageTooLong, PeerIdInvalid,
+                    UserDeactivated, UserIsBlocked, UserIsBot)
+
+
+class DeliveryQueue:
+    """Sends queued admin messages to Telegram from the bot's event loop.
+
+    `emit(event)` is called with {'message_id', 'user_id', 'status', 'error'}
+    on every status change; `backend` defaults to storage.backend.
+    """
+
+    def __init__(self, emit=None, workers=DELIVERY_WORKERS, max_attempts=DELIVERY_MAX_ATTEMPTS,
+                 scheduler=default_scheduler, backend=None):
+        self.emit = emit
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.scheduler = scheduler
+        self.backend = backend
+        self._client = None
+        self._loop = None
+        self._wake = None
+        self._tasks = []
+        self._inflight = set()
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def _backend(self):
+        return self.backend or storage.backend
+
+    def send(self, user_id, text):
+        """Store an admin message and queue it for Telegram; returns the message id once committed"""
+        message_id = self._backend().queue_outbound_message(user_id, text).result(timeout=WRITE_TIMEOUT)
+        self._emit(message_id, user_id, 'queued')
+        self.notify()
+        return message_id
+
+    def notify(self):
+        """Wake the workers (safe from any thread)"""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake.set)
+
+    async def run(self, client):
+        """Deliver until cancelled (bot_runtime on_connect hook)"""
+        self._client = client
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        jobs = asyncio.Queue(maxsize=self.workers * 2)
+        self._tasks = [asyncio.create_task(self._worker(jobs)) for _ in range(self.workers)]
+        try:
+            while True:
+                self._wake.clear()
+                try:
+                    due = await asyncio.to_thread(db.due_deliveries, timeutil.now_ms(), DELIVERY_BATCH)
+                except Exception as e:
+                    print(f"❌ Could not read due deliveries: {e}")
+                    due = []
+                fresh = [delivery for delivery in due if delivery[0] not in self._inflight]
+                for delivery in fresh:
+                    self._inflight.add(delivery[0])
+                    await jobs.put(delivery)
+                if len(due) == DELIVERY_BATCH:
+                    # More may be due: go again once this batch is under way
+                    if not fresh:
+                        await jobs.join()
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), DELIVERY_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    async def _worker(self, jobs):
+        while True:
+            delivery = await jobs.get()
+            try:
+                await self._deliver(delivery)
+            except Exception as e:
+                print(f"❌ Could not record delivery {delivery[0]}: {e}")
+            finally:
+                self._inflight.discard(delivery[0])
+                jobs.task_done()
+
+    async def _deliver(self, delivery):
+        delivery_id, message_id, user_id, text, attempts = delivery
+        error = retry_at_ms = None
+        try:
+            await self.scheduler.call(lambda: self._client.send_message(user_id, text),
+                                      chat_id=user_id, priority=PRIORITY_REPLY)
+            status = 'sent'
+            self.sent += 1
+        except PERMANENT_ERRORS as e:
+            status, error = 'failed', str(e)
+        except Exception as e:
+            error = str(e)
+            if attempts + 1 >= self.max_attempts:
+                status = 'failed'
+            else:
+                status = 'retrying'
+                retry_at_ms = timeutil.now_ms() + min(2 ** attempts, DELIVERY_MAX_BACKOFF) * 1000
+                self.retries += 1
+        if status == 'failed':
+            self.failed += 1
+            print(f"❌ Telegram delivery of message {message_id} to {user_id} failed: {error}")
+
+        await asyncio.to_thread(self._backend().record_delivery, delivery, status, error, retry_at_ms)
+        self._emit(message_id, user_id, status, error)
+
+    def _emit(self, message_id, user_id, status, error=None):
+        if self.emit is None:
+            return
+        try:
+            self.emit({'message_id': message_id, 'user_id': user_id, 'status': status, 'error': error})
+        except Exception as e:
+            print(f"⚠️ Could not emit delivery status: {e}")
+
+    def status(self):
+        pending, retrying, oldest_ms = db.delivery_backlog()
+        return {
+            'running': bool(self._tasks),
+            'pending': pending,
+            'retrying': retrying,
+            'lag_ms': timeutil.now_ms() - oldest_ms if oldest_ms else 0,
+            'in_flight': len(self._inflight),
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed
+        }
@@ -0,0 +1,616 @@
+"""
+In-process stand-ins for the parts of Firestore and the Realtime Database this app uses.
+
+Counts document reads/writes the way Firestore bills them (a count()
+aggregation costs one read per 1000 matched entries, minimum one), so
+benchmarks can compare query strategies without a project or emulator.
+
+    client = FakeFirestore()
+    firebase_config.use_firestore_client(client)
+
+or, for both databases with simulated network round trips:
+
+    firestore_client, rtdb = fake_firebase.install(latency_ms=20)
+
+Every call that would be a network round trip (a document get/set, a
+query stream, a batch commit, an aggregation, a Realtime DB read or
+write) sleeps for the configured latency (plus random jitter) and is
+counted in `rpcs`. Queries support on_snapshot(); listeners are called on
+the writing thread, with only the changed document in the snapshot list.
+"""
+
+import datetime
+import heapq
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1.transforms import Increment, Maximum
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+# Default injected round-trip time, e.g. FAKE_FIREBASE_LATENCY_MS=20 for a nearby region
+LATENCY_MS = float(os.environ.get('FAKE_FIREBASE_LATENCY_MS', 0))
+JITTER_MS = float(os.environ.get('FAKE_FIREBASE_JITTER_MS', 0))
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+}
+
+
+class _Latency:
+    """Injected network latency and a round-trip counter"""
+
+    def __init__(self, latency_ms=None, jitter_ms=None):
+        self.latency_ms = LATENCY_MS if latency_ms is None else latency_ms
+        self.jitter_ms = JITTER_MS if jitter_ms is None else jitter_ms
+        self.rpcs = 0
+
+    def _delay(self):
+        return (self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+    def _rpc(self):
+        """Account for one round trip"""
+        self.rpcs += 1
+        delay = self._delay()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeFirestore(_Latency):
+    """Dict-backed Firestore client with read/write counters"""
+
+    def __init__(self, latency_ms=None, jitter_ms=None):
+        super().__init__(latency_ms, jitter_ms)
+        self._docs = {}  # collection path -> {doc id: data}
+        self._lock = threading.RLock()
+        self._watches = []
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def reset_counters(self):
+        self.reads = 0
+        self.writes = 0
+        self.rpcs = 0
+
+    def counters(self):
+        return {'reads': self.reads, 'writes': self.writes, 'rpcs': self.rpcs}
+
+    # --- storage helpers used by the reference classes ---
+
+    def _read(self, path, doc_id):
+        with self._lock:
+            self.reads += 1
+            data = self._docs.get(path, {}).get(doc_id)
+            return dict(data) if data is not None else None
+
+    def _write(self, path, doc_id, data, merge=False, must_exist=False, must_not_exist=False):
+        with self._lock:
+            docs = self._docs.setdefault(path, {})
+            current = docs.get(doc_id)
+            if must_not_exist and current is not None:
+                raise AlreadyExists(f'Document already exists: {path}/{doc_id}')
+            if must_exist and current is None:
+                raise NotFound(f'No document to update: {path}/{doc_id}')
+            base = dict(current) if (merge and current is not None) else {}
+            for key, value in data.items():
+                base[key] = _resolve(value, base.get(key))
+            docs[doc_id] = base
+            self.writes += 1
+            self._notify(path, doc_id, current, base)
+
+    def _delete(self, path, doc_id):
+        with self._lock:
+            current = self._docs.get(path, {}).pop(doc_id, None)
+            self.writes += 1
+            if current is not None:
+                self._notify(path, doc_id, current, None)
+
+    def _notify(self, path, doc_id, before, after):
+        for watch in list(self._watches):
+            watch._on_write(path, doc_id, before, after)
+
+    def _scan(self, path):
+        with self._lock:
+            return [(doc_id, dict(data)) for doc_id, data in self._docs.get(path, {}).items()]
+
+
+def _resolve(value, current):
+    """Apply server-side transforms the way Firestore does on write"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, Increment):
+        return (current or 0) + value.value
+    if isinstance(value, Maximum):
+        return value.value if current is None else max(current, value.value)
+    return value
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, client, path, doc_id):
+        self._client = client
+        self._path = path
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f'{self._path}/{self.id}'
+
+    def collection(self, name):
+        return FakeCollection(self._client, f'{self.path}/{name}')
+
+    def get(self):
+        self._client._rpc()
+        return FakeSnapshot(self, self._client._read(self._path, self.id))
+
+    def set(self, data, merge=False):
+        self._client._rpc()
+        self._client._write(self._path, self.id, data, merge=merge)
+
+    def create(self, data):
+        self._client._rpc()
+        self._client._write(self._path, self.id, data, must_not_exist=True)
+
+    def update(self, data):
+        self._client._rpc()
+        self._client._write(self._path, self.id, data, merge=True, must_exist=True)
+
+    def delete(self):
+        self._client._rpc()
+        self._client._delete(self._path, self.id)
+
+
+class FakeAggregation:
+    def __init__(self, query, alias=None):
+        self._query = query
+        self._alias = alias or 'count'
+
+    def get(self):
+        self._query._client._rpc()
+        matched = len(self._query._matches())
+        # Billed as one read per batch of up to 1000 index entries
+        self._query._client.reads += max(1, math.ceil(matched / 1000))
+        return [[_AggregationResult(self._alias, matched)]]
+
+
+class _AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeQuery:
+    def __init__(self, client, path, filters=(), orders=(), limit=None, fields=None, cursor=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._fields = fields
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit, 'fields': self._fields,
+                 'cursor': self._cursor}
+        state.update(changes)
+        return FakeQuery(self._client, self._path, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, document_fields):
+        """Only the dict form: values for the order_by fields"""
+        return self._copy(cursor=dict(document_fields))
+
+    def _past_cursor(self, data):
+        for field, direction in self._orders:
+            value, cursor = data[field], self._cursor[field]
+            if value != cursor:
+                return (value > cursor) != (direction == firestore.Query.DESCENDING)
+        return False
+
+    def count(self, alias=None):
+        return FakeAggregation(self, alias)
+
+    def on_snapshot(self, callback):
+        return FakeWatch(self, callback)
+
+    def _accepts(self, data):
+        return all(field in data and _OPERATORS[op](data[field], value) for field, op, value in self._filters)
+
+    def _matches(self):
+        rows = [(doc_id, data) for doc_id, data in self._client._scan(self._path) if self._accepts(data)]
+        for field, direction in reversed(self._orders):
+            rows = [r for r in rows if field in r[1]]
+            rows.sort(key=lambda r: r[1][field], reverse=direction == firestore.Query.DESCENDING)
+        if self._cursor is not None:
+            rows = [r for r in rows if self._past_cursor(r[1])]
+        return rows
+
+    def stream(self):
+        self._client._rpc()
+        rows = self._matches()
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            self._client.reads += 1
+            if self._fields is not None:
+                data = {f: data[f] for f in self._fields if f in data}
+            yield FakeSnapshot(FakeDocument(self._client, self._path, doc_id), data)
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeWatch:
+    """Snapshot listener: one initial snapshot, then one call per matching write"""
+
+    def __init__(self, query, callback):
+        self._query = query
+        self._callback = callback
+        client = query._client
+        with client._lock:
+            client._watches.append(self)
+            docs = query.get()
+        changes = [DocumentChange(ChangeType.ADDED, doc, -1, i) for i, doc in enumerate(docs)]
+        callback(docs, changes, datetime.datetime.now(datetime.timezone.utc))
+
+    def _on_write(self, path, doc_id, before, after):
+        if path != self._query._path:
+            return
+        was = before is not None and self._query._accepts(before)
+        now = after is not None and self._query._accepts(after)
+        if not (was or now):
+            return
+        change_type = ChangeType.MODIFIED if was and now else ChangeType.ADDED if now else ChangeType.REMOVED
+        client = self._query._client
+        client.reads += 1
+        doc = FakeSnapshot(FakeDocument(client, path, doc_id), dict(after if now else before))
+        self._callback([doc], [DocumentChange(change_type, doc, -1, -1)], datetime.datetime.now(datetime.timezone.utc))
+
+    def unsubscribe(self):
+        with self._query._client._lock:
+            if self in self._query._client._watches:
+                self._query._client._watches.remove(self)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._client, self._path, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.datetime.now(datetime.timezone.utc), ref
+
+
+class FakeBatch:
+    """Atomic write batch: all operations apply together or not at all"""
+
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(('set', ref, data, merge))
+
+    def create(self, ref, data):
+        self._ops.append(('create', ref, data, False))
+
+    def update(self, ref, data):
+        self._ops.append(('update', ref, data, True))
+
+    def delete(self, ref):
+        self._ops.append(('delete', ref, None, False))
+
+    def commit(self):
+        client = self._client
+        client._rpc()
+        with client._lock:
+            # Validate preconditions first so a failing batch writes nothing
+            for kind, ref, _data, _merge in self._ops:
+                exists = ref.id in client._docs.get(ref._path, {})
+                if kind == 'create' and exists:
+                    raise AlreadyExists(f'Document already exists: {ref.path}')
+                if kind == 'update' and not exists:
+                    raise NotFound(f'No document to update: {ref.path}')
+            for kind, ref, data, merge in self._ops:
+                if kind == 'delete':
+                    client._delete(ref._path, ref.id)
+                else:
+                    client._write(ref._path, ref.id, data, merge=merge)
+        results = list(self._ops)
+        self._ops = []
+        return results
+
+
+class FakeRealtimeDB(_Latency):
+    """Dict-backed Realtime Database with a byte counter.
+
+    `bytes_downloaded` adds up the JSON size of every get(), which is what
+    the real service bills and sends over the wire.
+
+        rtdb = FakeRealtimeDB()
+        firebase_config.use_realtime_db(rtdb.reference())
+    """
+
+    def __init__(self, latency_ms=None, jitter_ms=None):
+        super().__init__(latency_ms, jitter_ms)
+        self._root = {}
+        self._lock = threading.RLock()
+        self._push_seq = 0
+        self.reads = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+
+    def reference(self, path='/'):
+        return FakeReference(self, _rtdb_path(path))
+
+    def reset_counters(self):
+        self.reads = 0
+        self.rpcs = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+
+    def counters(self):
+        return {'reads': self.reads, 'rpcs': self.rpcs,
+                'bytes_downloaded': self.bytes_downloaded, 'bytes_uploaded': self.bytes_uploaded}
+
+    def _node(self, parts):
+        node = self._root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _download(self, value):
+        self.reads += 1
+        self.bytes_downloaded += len(json.dumps(value)) if value is not None else 4
+        return value
+
+    def _set(self, parts, value):
+        """Write (or with None, delete) one location, pruning emptied parents"""
+        if not parts:
+            self._root = _rtdb_copy(value) if isinstance(value, dict) else {}
+            return
+        trail = [self._root]
+        for part in parts[:-1]:
+            node = trail[-1]
+            if value is None and not isinstance(node.get(part), dict):
+                return
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            trail.append(node[part])
+        if value is None:
+            trail[-1].pop(parts[-1], None)
+            for node, part in zip(reversed(trail[:-1]), reversed(parts[:-1])):
+                if node[part]:
+                    break
+                del node[part]
+        else:
+            trail[-1][parts[-1]] = _rtdb_copy(value)
+
+    def _next_push_id(self):
+        # Push ids sort in creation order, like Firebase's
+        with self._lock:
+            self._push_seq += 1
+            return '-%011x%08x' % (int(time.time() * 1000), self._push_seq)
+
+
+def _rtdb_path(path):
+    return tuple(part for part in str(path).split('/') if part)
+
+
+def _rtdb_copy(value):
+    # Values cross the wire as JSON
+    return json.loads(json.dumps(value))
+
+
+def _rtdb_key_order(key):
+    # Integer-like keys sort numerically before all other keys
+    if not key.lstrip('-').isdigit():
+        return (1, 0, key)
+    try:
+        value = int(key)
+        if -2 ** 31 <= value < 2 ** 31 and str(value) == key:
+            return (0, value, '')
+    except ValueError:
+        pass
+    return (1, 0, key)
+
+
+def _rtdb_value_order(value):
+    if value is None:
+        return (0, 0, '')
+    if isinstance(value, bool):
+        return (1, int(value), '')
+    if isinstance(value, (int, float)):
+        return (2, value, '')
+    if isinstance(value, str):
+        return (3, 0, value)
+    return (4, 0, '')
+
+
+class FakeReference:
+    def __init__(self, rtdb, parts):
+        self._rtdb = rtdb
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self._parts)
+
+    def child(self, path):
+        return FakeReference(self._rtdb, self._parts + _rtdb_path(path))
+
+    def get(self):
+        self._rtdb._rpc()
+        with self._rtdb._lock:
+            return self._rtdb._download(_rtdb_copy(self._rtdb._node(self._parts)))
+
+    def set(self, value):
+        self._rtdb._rpc()
+        with self._rtdb._lock:
+            self._rtdb.bytes_uploaded += len(json.dumps(value))
+            self._rtdb._set(self._parts, value)
+
+    def update(self, value):
+        """Multi-location update: keys may be relative paths, None deletes"""
+        self._rtdb._rpc()
+        with self._rtdb._lock:
+            self._rtdb.bytes_uploaded += len(json.dumps(value))
+            for path, item in value.items():
+                self._rtdb._set(self._parts + _rtdb_path(path), item)
+
+    def push(self, value=''):
+        ref = self.child(self._rtdb._next_push_id())
+        ref.set(value)
+        return ref
+
+    def delete(self):
+        self._rtdb._rpc()
+        with self._rtdb._lock:
+            self._rtdb._set(self._parts, None)
+
+    def order_by_key(self):
+        return FakeRealtimeQuery(self, None)
+
+    def order_by_child(self, path):
+        return FakeRealtimeQuery(self, path)
+
+
+class FakeRealtimeQuery:
+    """Ordered, limited read of a reference's children (filtered server-side)"""
+
+    def __init__(self, reference, child_path):
+        self._reference = reference
+        self._child = child_path
+        self._start = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, value):
+        self._start = value
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, count):
+        self._first = count
+        return self
+
+    def limit_to_last(self, count):
+        self._last = count
+        return self
+
+    def _sort_key(self, item):
+        key, value = item
+        if self._child is None:
+            return _rtdb_key_order(key)
+        field = value.get(self._child) if isinstance(value, dict) else None
+        return _rtdb_value_order(field) + _rtdb_key_order(key)
+
+    def _bound(self, item):
+        key, value = item
+        if self._child is None:
+            return _rtdb_key_order(key)
+        return _rtdb_value_order(value.get(self._child) if isinstance(value, dict) else None)
+
+    def get(self):
+        rtdb = self._reference._rtdb
+        rtdb._rpc()
+        with rtdb._lock:
+            node = rtdb._node(self._reference._parts)
+            items = list(node.items()) if isinstance(node, dict) else []
+            if self._first is not None and self._start is None and self._end is None:
+                items = heapq.nsmallest(self._first, items, key=self._sort_key)
+            else:
+                items.sort(key=self._sort_key)
+            order = _rtdb_key_order if self._child is None else _rtdb_value_order
+            if self._start is not None:
+                items = [i for i in items if self._bound(i) >= order(self._start)]
+            if self._end is not None:
+                items = [i for i in items if self._bound(i) <= order(self._end)]
+            if self._first is not None:
+                items = items[:self._first]
+            if self._last is not None:
+                items = items[-self._last:] if self._last else []
+            return rtdb._download(OrderedDict((key, _rtdb_copy(value)) for key, value in items))
+
+
+def install(latency_ms=None, jitter_ms=None):
+    """Point firebase_config (Firestore client, Realtime DB) at fresh fakes"""
+    import firebase_config
+
+    client = FakeFirestore(latency_ms, jitter_ms)
+    rtdb = FakeRealtimeDB(latency_ms, jitter_ms)
+    firebase_config.use_firestore_client(client)
+    firebase_config.use_realtime_db(rtdb.reference())
+    return client, rtdb
+
+
+def uninstall():
+    import firebase_config
+
+    firebase_config.use_firestore_client(None)
+    firebase_config.use_realtime_db(None)
@@ -3,6 +3,17 @@ from firebase_admin import credentials, firestore, db
 import os
 import datetime
 import json
+import threading
+import time
+
+from google.api_core.exceptions import AlreadyExists
+
+import firestore_dao
+import timeutil
+from firestore_dao import COUNTER_SHARDS, user_document, message_document
+
+# Statistics: how long counts are cached locally
+COUNT_CACHE_TTL = float(os.environ.get('FIRESTORE_COUNT_CACHE_SECONDS', 30))
 
 # Firebase configuration - Load from JSON file
 def load_firebase_config():
@@ -62,18 +73,34 @@ def initialize_firebase():
         print(f"❌ Firebase initialization failed: {e}")
         return False
 
+# Clients live in firestore_dao.py; one shared instance per process
+def use_firestore_client(client):
+    """Route every Firestore call to `client` (None restores the real one)"""
+    firestore_dao.use_client(client)
+    invalidate_count_cache()
+
 # Get Firestore database
 def get_firestore():
     """Get Firestore database instance"""
     try:
-        return firestore.client()
+        return firestore_dao.get_client()
     except Exception as e:
         print(f"❌ Error getting Firestore: {e}")
         return None
 
+# Root reference injected for offline runs (see fake_firebase.FakeRealtimeDB)
+_realtime_db_override = None
+
+def use_realtime_db(reference):
+    """Route every Realtime Database call to `reference` (None restores the real one)"""
+    global _realtime_db_override
+    _realtime_db_override = reference
+
 # Get Realtime Database
 def get_realtime_db():
     """Get Realtime Database instance"""
+    if _realtime_db_override is not None:
+        return _realtime_db_override
     try:
         return db.reference()
     except Exception as e:
@@ -89,21 +116,21 @@ def add_user_to_firebase(user_id, full_name, username, join_date, invite_link=No
             print("❌ Firebase database not available")
             return False
             
-        user_data = {
-            'user_id': user_id,
-            'full_name': full_name,
-            'username': username,
-            'join_date': join_date,
-            'invite_link': invite_link,
-            'photo_url': photo_url,
-            'label': label,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }
+        user_data = user_document(user_id, full_name, username, join_date, invite_link, photo_url, label)
         
         # Use user_id as document ID for easier retrieval
         doc_ref = db.collection('users').document(str(user_id))
-        doc_ref.set(user_data)
+        # New users are created together with their counter increments in one
+        # atomic batch; an existing user is just overwritten and not recounted
+        batch = db.batch()
+        batch.create(doc_ref, user_data)
+        _increment_counter(batch, db, 'total_users')
+        if join_date:
+            _increment_counter(batch, db, _joins_counter_name(join_date))
+        try:
+            batch.commit()
+        except AlreadyExists:
+            doc_ref.set(user_data)
         
         print(f"✅ User {user_id} added to Firebase successfully")
         return True
@@ -120,10 +147,7 @@ def get_user_from_firebase(user_id):
         if not db:
             return None
             
-        doc = db.collection('users').document(str(user_id)).get()
-        if doc.exists:
-            return doc.to_dict()
-        return None
+        return firestore_dao.FirestoreDAO(db).get_user(user_id)
     except Exception as e:
         print(f"❌ Error getting user from Firebase: {e}")
         return None
@@ -162,10 +186,7 @@ def update_user_label(user_id, label):
         if not db:
             return False
             
-        db.collection('users').document(str(user_id)).update({
-            'label': label,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
+        firestore_dao.FirestoreDAO(db).update_user(user_id, {'label': label})
         
         print(f"✅ User {user_id} label updated in Firebase")
         return True
@@ -173,8 +194,19 @@ def update_user_label(user_id, label):
         print(f"❌ Error updating user label in Firebase: {e}")
         return False
 
+# Outbox replication (see replicator.py)
+def replicate_events(events):
+    """Apply (kind, payload) outbox events in one atomic batch (see FirestoreDAO.apply_events).
+
+    Raises on failure so the replicator can retry.
+    """
+    db = get_firestore()
+    if not db:
+        raise RuntimeError("Firebase database not available")
+    firestore_dao.FirestoreDAO(db).apply_events(events)
+
 # Message management functions
-def save_message_to_firebase(user_id, sender, message, timestamp=None):
+def save_message_to_firebase(user_id, sender, message, timestamp=None, message_id=None):
     """Save message to Firebase"""
     try:
         db = get_firestore()
@@ -185,16 +217,25 @@ def save_message_to_firebase(user_id, sender, message, timestamp=None):
         if timestamp is None:
             timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-        message_data = {
-            'user_id': user_id,
-            'sender': sender,
-            'message': message,
-            'timestamp': timestamp,
-            'created_at': firestore.SERVER_TIMESTAMP
-        }
+        message_data = message_document(user_id, sender, message, timestamp, message_id)
         
-        # Add message to messages collection
-        doc_ref = db.collection('messages').add(message_data)
+        if message_id is not None:
+            doc_ref = db.collection('messages').document(str(message_id))
+        else:
+            doc_ref = db.collection('messages').document()
+        batch = db.batch()
+        batch.create(doc_ref, message_data)
+        _increment_counter(batch, db, 'total_messages')
+        firestore_dao.add_activity(batch, db, user_id, message_data['ts_ms'])
+        try:
+            batch.commit()
+        except AlreadyExists:
+            # Re-sent message (retry or re-migration) is already there; never
+            # overwrite a different message that got the same id
+            stored = doc_ref.get()
+            if stored.exists and not firestore_dao.same_message(stored.to_dict(), message_data):
+                print(f"❌ Message {message_id} not saved to Firebase: id taken by a different message")
+                return False
         print(f"✅ Message saved to Firebase for user {user_id}: {message[:50]}...")
         return True
     except Exception as e:
@@ -203,30 +244,47 @@ def save_message_to_firebase(user_id, sender, message, timestamp=None):
         traceback.print_exc()
         return False
 
-def get_messages_for_user_from_firebase(user_id, limit=100):
-    """Get messages for user from Firebase"""
+def get_messages_for_user_from_firebase(user_id, limit=100, before_id=None, after_id=None):
+    """Get a keyset page of messages for user from Firebase, newest first.
+
+    Seeks on the mirrored `message_id` field (composite index on
+    user_id + message_id), so no documents before the cursor are read.
+    Returns (messages, has_more) with messages as (id, sender, message, timestamp,
+    delivery_status, delivery_error).
+    """
     try:
         db = get_firestore()
         if not db:
             print("❌ Firebase database not available")
-            return []
-            
-        messages = []
-        docs = db.collection('messages').where('user_id', '==', user_id).order_by('timestamp').limit(limit).stream()
-        
-        for doc in docs:
-            msg_data = doc.to_dict()
-            messages.append((
-                msg_data.get('sender', ''),
-                msg_data.get('message', ''),
-                msg_data.get('timestamp', '')
-            ))
+            return [], False
             
+        messages, has_more = firestore_dao.FirestoreDAO(db).get_message_page(user_id, limit, before_id, after_id)
+
         print(f"✅ Retrieved {len(messages)} messages from Firebase for user {user_id}")
-        return messages
+        return messages, has_more
     except Exception as e:
         print(f"❌ Error getting messages from Firebase: {e}")
-        return []
+        return [], False
+
+def get_messages_since_from_firebase(user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+    """Get messages newer than a high-water mark from Firebase, oldest first.
+
+    Same contract as db.get_messages_since: since_id seeks on the mirrored
+    `message_id`, since_ts/since_ts_id on (`ts_ms`, `message_id`) (composite
+    indexes on user_id + those fields).
+    Returns (messages, has_more) with messages as (id, sender, message, timestamp, ts_ms,
+    delivery_status, delivery_error).
+    """
+    try:
+        db = get_firestore()
+        if not db:
+            print("❌ Firebase database not available")
+            return [], False
+            
+        return firestore_dao.FirestoreDAO(db).get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)
+    except Exception as e:
+        print(f"❌ Error getting new messages from Firebase: {e}")
+        return [], False
 
 def get_all_messages_from_firebase(limit=100):
     """Get all messages from Firebase"""
@@ -252,16 +310,166 @@ def get_all_messages_from_firebase(limit=100):
         print(f"❌ Error getting all messages from Firebase: {e}")
         return []
 
+# Bulk reads for the startup hydrator (see hydrator.py)
+USER_FIELDS = ['user_id', 'full_name', 'username', 'join_date', 'invite_link', 'photo_url', 'label']
+MESSAGE_FIELDS = ['message_id', 'user_id', 'sender', 'message', 'timestamp', 'ts_ms']
+
+def stream_users_from_firebase():
+    """Yield every user as a tuple in USER_FIELDS order (projection, one pass)"""
+    db = get_firestore()
+    if not db:
+        return
+    for doc in db.collection('users').select(USER_FIELDS).stream():
+        data = doc.to_dict()
+        if data.get('user_id') is not None:
+            yield tuple(data.get(field) for field in USER_FIELDS)
+
+def stream_messages_since_from_firebase(since_ms):
+    """Yield messages with ts_ms >= since_ms as tuples in MESSAGE_FIELDS order"""
+    db = get_firestore()
+    if not db:
+        return
+    for doc in db.collection('messages').where('ts_ms', '>=', since_ms).select(MESSAGE_FIELDS).stream():
+        data = doc.to_dict()
+        yield tuple(data.get(field) for field in MESSAGE_FIELDS)
+
+def get_max_message_id_from_firebase():
+    """Highest mirrored message_id in Firestore (one document read), 0 if none"""
+    db = get_firestore()
+    if not db:
+        return 0
+    return firestore_dao.FirestoreDAO(db).max_message_id()
+
+# Change feed for the message cache (see message_cache.py)
+def watch_new_messages(since_ms, callback):
+    """Listen for message writes with ts_ms >= since_ms; returns the Watch (call .unsubscribe()) or None"""
+    try:
+        db = get_firestore()
+        if not db:
+            return None
+        return firestore_dao.FirestoreDAO(db).watch_messages(since_ms, callback)
+    except Exception as e:
+        print(f"❌ Error listening for Firebase messages: {e}")
+        return None
+
 # Statistics functions
+#
+# Counts use server-side count() aggregations (billed one read per 1000
+# index entries) instead of streaming documents. Each count also has a
+# sharded counter under counters/<name>/shards/<n>, incremented in the same
+# batch as the document it counts, which is read when aggregation fails.
+# Counters only see writes made after they were introduced, so
+# reseed_counters() backfills every family from the data once (marked by
+# counters/_seeded) and the fallback is only used after that.
+# Results are cached locally for COUNT_CACHE_TTL seconds.
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+_counters_seeded = False
+
+_joins_counter_name = firestore_dao.joins_counter_name
+_increment_counter = firestore_dao.add_counter_increment
+
+def read_counter(name):
+    """Sum the shards of a distributed counter (at most COUNTER_SHARDS reads); None if it has none"""
+    db = get_firestore()
+    if not db:
+        return None
+    shards = list(db.collection('counters').document(name).collection('shards').stream())
+    if not shards:
+        return None
+    return sum(shard.to_dict().get('count', 0) for shard in shards)
+
+def reseed_counter(name, value):
+    """Reset a sharded counter to `value` (after bulk writes that bypassed it)"""
+    db = get_firestore()
+    if not db:
+        return False
+    batch = db.batch()
+    shards = db.collection('counters').document(name).collection('shards')
+    for shard in range(COUNTER_SHARDS):
+        batch.set(shards.document(str(shard)), {'count': value if shard == 0 else 0})
+    batch.commit()
+    return True
+
+def reseed_counters():
+    """Reset every counter family from the data: total_users and total_messages
+    from count(), joins_<day> from the users' join dates (one read per user)"""
+    global _counters_seeded
+    db = get_firestore()
+    if not db:
+        return False
+    dao = firestore_dao.FirestoreDAO(db)
+    reseed_counter('total_users', dao.count(db.collection('users')))
+    reseed_counter('total_messages', dao.count(db.collection('messages')))
+    joins = {}
+    for doc in db.collection('users').select(['join_date']).stream():
+        join_date = doc.to_dict().get('join_date')
+        if join_date:
+            name = _joins_counter_name(join_date)
+            joins[name] = joins.get(name, 0) + 1
+    for name, value in joins.items():
+        reseed_counter(name, value)
+    db.collection('counters').document('_seeded').set({'seeded_at': firestore.SERVER_TIMESTAMP, 'join_days': len(joins)})
+    _counters_seeded = True
+    invalidate_count_cache()
+    print(f"✅ Sharded counters reseeded ({len(joins)} join days)")
+    return True
+
+def counters_seeded():
+    """Whether reseed_counters() has backfilled the counters (so they can stand in for count())"""
+    global _counters_seeded
+    if not _counters_seeded:
+        db = get_firestore()
+        _counters_seeded = bool(db) and db.collection('counters').document('_seeded').get().exists
+    return _counters_seeded
+
+def ensure_counters_seeded():
+    """Backfill the counters once per project"""
+    try:
+        if not counters_seeded():
+            reseed_counters()
+    except Exception as e:
+        print(f"❌ Could not reseed sharded counters: {e}")
+
+def seed_counters_in_background():
+    """ensure_counters_seeded() on a daemon thread; called at startup"""
+    thread = threading.Thread(target=ensure_counters_seeded, name='counter-seed', daemon=True)
+    thread.start()
+    return thread
+
+def invalidate_count_cache():
+    with _count_cache_lock:
+        _count_cache.clear()
+
+def _firestore_count(key, build_query, counter_name=None):
+    """Cached count(): aggregation query first, sharded counter (if any) as the fallback"""
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    db = get_firestore()
+    if not db:
+        return 0
+    try:
+        count = firestore_dao.FirestoreDAO(db).count(build_query(db))
+    except Exception as e:
+        if counter_name and counters_seeded():
+            print(f"⚠️ count() aggregation failed for {key}, using sharded counter: {e}")
+            count = read_counter(counter_name) or 0
+        else:
+            # Unseeded counters hold only recent writes: a stale count beats a partial one
+            print(f"⚠️ count() aggregation failed for {key} and no seeded counter to fall back on: {e}")
+            count = cached[0] if cached else 0
+    
+    with _count_cache_lock:
+        _count_cache[key] = (count, now + COUNT_CACHE_TTL)
+    return count
+
 def get_total_users_from_firebase():
     """Get total users count from Firebase"""
     try:
-        db = get_firestore()
-        if not db:
-            return 0
-            
-        docs = db.collection('users').stream()
-        count = len(list(docs))
+        count = _firestore_count('total_users', lambda db: db.collection('users'), 'total_users')
         print(f"✅ Total users in Firebase: {count}")
         return count
     except Exception as e:
@@ -271,12 +479,7 @@ def get_total_users_from_firebase():
 def get_total_messages_from_firebase():
     """Get total messages count from Firebase"""
     try:
-        db = get_firestore()
-        if not db:
-            return 0
-            
-        docs = db.collection('messages').stream()
-        count = len(list(docs))
+        count = _firestore_count('total_messages', lambda db: db.collection('messages'), 'total_messages')
         print(f"✅ Total messages in Firebase: {count}")
         return count
     except Exception as e:
@@ -286,20 +489,11 @@ def get_total_messages_from_firebase():
 def get_active_users_from_firebase(minutes=60):
     """Get active users count from Firebase"""
     try:
-        db = get_firestore()
-        if not db:
-            return 0
-            
-        since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
-        docs = db.collection('messages').where('timestamp', '>=', since.strftime('%Y-%m-%d %H:%M:%S')).stream()
-        
-        # Get unique user IDs
-        user_ids = set()
-        for doc in docs:
-            msg_data = doc.to_dict()
-            user_ids.add(msg_data.get('user_id'))
-            
-        count = len(user_ids)
+        # activity/<user_id> holds each user's last message time (written with
+        # the message), so distinct active users are a count() over it
+        since_ms = timeutil.minutes_ago_ms(minutes)
+        count = _firestore_count(f'active_users_{minutes}',
+                                 lambda db: db.collection('activity').where('last_active_ms', '>=', since_ms))
         print(f"✅ Active users in Firebase: {count}")
         return count
     except Exception as e:
@@ -309,13 +503,14 @@ def get_active_users_from_firebase(minutes=60):
 def get_new_joins_today_from_firebase():
     """Get new joins today count from Firebase"""
     try:
-        db = get_firestore()
-        if not db:
-            return 0
-            
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-        docs = db.collection('users').where('join_date', '>=', today).stream()
-        count = len(list(docs))
+        today = datetime.date.today()
+        tomorrow = today + datetime.timedelta(days=1)
+        count = _firestore_count(
+            f"joins_{today.isoformat()}",
+            lambda db: db.collection('users')
+                .where('join_date', '>=', today.isoformat())
+                .where('join_date', '<', tomorrow.isoformat()),
+            _joins_counter_name(today.isoformat()))
         print(f"✅ New joins today in Firebase: {count}")
         return count
     except Exception as e:
@@ -323,8 +518,15 @@ def get_new_joins_today_from_firebase():
         return 0
 
 # Realtime Database functions (alternative)
-def save_message_to_realtime_db(user_id, sender, message, timestamp=None):
-    """Save message to Realtime Database"""
+#
+# Messages live under user_messages/<user_id>/<push id>, so reading a chat
+# transfers only that chat. Databases written by older versions keep one
+# flat messages/<push id> list; migrate_realtime_db_layout() moves it.
+RTDB_MESSAGES_PATH = 'user_messages'
+LEGACY_RTDB_MESSAGES_PATH = 'messages'
+
+def save_message_to_realtime_db(user_id, sender, message, timestamp=None, message_id=None):
+    """Save message to Realtime Database under the user's own path"""
     try:
         db = get_realtime_db()
         if not db:
@@ -337,10 +539,13 @@ def save_message_to_realtime_db(user_id, sender, message, timestamp=None):
             'user_id': user_id,
             'sender': sender,
             'message': message,
-            'timestamp': timestamp
+            'timestamp': timestamp,
+            'ts_ms': timeutil.to_ms(timestamp)
         }
+        if message_id is not None:
+            message_data['message_id'] = message_id
         
-        db.child('messages').push(message_data)
+        db.child(RTDB_MESSAGES_PATH).child(str(user_id)).push(message_data)
         print(f"✅ Message saved to Realtime DB for user {user_id}")
         return True
     except Exception as e:
@@ -348,69 +553,71 @@ def save_message_to_realtime_db(user_id, sender, message, timestamp=None):
         return False
 
 def get_messages_for_user_from_realtime_db(user_id, limit=100):
-    """Get messages for user from Realtime Database"""
+    """Get the newest `limit` messages for user from Realtime Database, oldest first.
+
+    Only the user's subtree is queried, and push ids sort by creation
+    time, so limit_to_last on the key needs no .indexOn rule.
+    """
     try:
         db = get_realtime_db()
         if not db:
             return []
             
-        messages = []
-        data = db.child('messages').get()
+        data = db.child(RTDB_MESSAGES_PATH).child(str(user_id)).order_by_key().limit_to_last(limit).get()
         
-        if data:
-            for key, msg_data in data.items():
-                if msg_data.get('user_id') == user_id:
-                    messages.append((
-                        msg_data.get('sender', ''),
-                        msg_data.get('message', ''),
-                        msg_data.get('timestamp', '')
-                    ))
-                    
-                    if len(messages) >= limit:
-                        break
-                        
+        messages = []
+        for msg_data in (data or {}).values():
+            messages.append((
+                msg_data.get('sender', ''),
+                msg_data.get('message', ''),
+                msg_data.get('timestamp', '')
+            ))
         return messages
     except Exception as e:
         print(f"❌ Error getting messages from Realtime DB: {e}")
         return []
 
-# Migration function
-def migrate_sqlite_to_firebase():
-    """Migrate data from SQLite to Firebase"""
+def migrate_realtime_db_layout(batch_size=500):
+    """Move legacy messages/<push id> entries to user_messages/<user_id>/<push id>.
+
+    Each chunk is a single multi-path update that writes the new location
+    and deletes the old one, so a message is never in both places or lost,
+    and a rerun continues with whatever is still left under messages/.
+    Returns the number of messages moved, or None on error.
+    """
     try:
-        import sqlite3
-        
-        # Connect to SQLite
-        sqlite_db = 'users.db'
-        if not os.path.exists(sqlite_db):
-            print("❌ SQLite database not found")
-            return False
-            
-        conn = sqlite3.connect(sqlite_db)
-        c = conn.cursor()
-        
-        # Migrate users
-        c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users')
-        users = c.fetchall()
-        
-        for user in users:
-            add_user_to_firebase(
-                user[0], user[1], user[2], user[3], 
-                user[4], user[5], user[6]
-            )
-        
-        # Migrate messages
-        c.execute('SELECT user_id, sender, message, timestamp FROM messages')
-        messages = c.fetchall()
-        
-        for msg in messages:
-            save_message_to_firebase(msg[0], msg[1], msg[2], msg[3])
-        
-        conn.close()
-        
-        print(f"✅ Migration completed: {len(users)} users, {len(messages)} messages")
-        return True
+        db = get_realtime_db()
+        if not db:
+            return None
         
+        moved = 0
+        while True:
+            legacy = db.child(LEGACY_RTDB_MESSAGES_PATH).order_by_key().limit_to_first(batch_size).get()
+            if not legacy:
+                break
+            updates = {}
+            for key, msg_data in legacy.items():
+                if not isinstance(msg_data, dict):
+                    msg_data = {'message': msg_data}
+                if 'ts_ms' not in msg_data and msg_data.get('timestamp'):
+                    msg_data['ts_ms'] = timeutil.to_ms(msg_data['timestamp'])
+                owner = str(msg_data['user_id']) if msg_data.get('user_id') is not None else '_unassigned'
+                updates[f'{RTDB_MESSAGES_PATH}/{owner}/{key}'] = msg_data
+                updates[f'{LEGACY_RTDB_MESSAGES_PATH}/{key}'] = None
+            db.update(updates)
+            moved += len(legacy)
+            print(f"🚚 Moved {moved} Realtime DB messages to per-user paths")
+        return moved
+    except Exception as e:
+        print(f"❌ Realtime DB layout migration failed: {e}")
+        return None
+
+# Migration function
+def migrate_sqlite_to_firebase(restart=False):
+    """Migrate data from SQLite to Firebase (batched, resumable; see firebase_migrator.py)"""
+    try:
+        from firebase_migrator import migrator
+        return migrator.run(restart=restart)
     except Exception as e:
         print(f"❌ Migration error: {e}")
         return False
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+import firebase_config
+import timeutil
+from db_writer import writer, WRITE_TIMEOUT
+
+# Firestore accepts at most 500 writes per batch
+BATCH_SIZE = min(int(os.environ.get('MIGRATION_BATCH_SIZE', 500)), 500)
+WORKERS = int(os.environ.get('MIGRATION_WORKERS', 4))
+MAX_RETRIES = 3
+
+# Lowest possible keyset position (Telegram ids and row ids are above this)
+_START_KEY = -(2 ** 63)
+
+
+def _user_doc(row):
+    return str(row[0]), firebase_config.user_document(*row)
+
+def _message_doc(row):
+    message_id, user_id, sender, message, timestamp, delivery_status, delivery_error = row
+    data = firebase_config.message_document(user_id, sender, message, timestamp, message_id)
+    if delivery_status is not None:
+        # The document is overwritten whole, so carry the Telegram delivery outcome over
+        data.update(delivery_status=delivery_status, delivery_error=delivery_error)
+    return str(message_id), data
+
+# (checkpoint name / collection, keyset chunk query, total query, row -> (doc id, body))
+TABLES = [
+    ('users',
+     'SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users '
+     'WHERE user_id > ? ORDER BY user_id LIMIT ?',
+     'SELECT COUNT(*) FROM users',
+     _user_doc),
+    ('messages',
+     'SELECT id, user_id, sender, message, timestamp, delivery_status, delivery_error FROM messages '
+     'WHERE id > ? ORDER BY id LIMIT ?',
+     'SELECT COUNT(*) FROM messages',
+     _message_doc),
+]
+
+
+class FirestoreMigrator:
+    """Streams SQLite rows into Firestore batched writes on a bounded worker pool.
+
+    Chunks are read by keyset, written in parallel, and checkpointed in
+    order, so an interrupted run resumes after the last fully written chunk.
+    Documents use the same ids as the live writers, so rewriting a chunk is
+    harmless.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, workers=WORKERS):
+        self.batch_size = batch_size
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._thread = None
+        self._progress = {'status': 'idle'}
+
+    def start(self, restart=False):
+        """Run in a background thread; False if a run is already in progress"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(target=self.run, args=(restart,), name='firestore-migrator', daemon=True)
+            self._thread.start()
+            return True
+
+    def run(self, restart=False):
+        """Migrate every table; returns True when all rows were copied"""
+        db = firebase_config.get_firestore()
+        if not db:
+            self._progress = {'status': 'failed', 'error': 'Firebase database not available'}
+            return False
+        if restart:
+            writer.execute('DELETE FROM migration_checkpoints').result(timeout=WRITE_TIMEOUT)
+
+        self._progress = {
+            'status': 'running',
+            'started_ms': timeutil.now_ms(),
+            'batch_size': self.batch_size,
+            'workers': self.workers,
+            'tables': {}
+        }
+        started = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='firestore-batch') as executor:
+                for name, chunk_sql, total_sql, build in TABLES:
+                    self._migrate_table(db, executor, name, chunk_sql, total_sql, build)
+        except Exception as e:
+            print(f"❌ Migration stopped, will resume from the last checkpoint: {e}")
+            self._progress.update({'status': 'failed', 'error': str(e)})
+            return False
+
+        self._reseed_counters()
+        elapsed = time.monotonic() - started
+        copied = sum(t['rows_this_run'] for t in self._progress['tables'].values())
+        self._progress.update({
+            'status': 'completed',
+            'elapsed_seconds': round(elapsed, 2),
+            'rows_per_sec': round(copied / elapsed, 1) if elapsed else None
+        })
+        print(f"✅ Migration completed: {copied} rows in {elapsed:.1f}s")
+        return True
+
+    def _migrate_table(self, db, executor, name, chunk_sql, total_sql, build):
+        last_key, rows_copied = self._load_checkpoint(name)
+        with db_pool.connection() as conn:
+            total = conn.execute(total_sql).fetchone()[0]
+        table = {'rows_total': total, 'rows_copied': rows_copied, 'rows_this_run': 0,
+                 'last_key': last_key if last_key != _START_KEY else None, 'rows_per_sec': 0}
+        self._progress['tables'][name] = table
+        started = time.monotonic()
+
+        # Oldest chunk first: waiting on it keeps checkpoints contiguous while
+        # the pool works on the chunks behind it
+        in_flight = deque()
+
+        def finish_oldest():
+            future, chunk_last_key, count = in_flight.popleft()
+            future.result()
+            table['rows_copied'] += count
+            table['rows_this_run'] += count
+            table['last_key'] = chunk_last_key
+            elapsed = time.monotonic() - started
+            table['rows_per_sec'] = round(table['rows_this_run'] / elapsed, 1) if elapsed else 0
+            self._save_checkpoint(name, chunk_last_key, table['rows_copied'])
+
+        try:
+            while True:
+                with db_pool.connection() as conn:
+                    rows = conn.execute(chunk_sql, (last_key, self.batch_size)).fetchall()
+                if not rows:
+                    break
+                last_key = rows[-1][0]
+                in_flight.append((executor.submit(self._write_batch, db, name, rows, build), last_key, len(rows)))
+                if len(in_flight) >= self.workers * 2:
+                    finish_oldest()
+            while in_flight:
+                finish_oldest()
+        finally:
+            for future, _key, _count in in_flight:
+                future.cancel()
+
+        print(f"🚚 Migrated {table['rows_this_run']} {name} at {table['rows_per_sec']} rows/sec")
+
+    def _write_batch(self, db, collection, rows, build):
+        """Commit one chunk as a single batched write, retrying with backoff"""
+        for attempt in range(MAX_RETRIES):
+            try:
+                batch = db.batch()
+                for row in rows:
+                    doc_id, data = build(row)
+                    batch.set(db.collection(collection).document(doc_id), data)
+                batch.commit()
+                return len(rows)
+            except Exception as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                print(f"⚠️ Batch of {len(rows)} {collection} failed ({e}), retrying")
+                time.sleep(0.5 * 2 ** attempt)
+
+    def _load_checkpoint(self, name):
+        with db_pool.connection() as conn:
+            row = conn.execute('SELECT last_key, rows_copied FROM migration_checkpoints WHERE name = ?', (name,)).fetchone()
+        return (row[0], row[1]) if row else (_START_KEY, 0)
+
+    def _save_checkpoint(self, name, last_key, rows_copied):
+        writer.execute('''
+            INSERT INTO migration_checkpoints (name, last_key, rows_copied, updated_ms) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                last_key = excluded.last_key, rows_copied = excluded.rows_copied, updated_ms = excluded.updated_ms
+        ''', (name, last_key, rows_copied, timeutil.now_ms())).result(timeout=WRITE_TIMEOUT)
+
+    def _reseed_counters(self):
+        """Bulk writes skip the sharded counters; reset every family from the data"""
+        try:
+            firebase_config.reseed_counters()
+        except Exception as e:
+            print(f"❌ Could not reseed sharded counters after migration: {e}")
+
+    def status(self):
+        return dict(self._progress, running=bool(self._thread and self._thread.is_alive()))
+
+
+# Shared migrator used by api_simple.py
+migrator = FirestoreMigrator()
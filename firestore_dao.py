@@ -0,0 +1,280 @@
+"""
+Firestore data access with one shared client per process.
+
+FirestoreDAO is used from Flask threads and background workers. The bot's
+event loop does no Firestore I/O: its writes reach Firestore through the
+SQLite outbox (replicator.py).
+"""
+
+import os
+import random
+import threading
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+import timeutil
+
+# Shards per distributed counter (counters/<name>/shards/<n>)
+COUNTER_SHARDS = int(os.environ.get('FIRESTORE_COUNTER_SHARDS', 10))
+
+_lock = threading.Lock()
+_client = None
+_override = None
+
+
+def get_client():
+    """The process-wide Firestore client (created on first use)"""
+    global _client
+    if _override is not None:
+        return _override
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = firestore.client()
+    return _client
+
+
+def use_client(client):
+    """Swap in another client (e.g. fake_firebase); None restores the real one"""
+    global _override
+    _override = client
+
+
+class MessageIdConflict(Exception):
+    """A message create found its document id taken by a different message.
+
+    `index` is the position of the event in the list passed to apply_events;
+    events before it were applied, events after it were not.
+    """
+
+    def __init__(self, message_id, index=0):
+        super().__init__(f"messages/{message_id} already holds a different message")
+        self.message_id = message_id
+        self.index = index
+
+
+# --- Document layouts shared by every writer ---
+
+def user_document(user_id, full_name, username, join_date, invite_link=None, photo_url=None, label=None):
+    """Firestore users/<user_id> document body"""
+    return {
+        'user_id': user_id,
+        'full_name': full_name,
+        'username': username,
+        'join_date': join_date,
+        'invite_link': invite_link,
+        'photo_url': photo_url,
+        'label': label,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+
+
+def message_document(user_id, sender, message, timestamp, message_id=None):
+    """Firestore messages/<message_id> document body"""
+    message_data = {
+        'user_id': user_id,
+        'sender': sender,
+        'message': message,
+        'timestamp': timestamp,
+        'ts_ms': timeutil.to_ms(timestamp),
+        'created_at': firestore.SERVER_TIMESTAMP
+    }
+    if message_id is not None:
+        # Mirror the SQLite row id so history can be paged by id
+        message_data['message_id'] = message_id
+    return message_data
+
+
+# Fields that identify a message; delivery_status and created_at may differ between copies
+MESSAGE_IDENTITY = ('user_id', 'sender', 'message', 'timestamp')
+
+
+def same_message(stored, data):
+    """Whether a stored message document holds the message in `data`"""
+    return all(stored.get(field) == data.get(field) for field in MESSAGE_IDENTITY)
+
+
+def joins_counter_name(join_date):
+    return f"joins_{str(join_date)[:10]}"
+
+
+def add_activity(batch, client, user_id, ts_ms):
+    """Raise activity/<user_id>.last_active_ms to ts_ms in a write batch (active-user counts)"""
+    if ts_ms is None:
+        return
+    batch.set(client.collection('activity').document(str(user_id)),
+              {'user_id': user_id, 'last_active_ms': firestore.Maximum(ts_ms)}, merge=True)
+
+
+def add_counter_increment(batch, client, name, amount=1):
+    """Add an increment of one random shard of counter `name` to a write batch"""
+    shard = client.collection('counters').document(name).collection('shards').document(str(random.randrange(COUNTER_SHARDS)))
+    batch.set(shard, {'count': firestore.Increment(amount)}, merge=True)
+
+
+class FirestoreDAO:
+    """Blocking data access on the shared client"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _user_ref(self, user_id):
+        return self.client.collection('users').document(str(user_id))
+
+    def _page_query(self, user_id, limit, before_id, after_id):
+        query = self.client.collection('messages').where('user_id', '==', user_id)
+        if before_id is not None:
+            query = query.where('message_id', '<', before_id)
+        if after_id is not None:
+            query = query.where('message_id', '>', after_id)
+        direction = firestore.Query.ASCENDING if after_id is not None else firestore.Query.DESCENDING
+        return query.order_by('message_id', direction=direction).limit(limit + 1)
+
+    @staticmethod
+    def _page_result(docs, limit, after_id):
+        messages = []
+        for doc in docs[:limit]:
+            msg_data = doc.to_dict()
+            messages.append((
+                msg_data.get('message_id'),
+                msg_data.get('sender', ''),
+                msg_data.get('message', ''),
+                msg_data.get('timestamp', ''),
+                msg_data.get('delivery_status'),
+                msg_data.get('delivery_error')
+            ))
+        if after_id is not None:
+            messages.reverse()
+        return messages, len(docs) > limit
+
+    def _since_query(self, user_id, since_id, since_ts, limit, since_ts_id=None):
+        query = self.client.collection('messages').where('user_id', '==', user_id)
+        if since_id is not None:
+            query = query.where('message_id', '>', since_id).order_by('message_id')
+        elif since_ts_id is not None:
+            # Resume inside a run of equal timestamps (index on user_id, ts_ms, message_id)
+            query = query.order_by('ts_ms').order_by('message_id').start_after(
+                {'ts_ms': since_ts or 0, 'message_id': since_ts_id})
+        else:
+            query = query.where('ts_ms', '>', since_ts or 0).order_by('ts_ms').order_by('message_id')
+        return query.limit(limit + 1)
+
+    @staticmethod
+    def _since_result(docs, limit):
+        messages = []
+        for doc in docs[:limit]:
+            msg_data = doc.to_dict()
+            messages.append((
+                msg_data.get('message_id'),
+                msg_data.get('sender', ''),
+                msg_data.get('message', ''),
+                msg_data.get('timestamp', ''),
+                msg_data.get('ts_ms'),
+                msg_data.get('delivery_status'),
+                msg_data.get('delivery_error')
+            ))
+        return messages, len(docs) > limit
+
+    def _max_id_query(self):
+        return self.client.collection('messages').order_by('message_id', direction=firestore.Query.DESCENDING).limit(1)
+
+    def _event_batch(self, events, create=True):
+        """Write batch for outbox events; `create` makes new documents and bumps counters"""
+        batch = self.client.batch()
+        for kind, payload in events:
+            self._add_event(batch, kind, payload, create)
+        return batch
+
+    def _add_event(self, batch, kind, payload, create):
+        if kind == 'user':
+            ref = self._user_ref(payload['user_id'])
+            if create:
+                batch.create(ref, user_document(**payload))
+                add_counter_increment(batch, self.client, 'total_users')
+                if payload.get('join_date'):
+                    add_counter_increment(batch, self.client, joins_counter_name(payload['join_date']))
+            else:
+                # Keep fields this event doesn't carry (label, created_at)
+                data = {k: v for k, v in user_document(**payload).items() if k in payload or k == 'updated_at'}
+                batch.set(ref, data, merge=True)
+        elif kind == 'user_update':
+            fields = {k: v for k, v in payload.items() if k != 'user_id'}
+            fields['updated_at'] = firestore.SERVER_TIMESTAMP
+            batch.set(self._user_ref(payload['user_id']), fields, merge=True)
+        elif kind == 'message_update':
+            fields = {k: v for k, v in payload.items() if k != 'message_id'}
+            batch.set(self.client.collection('messages').document(str(payload['message_id'])), fields, merge=True)
+        elif kind == 'message':
+            # Always a create: an existing document is a conflict for apply_events to resolve
+            ref = self.client.collection('messages').document(str(payload['message_id']))
+            data = message_document(payload['user_id'], payload['sender'], payload['message'],
+                                    payload['timestamp'], payload['message_id'])
+            batch.create(ref, data)
+            add_counter_increment(batch, self.client, 'total_messages')
+            add_activity(batch, self.client, payload['user_id'], data['ts_ms'])
+        else:
+            raise ValueError(f"Unknown outbox event kind: {kind}")
+
+    def get_user(self, user_id):
+        snapshot = self._user_ref(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def update_user(self, user_id, fields):
+        self._user_ref(user_id).set(dict(fields, updated_at=firestore.SERVER_TIMESTAMP), merge=True)
+
+    def update_message(self, message_id, fields):
+        self.client.collection('messages').document(str(message_id)).set(fields, merge=True)
+
+    def get_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        """Keyset page newest first: (messages, has_more), rows as in db.get_message_page"""
+        return self._page_result(list(self._page_query(user_id, limit, before_id, after_id).stream()), limit, after_id)
+
+    def get_messages_since(self, user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+        """Messages after a high-water mark, oldest first: (messages, has_more)"""
+        query = self._since_query(user_id, since_id, since_ts, limit, since_ts_id)
+        return self._since_result(list(query.stream()), limit)
+
+    def count(self, query):
+        return query.count().get()[0][0].value
+
+    def max_message_id(self):
+        docs = list(self._max_id_query().stream())
+        return (docs[0].to_dict().get('message_id') or 0) if docs else 0
+
+    def watch_messages(self, since_ms, callback):
+        """on_snapshot listener for messages with ts_ms >= since_ms; returns the Watch"""
+        return self.client.collection('messages').where('ts_ms', '>=', since_ms).on_snapshot(callback)
+
+    def apply_events(self, events):
+        """Apply (kind, payload) outbox events in one atomic batch.
+
+        Document ids come from SQLite keys, so re-applying is safe: if a
+        document already exists the events are retried one by one. User
+        events are idempotent and merge into the existing document without
+        counting it again. A message document is only left alone if it holds
+        the same message; a different one means two messages got the same
+        id, which raises MessageIdConflict instead of overwriting it.
+        """
+        try:
+            self._event_batch(events).commit()
+            return
+        except AlreadyExists:
+            pass
+        for index, (kind, payload) in enumerate(events):
+            try:
+                self._event_batch([(kind, payload)]).commit()
+            except AlreadyExists:
+                if kind != 'message':
+                    self._event_batch([(kind, payload)], create=False).commit()
+                    continue
+                stored = self.client.collection('messages').document(str(payload['message_id'])).get()
+                if stored.exists and not same_message(stored.to_dict(), payload):
+                    raise MessageIdConflict(payload['message_id'], index)
+
+
+def dao():
+    """Blocking DAO on the shared client"""
+    return FirestoreDAO(get_client())
+
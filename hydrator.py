@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+import db
+import db_pool
+import message_cache
+import stats
+import timeutil
+from db_writer import writer, WRITE_TIMEOUT
+
+# 'auto' hydrates only an empty local database, 'always' on every boot, 'never' skips
+HYDRATE_MODE = os.environ.get('HYDRATE_ON_BOOT', 'auto')
+HYDRATE_MESSAGE_DAYS = float(os.environ.get('HYDRATE_MESSAGE_DAYS', 30))
+# Rows per SQLite transaction
+HYDRATE_BATCH = int(os.environ.get('HYDRATE_BATCH', 5000))
+
+
+def reserve_message_ids():
+    """Make new local message ids start above Firestore's highest, so replicated
+    messages can't take the id of one already there; returns that id"""
+    import firebase_config
+
+    max_id = firebase_config.get_max_message_id_from_firebase()
+    writer.submit(db.reserve_message_ids, max_id).result(timeout=WRITE_TIMEOUT)
+    return max_id
+
+
+class Hydrator:
+    """Warms the local SQLite cache from Firestore after a cold start.
+
+    Users and recent messages are streamed in two parallel threads and
+    written in large executemany transactions through the shared writer,
+    so live traffic keeps being served (and committed) while it runs.
+    """
+
+    def __init__(self, batch_size=HYDRATE_BATCH, message_days=HYDRATE_MESSAGE_DAYS):
+        self.batch_size = batch_size
+        self.message_days = message_days
+        self._ready = threading.Event()
+        self._thread = None
+        self._status = {'state': 'pending'}
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def start(self, firebase_available, mode=HYDRATE_MODE):
+        """Begin hydration in the background (or mark ready straight away if it is not needed)"""
+        if not firebase_available or mode == 'never':
+            return self.skip('Firebase not available' if not firebase_available else 'disabled')
+        with db_pool.connection() as conn:
+            has_users = conn.execute('SELECT 1 FROM users LIMIT 1').fetchone() is not None
+        if mode == 'auto' and has_users:
+            return self.skip('local database already populated')
+
+        # Before any new local message is written
+        reserve_message_ids()
+
+        self._status = {'state': 'running', 'started_ms': timeutil.now_ms(), 'users': 0, 'messages': 0}
+        self._thread = threading.Thread(target=self._run, name='sqlite-hydrator', daemon=True)
+        self._thread.start()
+
+    def skip(self, reason):
+        self._status = {'state': 'skipped', 'reason': reason}
+        self._ready.set()
+
+    def _run(self):
+        import firebase_config
+
+        started = time.monotonic()
+        since_ms = timeutil.minutes_ago_ms(self.message_days * 24 * 60)
+        sources = [
+            ('users', firebase_config.stream_users_from_firebase, (), db.insert_hydrated_users),
+            ('messages', firebase_config.stream_messages_since_from_firebase, (since_ms,), db.insert_hydrated_messages),
+        ]
+        errors = []
+        threads = [threading.Thread(target=self._load, args=(source, errors), name=f'hydrate-{source[0]}')
+                   for source in sources]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            self._status.update({'state': 'failed', 'error': '; '.join(errors)})
+            print(f"❌ Hydration failed: {self._status['error']}")
+        else:
+            writer.submit(db.rebuild_summaries).result(timeout=WRITE_TIMEOUT)
+            stats.cache.invalidate()
+            message_cache.cache.clear()
+            elapsed = time.monotonic() - started
+            rows = self._status['users'] + self._status['messages']
+            self._status.update({
+                'state': 'ready',
+                'seconds': round(elapsed, 2),
+                'rows_per_sec': round(rows / elapsed, 1) if elapsed else None
+            })
+            print(f"✅ Hydrated {self._status['users']} users and {self._status['messages']} messages in {elapsed:.1f}s")
+        # Serve from whatever is local even after a failure; /health shows the state
+        self._ready.set()
+
+    def _load(self, source, errors):
+        name, stream, args, insert = source
+        pending = None
+        try:
+            chunk = []
+            for row in stream(*args):
+                chunk.append(row)
+                if len(chunk) >= self.batch_size:
+                    # Keep one chunk in flight while the next one streams in
+                    if pending:
+                        pending.result(timeout=WRITE_TIMEOUT)
+                    pending = self._submit(name, insert, chunk)
+                    chunk = []
+            if pending:
+                pending.result(timeout=WRITE_TIMEOUT)
+            if chunk:
+                self._submit(name, insert, chunk).result(timeout=WRITE_TIMEOUT)
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+
+    def _submit(self, name, insert, chunk):
+        future = writer.submit(insert, chunk)
+
+        def count(done):
+            if done.exception() is None:
+                self._status[name] += len(chunk)
+        future.add_done_callback(count)
+        return future
+
+    def status(self):
+        return dict(self._status, ready=self.is_ready())
+
+
+# Shared hydrator used by api_simple.py
+loader = Hydrator()
@@ -0,0 +1,201 @@
+"""
+Ingestion of private messages users send to the bot.
+
+The Pyrogram handler (InboundMessages.handle) only turns a message into a
+row and queues it, so the bot loop never waits on the database. One
+writer task collects up to INBOUND_BATCH rows (waiting at most
+INBOUND_BATCH_WINDOW_MS after the first) and stores them with a single
+Storage.queue_messages call, one transaction on SQLite. Stored batches
+are then emitted, in order, by one emitter task on a worker thread.
+
+Pyrogram runs handlers on several workers, so two messages from one user
+can reach the handler out of order; each batch puts every user's
+messages back in Telegram id order before they are stored. Media is
+stored as text in the upload convention, e.g. "[USER] [PHOTO] (84.2 KB)";
+contacts and polls keep their name and number or question and options.
+"""
+
+import asyncio
+import os
+
+from pyrogram.enums import MessageMediaType
+
+import storage
+import timeutil
+
+INBOUND_BATCH = int(os.environ.get('INBOUND_BATCH', 200))
+INBOUND_BATCH_WINDOW_MS = float(os.environ.get('INBOUND_BATCH_WINDOW_MS', 20))
+# Messages waiting to be stored before the handler has to wait
+INBOUND_QUEUE_SIZE = int(os.environ.get('INBOUND_QUEUE_SIZE', 10000))
+
+
+def _size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def describe(message):
+    """Text stored for a Telegram message: its text, or media metadata plus caption"""
+    # A link preview is media too, but the message is its text
+    if message.media is None or message.media == MessageMediaType.WEB_PAGE:
+        return message.text or ''
+    kind = message.media.value
+    media = getattr(message, kind, None)
+    details = []
+    if message.media == MessageMediaType.CONTACT:
+        name = ' '.join(part for part in (media.first_name, media.last_name) if part)
+        details += [value for value in (name, media.phone_number) if value]
+    elif message.media == MessageMediaType.POLL:
+        details.append(f"{media.question}: {' / '.join(option.text for option in media.options)}")
+    for attribute in ('file_name', 'emoji', 'mime_type'):
+        value = getattr(media, attribute, None)
+        if isinstance(value, str) and value:
+            details.append(value)
+    location = getattr(media, 'location', media)
+    if isinstance(getattr(location, 'latitude', None), float):
+        details.append(f"{location.latitude:.5f}, {location.longitude:.5f}")
+    duration = getattr(media, 'duration', None)
+    if isinstance(duration, int) and duration:
+        details.append(f"{duration // 60}:{duration % 60:02d}")
+    file_size = getattr(media, 'file_size', None)
+    if isinstance(file_size, int) and file_size:
+        details.append(_size(file_size))
+    text = f"[USER] [{kind.upper()}]"
+    if details:
+        text += f" ({', '.join(details)})"
+    if message.caption:
+        text += f" {message.caption}"
+    return text
+
+
+def _in_order(batch):
+    """Put each user's messages in Telegram id order, keeping the slots they arrived in"""
+    slots = {}
+    for index, item in enumerate(batch):
+        slots.setdefault(item[0], []).append(index)
+    ordered = list(batch)
+    for indexes in slots.values():
+        if len(indexes) > 1:
+            for index, item in zip(indexes, sorted((batch[i] for i in indexes), key=lambda item: item[1])):
+                ordered[index] = item
+    return ordered
+
+
+class InboundMessages:
+    """Stores private messages in batches and fans them out, on the bot's event loop.
+
+    `emit(user_id, sender, message)` is called on a worker thread for each
+    stored message, in storage order; `backend` defaults to storage.backend.
+    """
+
+    def __init__(self, emit=None, batch=INBOUND_BATCH, window_ms=INBOUND_BATCH_WINDOW_MS,
+                 queue_size=INBOUND_QUEUE_SIZE, backend=None):
+        self.emit = emit
+        self.batch = batch
+        self.window = window_ms / 1000
+        self.queue_size = queue_size
+        self.backend = backend
+        self._queue = None
+        self._emits = None
+        self._tasks = []
+        self.received = 0
+        self.stored = 0
+        self.failed = 0
+        self.batches = 0
+        self.emit_failures = 0
+
+    def _backend(self):
+        return self.backend or storage.backend
+
+    def _start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._emits = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._writer()), asyncio.create_task(self._emitter())]
+
+    async def handle(self, client, message):
+        """Pyrogram handler for private messages: queue the message and return"""
+        if not self._tasks:
+            self._start()
+        timestamp = timeutil.format_ms(int(message.date.timestamp() * 1000)) if message.date else None
+        self.received += 1
+        await self._queue.put((message.from_user.id, message.id, describe(message), timestamp))
+
+    async def _collect(self):
+        """Wait for one message, then gather more until the window closes or the batch is full"""
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.batch:
+            if self._queue.empty():
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _writer(self):
+        while True:
+            batch = _in_order(await self._collect())
+            rows = [(user_id, 'user', text, timestamp) for user_id, _telegram_id, text, timestamp in batch]
+            try:
+                await asyncio.wrap_future(self._backend().queue_messages(rows))
+            except Exception as e:
+                self.failed += len(rows)
+                print(f"❌ Could not store {len(rows)} incoming messages: {e}")
+            else:
+                self.stored += len(rows)
+                self.batches += 1
+                await self._emits.put(rows)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _emitter(self):
+        while True:
+            rows = await self._emits.get()
+            try:
+                if self.emit is not None:
+                    await asyncio.to_thread(self._emit_rows, rows)
+            finally:
+                self._emits.task_done()
+
+    def _emit_rows(self, rows):
+        for user_id, sender, text, _timestamp in rows:
+            try:
+                self.emit(user_id, sender, text)
+            except Exception as e:
+                self.emit_failures += 1
+                print(f"⚠️ Could not emit incoming message from {user_id}: {e}")
+
+    async def drain(self):
+        """Wait until every queued message has been stored and emitted"""
+        if not self._tasks:
+            return
+        await self._queue.join()
+        await self._emits.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def status(self):
+        return {
+            'running': bool(self._tasks),
+            'queued': self._queue.qsize() if self._queue else 0,
+            'emits_pending': self._emits.qsize() if self._emits else 0,
+            'received': self.received,
+            'stored': self.stored,
+            'failed': self.failed,
+            'batches': self.batches,
+            'avg_batch': round(self.stored / self.batches, 1) if self.batches else 0,
+            'emit_failures': self.emit_failures
+        }
@@ -0,0 +1,147 @@
+"""
+Approval of join requests that piled up while the bot was offline.
+
+approve_and_dm only sees live updates. Listing pending requests is a
+user-only MTProto method, so JoinBacklog lists them with an admin user
+session (BACKLOG_SESSION_STRING) and the bot approves exactly the listed
+ones through the Telegram scheduler. A bulk approve_all would also take
+requests that arrived after the listing, which the live JoinPipeline is
+handling; listed users the pipeline already has in flight are skipped
+and the rest are claimed in it until welcomed. Approved users are then
+upserted in one batched transaction and welcomed by the bot. Without a
+user session the drain is off.
+"""
+
+import asyncio
+import os
+import time
+
+import timeutil
+from join_pipeline import approve_request
+from telegram_scheduler import scheduler as default_scheduler, PRIORITY_WELCOME
+
+# Seconds between drains after the one at startup
+JOIN_BACKLOG_INTERVAL = float(os.environ.get('JOIN_BACKLOG_INTERVAL', 600))
+
+
+class JoinBacklog:
+    """Drains pending join requests for one chat on the bot's event loop.
+
+    persist_users(users) and welcome(bot, user, chat_title) are coroutine
+    functions; user_client_factory() builds the admin user Client and is
+    called on the loop. `pipeline` is the live JoinPipeline, if any.
+    """
+
+    def __init__(self, chat_id, persist_users, welcome, user_client_factory=None,
+                 interval=JOIN_BACKLOG_INTERVAL, scheduler=default_scheduler, pipeline=None):
+        self.chat_id = chat_id
+        self.persist_users = persist_users
+        self.welcome = welcome
+        self.user_client_factory = user_client_factory
+        self.interval = interval
+        self.scheduler = scheduler
+        self.pipeline = pipeline
+        self._user_client = None
+        self._welcomes = set()
+        self._status = {'state': 'pending'}
+        self.drains = 0
+        self.approved = 0
+        self.skipped = 0
+
+    async def run(self, bot):
+        """Drain now and then every `interval` seconds (bot_runtime on_connect hook)"""
+        if self.user_client_factory is None:
+            self._status = {'state': 'disabled', 'reason': 'no user session (BACKLOG_SESSION_STRING)'}
+            return
+        while True:
+            try:
+                await self.drain(bot)
+            except Exception as e:
+                self._status = {'state': 'failed', 'error': str(e)}
+                print(f"❌ Join backlog drain failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _users_client(self):
+        if self._user_client is None:
+            client = self.user_client_factory()
+            await client.start()
+            self._user_client = client
+        return self._user_client
+
+    async def drain(self, bot):
+        """Approve, save and welcome everyone with a pending request; returns how many"""
+        self._status = {'state': 'running'}
+        started = time.perf_counter()
+        user_client = await self._users_client()
+        # 100 requests per round trip
+        users = [joiner.user async for joiner in user_client.get_chat_join_requests(self.chat_id) if joiner.user]
+        if not users:
+            self._status = {'state': 'idle', 'pending': 0, 'seconds': round(time.perf_counter() - started, 2)}
+            return 0
+        listed = time.perf_counter()
+        listed_count = len(users)
+
+        if self.pipeline is not None:
+            users = [user for user in users if self.pipeline.claim(user.id)]
+        claimed = users
+        skipped = listed_count - len(users)
+        welcoming = set()
+        try:
+            results = await asyncio.gather(*[
+                approve_request(bot, self.scheduler, self.chat_id, user.id) for user in users
+            ], return_exceptions=True)
+            for user, result in zip(users, results):
+                if isinstance(result, Exception):
+                    print(f"❌ Backlog approval failed for {user.id}: {result}")
+            withdrawn = sum(1 for result in results if result is False)
+            users = [user for user, result in zip(users, results) if result is True]
+            approved = time.perf_counter()
+
+            if users:
+                await self.persist_users(users)
+            persisted = time.perf_counter()
+
+            chat = await self.scheduler.call(lambda: bot.get_chat(self.chat_id), priority=PRIORITY_WELCOME)
+            for user in users:
+                task = asyncio.create_task(self._welcome(bot, user, chat.title))
+                self._welcomes.add(task)
+                task.add_done_callback(self._welcomes.discard)
+                welcoming.add(user.id)
+        finally:
+            # Users being welcomed are released by _welcome
+            if self.pipeline is not None:
+                for user in claimed:
+                    if user.id not in welcoming:
+                        self.pipeline.release(user.id)
+
+        self.drains += 1
+        self.approved += len(users)
+        self.skipped += skipped
+        self._status = {
+            'state': 'idle',
+            'pending': listed_count,
+            'approved': len(users),
+            'skipped_in_flight': skipped,
+            'withdrawn': withdrawn,
+            'list_seconds': round(listed - started, 2),
+            'approve_seconds': round(approved - listed, 2),
+            'persist_seconds': round(persisted - approved, 2),
+            'seconds': round(persisted - started, 2),
+            'drained_ms': timeutil.now_ms()
+        }
+        print(f"✅ Drained {len(users)} of {listed_count} pending join requests in {persisted - started:.2f}s "
+              f"({skipped} already in flight, {withdrawn} withdrawn); {len(users)} welcome DMs queued")
+        return len(users)
+
+    async def _welcome(self, bot, user, chat_title):
+        try:
+            await self.welcome(bot, user, chat_title)
+        except Exception as e:
+            print(f"❌ Backlog welcome DM failed for {user.id}: {e}")
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.release(user.id)
+
+    def status(self):
+        return dict(self._status, drains=self.drains, approved=self.approved, skipped=self.skipped,
+                    welcomes_pending=len(self._welcomes))
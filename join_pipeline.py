@@ -0,0 +1,219 @@
+"""
+Staged handling of chat join requests.
+
+Each join used to be approved, written to the database, backed up (a full
+file copy) and welcomed inline in the Pyrogram handler, so a join storm
+left approvals waiting behind disk I/O. JoinPipeline splits the work into
+stages joined by bounded queues, each with its own worker count:
+
+    approve   approve_chat_join_request (the latency that users notice)
+    persist   storage write, awaited off the event loop
+    welcome   welcome DM
+
+persist and welcome both start once a request is approved; an approve
+stage that returns False (the request was withdrawn) ends it there.
+Backups are coalesced to at most one per JOIN_BACKUP_INTERVAL seconds. A
+full queue makes the stage before it wait, so a burst can't grow memory
+without bound. A user is in flight from submit() until every stage is done
+with their request; further requests for them are dropped meanwhile, and
+the join backlog (join_backlog.py) claims the users it drains the same way.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.errors import BadRequest, UserAlreadyParticipant, UserNotParticipant
+
+from telegram_scheduler import PRIORITY_APPROVAL
+
+# Concurrent calls per stage
+JOIN_APPROVE_WORKERS = int(os.environ.get('JOIN_APPROVE_WORKERS', 16))
+JOIN_PERSIST_WORKERS = int(os.environ.get('JOIN_PERSIST_WORKERS', 4))
+JOIN_WELCOME_WORKERS = int(os.environ.get('JOIN_WELCOME_WORKERS', 8))
+# Requests waiting per stage before submit() blocks
+JOIN_QUEUE_SIZE = int(os.environ.get('JOIN_QUEUE_SIZE', 10000))
+# Seconds between database backups while joins keep arriving
+JOIN_BACKUP_INTERVAL = float(os.environ.get('JOIN_BACKUP_INTERVAL', 30))
+# Approval latencies kept for the percentiles in status()
+LATENCY_SAMPLES = 10000
+
+
+async def approve_request(client, scheduler, chat_id, user_id):
+    """Approve one join request; True if the user is now in the chat.
+
+    A request that is already gone (HIDE_REQUESTER_MISSING) was approved
+    elsewhere or withdrawn, so membership decides which: False means there
+    is nobody to save or welcome.
+    """
+    try:
+        await scheduler.call(lambda: client.approve_chat_join_request(chat_id, user_id), priority=PRIORITY_APPROVAL)
+    except UserAlreadyParticipant:
+        return True
+    except BadRequest as e:
+        if 'HIDE_REQUESTER_MISSING' not in str(e.value):
+            raise
+        try:
+            member = await scheduler.call(lambda: client.get_chat_member(chat_id, user_id), priority=PRIORITY_APPROVAL)
+        except UserNotParticipant:
+            return False
+        return (member.status in (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.MEMBER)
+                or (member.status == ChatMemberStatus.RESTRICTED and bool(member.is_member)))
+    return True
+
+
+class _Stage:
+    def __init__(self, name, work, workers):
+        self.name = name
+        self.work = work
+        self.workers = workers
+        self.queue = None
+        self.done = 0
+        self.failed = 0
+
+    def status(self):
+        return {
+            'workers': self.workers,
+            'queued': self.queue.qsize() if self.queue else 0,
+            'done': self.done,
+            'failed': self.failed
+        }
+
+
+class JoinPipeline:
+    """approve -> (persist, welcome) for join requests, on the bot's event loop.
+
+    Stage functions are coroutines called as work(client, join_request);
+    `backup` is a blocking function run in an executor. claim(user_id) and
+    release(user_id) let other code mark a user's join as in flight.
+    """
+
+    def __init__(self, approve, persist, welcome, backup=None,
+                 approve_workers=JOIN_APPROVE_WORKERS, persist_workers=JOIN_PERSIST_WORKERS,
+                 welcome_workers=JOIN_WELCOME_WORKERS, queue_size=JOIN_QUEUE_SIZE,
+                 backup_interval=JOIN_BACKUP_INTERVAL):
+        self.approve = _Stage('approve', approve, approve_workers)
+        self.persist = _Stage('persist', persist, persist_workers)
+        self.welcome = _Stage('welcome', welcome, welcome_workers)
+        self.queue_size = queue_size
+        self.backup = backup
+        self.backup_interval = backup_interval
+        self.backups = 0
+        self.withdrawn = 0
+        self.duplicates = 0
+        self._backup_pending = False
+        self._tasks = []
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._in_flight = {}  # user id -> stages still to run for their request
+
+    def _start(self):
+        for stage in (self.approve, self.persist, self.welcome):
+            stage.queue = asyncio.Queue(maxsize=self.queue_size)
+            self._tasks += [asyncio.create_task(self._worker(stage)) for _ in range(stage.workers)]
+        if self.backup is not None:
+            self._tasks.append(asyncio.create_task(self._backup_loop()))
+
+    def claim(self, user_id):
+        """Mark a user's join as in flight; False if it already is"""
+        if user_id in self._in_flight:
+            return False
+        self._in_flight[user_id] = 1
+        return True
+
+    def release(self, user_id):
+        """One stage (or the claimer) is done with a user's join"""
+        remaining = self._in_flight.get(user_id, 1) - 1
+        if remaining > 0:
+            self._in_flight[user_id] = remaining
+        else:
+            self._in_flight.pop(user_id, None)
+
+    async def submit(self, client, join_request):
+        """Queue a join request; returns as soon as it is queued (or waits while the queue is full)"""
+        if not self._tasks:
+            self._start()
+        user_id = join_request.from_user.id
+        if not self.claim(user_id):
+            self.duplicates += 1
+            print(f"⏭️ Join request from {user_id} is already being handled")
+            return
+        await self.approve.queue.put((client, join_request, time.perf_counter()))
+
+    async def _worker(self, stage):
+        while True:
+            client, join_request, received = await stage.queue.get()
+            user_id = join_request.from_user.id
+            try:
+                result = await stage.work(client, join_request)
+            except Exception as e:
+                stage.failed += 1
+                print(f"❌ Join {stage.name} failed for {user_id}: {e}")
+            else:
+                stage.done += 1
+                if stage is self.approve:
+                    self._latencies.append(time.perf_counter() - received)
+                    if result is False:
+                        self.withdrawn += 1
+                        print(f"⏭️ Join request from {user_id} was withdrawn")
+                    else:
+                        self._in_flight[user_id] += 2
+                        await self.persist.queue.put((client, join_request, received))
+                        await self.welcome.queue.put((client, join_request, received))
+                elif stage is self.persist:
+                    self._backup_pending = True
+            finally:
+                self.release(user_id)
+                stage.queue.task_done()
+
+    async def _backup_loop(self):
+        while True:
+            await asyncio.sleep(self.backup_interval)
+            await self.flush_backup()
+
+    async def flush_backup(self):
+        """Run the coalesced backup now if anything was persisted since the last one"""
+        if not self._backup_pending:
+            return
+        self._backup_pending = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.backup)
+            self.backups += 1
+        except Exception as e:
+            print(f"❌ Join backup failed: {e}")
+
+    async def drain(self):
+        """Wait until every queued request has been through all stages"""
+        if not self._tasks:
+            return
+        await self.approve.queue.join()
+        await self.persist.queue.join()
+        await self.welcome.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def latency_ms(self, percentile):
+        """Approval latency percentile (0-100) over recent requests, in ms"""
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return round(ordered[index] * 1000, 1)
+
+    def status(self):
+        return {
+            'approve': self.approve.status(),
+            'persist': self.persist.status(),
+            'welcome': self.welcome.status(),
+            'backups': self.backups,
+            'withdrawn': self.withdrawn,
+            'duplicates': self.duplicates,
+            'in_flight': len(self._in_flight),
+            'approval_p50_ms': self.latency_ms(50),
+            'approval_p99_ms': self.latency_ms(99)
+        }
@@ -0,0 +1,163 @@
+import os
+import threading
+from collections import OrderedDict
+
+import timeutil
+from db_writer import writer
+
+# Conversations kept in memory, and history pages kept per conversation
+CACHE_USERS = int(os.environ.get('MESSAGE_CACHE_USERS', 500))
+PAGES_PER_USER = int(os.environ.get('MESSAGE_CACHE_PAGES_PER_USER', 8))
+# The listener's result set grows with every new message; re-subscribe this often
+WATCH_ROTATE_SECONDS = float(os.environ.get('MESSAGE_CACHE_WATCH_ROTATE_SECONDS', 3600))
+
+
+class MessageCache:
+    """Read-through LRU of chat history pages, keyed by user.
+
+    Entries are dropped when a message for that user is committed locally
+    (db.insert_message -> note_write, applied after the commit) or written
+    to Firestore by any instance (on_snapshot listener on new messages), so
+    instances stay coherent without re-querying.
+    """
+
+    def __init__(self, max_users=CACHE_USERS, pages_per_user=PAGES_PER_USER):
+        self.max_users = max_users
+        self.pages_per_user = pages_per_user
+        self._entries = OrderedDict()  # user_id -> OrderedDict(page key -> (messages, has_more))
+        self._lock = threading.Lock()
+        self._loading = {}     # user_id -> loads in flight
+        self._stale = set()    # users invalidated while a load was in flight
+        self._pending = set()  # users written in the current writer batch
+        self._watch = None
+        self._watch_thread = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+
+    def get_page(self, user_id, key, load):
+        """Cached page `key` for `user_id`, calling load() -> (messages, has_more) on a miss"""
+        with self._lock:
+            pages = self._entries.get(user_id)
+            if pages is not None and key in pages:
+                self._entries.move_to_end(user_id)
+                pages.move_to_end(key)
+                self.hits += 1
+                return pages[key]
+            self.misses += 1
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+
+        result = None
+        try:
+            result = load()
+            return result
+        finally:
+            with self._lock:
+                self._loading[user_id] -= 1
+                stale = user_id in self._stale
+                if not self._loading[user_id]:
+                    del self._loading[user_id]
+                    self._stale.discard(user_id)
+                # Don't cache failures or pages that were outdated before they arrived
+                if result is not None and not stale:
+                    self._store(user_id, key, result)
+
+    def _store(self, user_id, key, result):
+        pages = self._entries.setdefault(user_id, OrderedDict())
+        self._entries.move_to_end(user_id)
+        pages[key] = result
+        if len(pages) > self.pages_per_user:
+            pages.popitem(last=False)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id, remote=False):
+        with self._lock:
+            if user_id in self._loading:
+                self._stale.add(user_id)
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+                if remote:
+                    self.remote_invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._stale.update(self._loading)
+            self._entries.clear()
+
+    # --- local writes ---
+
+    def note_write(self, user_id):
+        """Called inside the write transaction; the entry is dropped once it commits"""
+        with self._lock:
+            self._pending.add(user_id)
+
+    def _flush_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        for user_id in pending:
+            self.invalidate(user_id)
+
+    # --- Firestore change feed ---
+
+    def start_watch(self, firebase_available):
+        """Subscribe to Firestore message writes (no-op without Firebase)"""
+        if not firebase_available or self._watch_thread:
+            return
+        self._subscribe()
+        self._watch_thread = threading.Thread(target=self._rotate, name='message-cache-watch', daemon=True)
+        self._watch_thread.start()
+
+    def _subscribe(self):
+        import firebase_config
+
+        # Overlap the previous subscription a little so no write falls in between
+        since_ms = timeutil.now_ms() - 60_000
+        watch = firebase_config.watch_new_messages(since_ms, self._on_snapshot)
+        old, self._watch = self._watch, watch
+        if old is not None:
+            old.unsubscribe()
+
+    def _rotate(self):
+        while not self._stop.wait(WATCH_ROTATE_SECONDS):
+            try:
+                self._subscribe()
+            except Exception as e:
+                print(f"⚠️ Message cache listener re-subscribe failed: {e}")
+
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            data = change.document.to_dict() or {}
+            if data.get('user_id') is not None:
+                self.invalidate(data['user_id'], remote=True)
+
+    def stop_watch(self):
+        self._stop.set()
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def status(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._entries),
+                'pages': sum(len(pages) for pages in self._entries.values()),
+                'max_users': self.max_users,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'remote_invalidations': self.remote_invalidations,
+                'listening': self._watch is not None
+            }
+
+
+# Shared cache used by db.py and api_simple.py
+cache = MessageCache()
+writer.on_commit(cache._flush_pending)
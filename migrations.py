@@ -0,0 +1,302 @@
+import datetime
+
+import db_pool
+import timeutil
+
+
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        username TEXT,
+        join_date TEXT,
+        invite_link TEXT,
+        photo_url TEXT,
+        label TEXT
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        sender TEXT,
+        message TEXT,
+        timestamp TEXT
+    )''')
+
+
+def _add_hot_query_indexes(conn):
+    # Chat history: WHERE user_id = ? ORDER BY id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON messages (user_id, id)')
+    # Active users and recent-message feeds: range/sort on timestamp
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+    # Dashboard user list: ORDER BY join_date DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)')
+
+
+def _add_epoch_ms_columns(conn):
+    conn.execute('ALTER TABLE messages ADD COLUMN ts_ms INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN join_ts_ms INTEGER')
+    # Backfill with the same parser the application uses for local timestamps
+    conn.create_function('ts_to_ms', 1, timeutil.to_ms, deterministic=True)
+    conn.execute('UPDATE messages SET ts_ms = ts_to_ms(timestamp) WHERE ts_ms IS NULL')
+    conn.execute('UPDATE users SET join_ts_ms = ts_to_ms(join_date) WHERE join_ts_ms IS NULL')
+    # Numeric indexes replace the TEXT ones
+    conn.execute('DROP INDEX IF EXISTS idx_messages_timestamp')
+    conn.execute('DROP INDEX IF EXISTS idx_users_join_date')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts_ms ON messages (ts_ms)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_join_ts_ms ON users (join_ts_ms)')
+
+
+def _add_user_activity_index(conn):
+    # Per-user message count / last activity / online checks
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id_ts_ms ON messages (user_id, ts_ms)')
+
+
+def _create_conversations(conn):
+    # Per-user inbox summary, maintained by db.insert_message in the same
+    # transaction as the message row itself
+    conn.execute('''CREATE TABLE IF NOT EXISTS conversations (
+        user_id INTEGER PRIMARY KEY,
+        last_message_id INTEGER,
+        last_message TEXT,
+        last_sender TEXT,
+        last_ts_ms INTEGER NOT NULL DEFAULT 0,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        unread_count INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_last_ts ON conversations (last_ts_ms, user_id)')
+    conn.execute('''
+        INSERT OR REPLACE INTO conversations (user_id, last_message_id, message_count)
+        SELECT user_id, MAX(id), COUNT(*) FROM messages WHERE user_id IS NOT NULL GROUP BY user_id
+    ''')
+    conn.execute('''
+        UPDATE conversations SET (last_message, last_sender, last_ts_ms) = (
+            SELECT message, sender, COALESCE(ts_ms, 0) FROM messages WHERE id = conversations.last_message_id
+        )
+    ''')
+    # User messages since the admin last replied count as unread
+    conn.execute('''
+        UPDATE conversations SET unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.user_id = conversations.user_id AND m.sender = 'user'
+              AND m.id > COALESCE((SELECT MAX(id) FROM messages a
+                                   WHERE a.user_id = conversations.user_id AND a.sender = 'admin'), 0)
+        )
+    ''')
+
+
+def _create_stats_tables(conn):
+    # Running totals and per-day join counts, bumped by db.py in the same
+    # transaction as the row they count (read through stats.py)
+    conn.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS daily_joins (
+        day TEXT PRIMARY KEY,
+        joins INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'total_users', COUNT(*) FROM users")
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'total_messages', COUNT(*) FROM messages")
+    conn.execute('''
+        INSERT OR REPLACE INTO daily_joins (day, joins)
+        SELECT date(join_ts_ms / 1000, 'unixepoch', 'localtime'), COUNT(*) FROM users
+        WHERE join_ts_ms IS NOT NULL GROUP BY 1
+    ''')
+
+
+def _create_migration_checkpoints(conn):
+    # Resume points for firebase_migrator: every row with key <= last_key is copied
+    conn.execute('''CREATE TABLE IF NOT EXISTS migration_checkpoints (
+        name TEXT PRIMARY KEY,
+        last_key INTEGER NOT NULL DEFAULT 0,
+        rows_copied INTEGER NOT NULL DEFAULT 0,
+        updated_ms INTEGER
+    )''')
+
+
+def _create_outbox(conn):
+    # Firestore writes waiting for replicator.py, queued in the same
+    # transaction as the SQLite change they mirror
+    conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_ms INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    )''')
+
+
+def _create_deliveries(conn):
+    # Outbound Telegram messages: the message row carries the latest status,
+    # deliveries holds what is still to be sent (delivery.py)
+    conn.execute('ALTER TABLE messages ADD COLUMN delivery_status TEXT')
+    conn.execute('''CREATE TABLE IF NOT EXISTS deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        created_ms INTEGER NOT NULL,
+        next_attempt_ms INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_next_attempt ON deliveries (next_attempt_ms)')
+
+
+def _add_delivery_error(conn):
+    # The delivery row is dropped once a message is sent or given up on,
+    # so the last error is kept with the message's status
+    conn.execute('ALTER TABLE messages ADD COLUMN delivery_error TEXT')
+
+
+# Ordered schema steps. Never edit a released step; append a new one instead.
+MIGRATIONS = [
+    (1, 'create users and messages tables', _create_base_tables),
+    (2, 'index messages(user_id, id), messages(timestamp), users(join_date)', _add_hot_query_indexes),
+    (3, 'epoch ms columns messages.ts_ms and users.join_ts_ms', _add_epoch_ms_columns),
+    (4, 'index messages(user_id, ts_ms)', _add_user_activity_index),
+    (5, 'conversations summary table', _create_conversations),
+    (6, 'stats_counters and daily_joins rollups', _create_stats_tables),
+    (7, 'migration_checkpoints for the Firestore migrator', _create_migration_checkpoints),
+    (8, 'outbox for asynchronous Firestore replication', _create_outbox),
+    (9, 'messages.delivery_status and the deliveries queue', _create_deliveries),
+    (10, 'messages.delivery_error', _add_delivery_error),
+]
+
+
+def current_version(conn):
+    """Return the highest applied schema version (0 for a fresh or legacy database)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate():
+    """Apply every pending migration in order, one transaction per step"""
+    with db_pool.connection() as conn:
+        if conn.in_transaction:
+            conn.commit()
+        version = current_version(conn)
+        for step, description, apply in MIGRATIONS:
+            if step <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                apply(conn)
+                conn.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                             (step, description, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            version = step
+            print(f"🧱 Applied migration {step}: {description}")
+        return version
+
+
+def conversations_page_sql(after_cursor=False, unread=False):
+    """The /conversations inbox query; parameters are (cursor_ts, cursor_user,) limit.
+
+    Built here so verify_query_plans() checks the SQL the endpoint runs.
+    """
+    conditions = []
+    if after_cursor:
+        conditions.append('(c.last_ts_ms, c.user_id) < (?, ?)')
+    if unread:
+        conditions.append('c.unread_count > 0')
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'''
+        SELECT c.user_id, c.last_message_id, c.last_message, c.last_sender, c.last_ts_ms,
+               c.message_count, c.unread_count, u.full_name, u.username, u.photo_url, u.label
+        FROM conversations c LEFT JOIN users u ON u.user_id = c.user_id
+        {where_sql}
+        ORDER BY c.last_ts_ms DESC, c.user_id DESC
+        LIMIT ?
+    '''
+
+
+# Queries on the request path that must be served from an index.
+# Keep these in sync with the SQL in api_simple.py.
+HOT_QUERIES = {
+    'messages_for_user': (
+        'SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+        'WHERE user_id = ? ORDER BY id DESC LIMIT ?',
+        (0, 100)),
+    'messages_before_id': (
+        'SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+        'WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+        (0, 0, 100)),
+    'messages_after_id': (
+        'SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+        'WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?',
+        (0, 0, 100)),
+    'messages_since_ts': (
+        'SELECT id, sender, message, ts_ms, timestamp, delivery_status, delivery_error FROM messages '
+        'WHERE user_id = ? AND (ts_ms, id) > (?, ?) ORDER BY ts_ms ASC, id ASC LIMIT ?',
+        (0, 0, 0, 500)),
+    'user_online_status': (
+        'SELECT 1 FROM messages WHERE user_id = ? AND ts_ms >= ? LIMIT 1',
+        (0, 0)),
+    'active_users': (
+        'SELECT COUNT(*) FROM conversations WHERE last_ts_ms >= ?',
+        (0,)),
+    'joins_on_day': (
+        'SELECT joins FROM daily_joins WHERE day = ?',
+        ('1970-01-01',)),
+    'recent_messages': (
+        'SELECT user_id, sender, message, ts_ms, timestamp FROM messages ORDER BY ts_ms DESC LIMIT 100',
+        ()),
+    'admin_messages': (
+        'SELECT m.user_id, m.sender, m.message, m.ts_ms, m.timestamp, u.full_name, u.username FROM messages m '
+        'LEFT JOIN users u ON m.user_id = u.user_id ORDER BY m.ts_ms DESC LIMIT 100',
+        ()),
+    'user_message_count': (
+        'SELECT COUNT(*) FROM messages WHERE user_id = ?',
+        (0,)),
+    'user_last_activity': (
+        'SELECT MAX(ts_ms) FROM messages WHERE user_id = ?',
+        (0,)),
+    'conversations_first_page': (conversations_page_sql(), (51,)),
+    'conversations_page': (conversations_page_sql(after_cursor=True), (0, 0, 51)),
+    'conversations_unread_page': (conversations_page_sql(after_cursor=True, unread=True), (0, 0, 51)),
+    'due_deliveries': (
+        'SELECT id, message_id, user_id, text, attempts FROM deliveries WHERE next_attempt_ms <= ? '
+        'ORDER BY next_attempt_ms, id LIMIT ?',
+        (0, 100)),
+    'dashboard_users': (
+        'SELECT user_id, full_name, username, join_ts_ms, join_date, invite_link, photo_url, label FROM users '
+        'ORDER BY join_ts_ms DESC LIMIT ? OFFSET ?',
+        (10, 0)),
+}
+
+
+def explain(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+
+
+def _plan_uses_index(plan):
+    for detail in plan:
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            return False
+        # A temp b-tree for DISTINCT is fine; one for sorting means the index missed
+        if 'TEMP B-TREE FOR ORDER BY' in detail:
+            return False
+    return True
+
+
+def verify_query_plans():
+    """Check every hot query against EXPLAIN QUERY PLAN; returns {name: {...}}"""
+    report = {}
+    with db_pool.connection() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            plan = explain(conn, sql, params)
+            uses_index = _plan_uses_index(plan)
+            report[name] = {'uses_index': uses_index, 'plan': plan}
+            if not uses_index:
+                print(f"⚠️ Query '{name}' is not index-backed: {' | '.join(plan)}")
+    return report
@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+
+import db_pool
+import timeutil
+from db_writer import writer, WRITE_TIMEOUT
+
+# Events per Firestore batch (a user or message event is up to 3 writes; the limit is 500)
+BATCH_SIZE = int(os.environ.get('REPLICATION_BATCH_SIZE', 150))
+POLL_INTERVAL = float(os.environ.get('REPLICATION_POLL_SECONDS', 1))
+MAX_BACKOFF = 60
+# Events that fail this often are parked and reported instead of retried
+MAX_ATTEMPTS = int(os.environ.get('REPLICATION_MAX_ATTEMPTS', 10))
+
+# Set by api_simple.py once Firebase is initialized; while False nothing is queued
+ENABLED = False
+
+
+def enqueue(conn, kind, payload):
+    """Queue a Firestore write in the caller's transaction (no-op when replication is off)"""
+    if not ENABLED:
+        return
+    conn.execute('INSERT INTO outbox (kind, payload, created_ms) VALUES (?, ?, ?)',
+                 (kind, json.dumps(payload), timeutil.now_ms()))
+
+
+class Replicator:
+    """Background thread that drains the outbox into Firestore in order.
+
+    Woken by every committed write batch, it sends up to `batch_size` events
+    per Firestore batch and deletes them once committed. On failure it backs
+    off exponentially and drops to one event per batch, so a bad event gets
+    isolated (and parked after MAX_ATTEMPTS) without holding back the rest.
+    A message whose id is taken by a different Firestore document is
+    parked straight away (see FirestoreDAO.apply_events).
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self._limit = batch_size
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.backoff = 0
+        self.replicated = 0
+        self.batches = 0
+        self.failures = 0
+        self.conflicts = 0
+        self.last_error = None
+        self.last_success_ms = None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='firestore-replicator', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping:
+            if self.backoff:
+                # New commits must not cut a backoff short
+                time.sleep(self.backoff)
+            else:
+                self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                while not self._stopping and self.drain_once():
+                    pass
+            except Exception as e:
+                print(f"❌ Replicator error: {e}")
+
+    def drain_once(self):
+        """Send one batch; True if there may be more to send right away"""
+        import firebase_config
+        from firestore_dao import MessageIdConflict
+
+        limit = self._limit
+        with db_pool.connection() as conn:
+            rows = conn.execute('SELECT id, kind, payload FROM outbox WHERE attempts < ? ORDER BY id LIMIT ?',
+                                (MAX_ATTEMPTS, limit)).fetchall()
+        if not rows:
+            return False
+
+        ids = [row[0] for row in rows]
+        try:
+            firebase_config.replicate_events([(kind, json.loads(payload)) for _id, kind, payload in rows])
+        except MessageIdConflict as e:
+            # Retrying can't help: keep what was applied, park the clash and go on with the rest
+            self.conflicts += 1
+            self.last_error = str(e)
+            writer.submit(_park_conflict, ids[:e.index], ids[e.index], str(e)).result(timeout=WRITE_TIMEOUT)
+            self.replicated += e.index
+            print(f"❌ Replication conflict, event parked: {e}")
+            return True
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            self.backoff = min(max(self.backoff * 2, 1), MAX_BACKOFF)
+            self._limit = 1
+            writer.submit(_record_failure, ids, str(e)).result(timeout=WRITE_TIMEOUT)
+            print(f"⚠️ Replication of {len(ids)} events failed, retrying in {self.backoff}s: {e}")
+            return False
+
+        writer.submit(_delete_events, ids).result(timeout=WRITE_TIMEOUT)
+        self.replicated += len(ids)
+        self.batches += 1
+        self.backoff = 0
+        self._limit = min(self._limit * 2, self.batch_size)
+        self.last_success_ms = timeutil.now_ms()
+        return len(rows) == limit
+
+    def status(self):
+        with db_pool.connection() as conn:
+            pending, oldest_ms = conn.execute(
+                'SELECT COUNT(*), MIN(created_ms) FROM outbox WHERE attempts < ?', (MAX_ATTEMPTS,)).fetchone()
+            parked = conn.execute('SELECT COUNT(*) FROM outbox WHERE attempts >= ?', (MAX_ATTEMPTS,)).fetchone()[0]
+        return {
+            'enabled': ENABLED,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'pending': pending,
+            'parked': parked,
+            'lag_ms': timeutil.now_ms() - oldest_ms if oldest_ms else 0,
+            'replicated': self.replicated,
+            'batches': self.batches,
+            'failures': self.failures,
+            'conflicts': self.conflicts,
+            'backoff_seconds': self.backoff,
+            'last_error': self.last_error,
+            'last_success_ms': self.last_success_ms
+        }
+
+
+def _delete_events(conn, ids):
+    conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+
+def _park_conflict(conn, applied_ids, conflict_id, error):
+    _delete_events(conn, applied_ids)
+    conn.execute('UPDATE outbox SET attempts = ?, last_error = ? WHERE id = ?', (MAX_ATTEMPTS, error, conflict_id))
+
+def _record_failure(conn, ids, error):
+    conn.executemany('UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                     [(error, i) for i in ids])
+
+
+# Shared replicator used by api_simple.py
+worker = Replicator()
+writer.on_commit(worker.notify)
+
+
+def configure(enabled):
+    """Turn outbox replication on or off; starts the replicator when on"""
+    global ENABLED
+    ENABLED = bool(enabled)
+    if ENABLED:
+        worker.start()
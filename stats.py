@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+import db_pool
+import timeutil
+from db_writer import writer
+
+# How long a computed snapshot is served before the next read refreshes it
+STATS_TTL = float(os.environ.get('STATS_TTL_SECONDS', 5))
+ACTIVE_MINUTES = 60
+# Push cadence for stats_update, and how often to recheck with no writes
+# (active_users still decays as conversations age out of the window)
+PUSH_INTERVAL = float(os.environ.get('STATS_PUSH_INTERVAL_SECONDS', 2))
+IDLE_REFRESH = float(os.environ.get('STATS_IDLE_REFRESH_SECONDS', 60))
+STAT_KEYS = ('total_users', 'active_users', 'total_messages', 'new_joins_today')
+
+
+# --- Write side: called by db.py inside the writer's transaction ---
+
+def bump(conn, name, amount=1):
+    """Add `amount` to a running counter"""
+    conn.execute('''
+        INSERT INTO stats_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', (name, amount))
+
+def record_message(conn):
+    bump(conn, 'total_messages')
+
+def record_join(conn, join_ts_ms):
+    """Count a newly inserted user and roll it into its day's join total"""
+    bump(conn, 'total_users')
+    if join_ts_ms is not None:
+        conn.execute('''
+            INSERT INTO daily_joins (day, joins) VALUES (?, 1)
+            ON CONFLICT(day) DO UPDATE SET joins = joins + 1
+        ''', (timeutil.day_key(join_ts_ms),))
+
+def rebuild(conn):
+    """Recount every rollup from the base tables (after bulk loads that skip record_*)"""
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'total_users', COUNT(*) FROM users")
+    conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'total_messages', COUNT(*) FROM messages")
+    conn.execute('DELETE FROM daily_joins')
+    conn.execute('''
+        INSERT INTO daily_joins (day, joins)
+        SELECT date(join_ts_ms / 1000, 'unixepoch', 'localtime'), COUNT(*) FROM users
+        WHERE join_ts_ms IS NOT NULL GROUP BY 1
+    ''')
+
+
+# --- Read side: TTL-cached snapshot for /dashboard-stats ---
+
+class StatsCache:
+    """Dashboard counters read from the rollup tables at most once per TTL"""
+
+    def __init__(self, ttl=STATS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._expires = 0.0
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self):
+        """Return the current stats dict, refreshing it if the TTL has passed"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._expires:
+            self.hits += 1
+            return snapshot
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            if self._snapshot is None or time.monotonic() >= self._expires:
+                self._snapshot = self._compute()
+                self._expires = time.monotonic() + self.ttl
+                self.refreshes += 1
+            return self._snapshot
+
+    def invalidate(self):
+        """Force the next read to recompute (e.g. after a restore)"""
+        self._expires = 0.0
+
+    def _compute(self):
+        with db_pool.connection() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM stats_counters').fetchall())
+            # conversations.last_ts_ms is the newest message per user, so this
+            # matches COUNT(DISTINCT user_id) over recent messages
+            active_users = conn.execute('SELECT COUNT(*) FROM conversations WHERE last_ts_ms >= ?',
+                                        (timeutil.minutes_ago_ms(ACTIVE_MINUTES),)).fetchone()[0]
+            row = conn.execute('SELECT joins FROM daily_joins WHERE day = ?', (timeutil.day_key(),)).fetchone()
+        return {
+            'total_users': counters.get('total_users', 0),
+            'active_users': active_users,
+            'total_messages': counters.get('total_messages', 0),
+            'new_joins_today': row[0] if row else 0,
+            'computed_at': timeutil.now_ms()
+        }
+
+    def status(self):
+        return {
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'refreshes': self.refreshes,
+            'age_ms': timeutil.now_ms() - self._snapshot['computed_at'] if self._snapshot else None
+        }
+
+
+class StatsBroadcaster:
+    """Pushes stats_update deltas to the admin room from one background task.
+
+    Committed write batches only set a dirty flag; the task recomputes at
+    most once per interval while admins are connected, so the cost follows
+    the write rate rather than the number of open dashboards.
+    """
+
+    def __init__(self, cache, interval=PUSH_INTERVAL, idle_refresh=IDLE_REFRESH, room='admin_room'):
+        self.cache = cache
+        self.interval = interval
+        self.idle_refresh = idle_refresh
+        self.room = room
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._admins = set()
+        self._dirty = True
+        self._started = False
+        self._last = {}
+        self._last_computed = 0.0
+        self.version = 0
+        self.pushes = 0
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def admin_joined(self, socketio, sid):
+        """Register an admin connection and start the push task on first use"""
+        with self._lock:
+            self.socketio = socketio
+            self._admins.add(sid)
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+
+    def admin_left(self, sid):
+        with self._lock:
+            self._admins.discard(sid)
+
+    def full_update(self):
+        """Complete payload for a newly joined admin"""
+        snapshot = self.cache.get()
+        current = {key: snapshot[key] for key in STAT_KEYS}
+        if not self._last:
+            # First admin: this is the baseline later deltas are diffed against
+            self._last = dict(current)
+        return {'version': self.version, 'full': True, 'changes': current}
+
+    def tick(self):
+        """Recompute if something changed and return the delta payload (or None)"""
+        now = time.monotonic()
+        if not self._dirty and now - self._last_computed < self.idle_refresh:
+            return None
+        self._dirty = False
+        self._last_computed = now
+        self.cache.invalidate()
+        snapshot = self.cache.get()
+        changes = {key: snapshot[key] for key in STAT_KEYS if self._last.get(key) != snapshot[key]}
+        self._last = {key: snapshot[key] for key in STAT_KEYS}
+        if not changes:
+            return None
+        self.version += 1
+        return {'version': self.version, 'full': False, 'changes': changes}
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            if not self._admins:
+                continue
+            try:
+                payload = self.tick()
+                if payload:
+                    self.socketio.emit('stats_update', payload, room=self.room)
+                    self.pushes += 1
+            except Exception as e:
+                print(f"❌ Stats broadcast failed: {e}")
+
+    def status(self):
+        return {
+            'admins': len(self._admins),
+            'interval_seconds': self.interval,
+            'version': self.version,
+            'pushes': self.pushes
+        }
+
+
+# Shared cache and broadcaster used by api_simple.py
+cache = StatsCache()
+broadcaster = StatsBroadcaster(cache)
+writer.on_commit(broadcaster.mark_dirty)
+
+def get_stats():
+    return cache.get()
@@ -0,0 +1,475 @@
+"""
+Storage backends behind one interface.
+
+Storage is the contract the API layer codes against: users, labels,
+messages (keyset pages and delta sync) and dashboard stats. Three engines
+implement it:
+
+    sqlite     local database, group-committed writes, replicated to
+               Firestore through the outbox; older history is read from
+               Firestore when it is not local (default)
+    firestore  Firestore only, through firestore_dao
+    memory     dicts in this process (benchmarks, offline runs)
+
+The engine is picked with STORAGE_BACKEND and created by configure().
+"""
+
+import bisect
+import datetime
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import db_pool
+import hydrator
+import message_cache
+import stats
+import timeutil
+from db_writer import writer, WRITE_TIMEOUT
+
+BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+# Last three digits of every Firestore-backend message id, so instances
+# writing to one project never pick the same id (0-999; random if unset)
+FIRESTORE_INSTANCE_ID = int(os.environ.get('FIRESTORE_INSTANCE_ID', random.randrange(1000))) % 1000
+
+# Backends without their own write queue run queue_* calls on this pool
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='storage')
+
+
+class Storage:
+    """Interface shared by every backend.
+
+    Messages are (id, sender, message, timestamp, delivery_status,
+    delivery_error) for pages and (id, sender, message, timestamp, ts_ms,
+    delivery_status, delivery_error) for delta sync; users are
+    (user_id, full_name, username, join_date, invite_link, photo_url, label).
+    """
+
+    name = None
+    # Set to a message_cache.MessageCache to serve repeated page reads from memory
+    page_cache = None
+
+    # --- users and labels ---
+
+    def add_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        """Insert a user (or refresh invite_link/photo_url of an existing one)"""
+        raise NotImplementedError
+
+    def queue_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        """add_user without waiting; returns a concurrent.futures.Future"""
+        return _executor.submit(self.add_user, user_id, full_name, username, join_date, invite_link, photo_url)
+
+    def queue_users(self, rows):
+        """add_user for many (user_id, full_name, username, join_date, invite_link, photo_url) rows,
+        batched where the engine allows; returns a concurrent.futures.Future"""
+        return _executor.submit(lambda: [self.add_user(*row) for row in rows])
+
+    def get_user(self, user_id):
+        """User fields as a dict, or None"""
+        raise NotImplementedError
+
+    def get_all_users(self):
+        raise NotImplementedError
+
+    def set_user_label(self, user_id, label):
+        raise NotImplementedError
+
+    # --- messages ---
+
+    def save_message(self, user_id, sender, message, timestamp=None):
+        """Store a message and return its id"""
+        raise NotImplementedError
+
+    def queue_message(self, user_id, sender, message, timestamp=None):
+        """save_message without waiting; the Future yields the message id"""
+        return _executor.submit(self.save_message, user_id, sender, message, timestamp)
+
+    def queue_messages(self, rows):
+        """save_message for many (user_id, sender, message, timestamp) rows in order, batched where
+        the engine allows; the Future yields the message ids"""
+        return _executor.submit(lambda: [self.save_message(*row) for row in rows])
+
+    # --- outbound Telegram messages (delivery.py) ---
+
+    def queue_outbound_message(self, user_id, message):
+        """Store an admin message and queue its Telegram delivery; the Future yields the message id"""
+        def save():
+            message_id = self.save_message(user_id, 'admin', message)
+            self.set_delivery_status(message_id, user_id, 'queued')
+            db.queue_delivery(message_id, user_id, message).result(timeout=WRITE_TIMEOUT)
+            return message_id
+        return _executor.submit(save)
+
+    def set_delivery_status(self, message_id, user_id, status, error=None):
+        """Write a message's delivery_status (queued, retrying, sent or failed) and last delivery error"""
+        raise NotImplementedError
+
+    def record_delivery(self, delivery, status, error=None, retry_at_ms=None):
+        """Reschedule (retry_at_ms) or drop a (id, message_id, user_id, ...) delivery and set its status"""
+        delivery_id, message_id, user_id = delivery[:3]
+        db.queue_delivery_result(delivery_id, None, user_id, status, error, retry_at_ms).result(timeout=WRITE_TIMEOUT)
+        self.set_delivery_status(message_id, user_id, status, error)
+
+    def get_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        """Keyset page, newest first: (messages, has_more), rows as in db.get_message_page"""
+        if self.page_cache is None:
+            return self.load_message_page(user_id, limit, before_id, after_id)
+        return self.page_cache.get_page(user_id, (limit, before_id, after_id),
+                                        lambda: self.load_message_page(user_id, limit, before_id, after_id))
+
+    def load_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        """Uncached get_message_page"""
+        raise NotImplementedError
+
+    def get_messages_since(self, user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+        """Messages after a high-water mark, oldest first: (messages, has_more).
+        The ts mark and the rows are as in db.get_messages_since"""
+        raise NotImplementedError
+
+    # --- stats ---
+
+    def get_stats(self):
+        """Dict with total_users, active_users, total_messages and new_joins_today"""
+        raise NotImplementedError
+
+    def status(self):
+        return {'backend': self.name, 'page_cache': self.page_cache is not None}
+
+
+class SQLiteStorage(Storage):
+    """The local database (db.py); batching comes from the group-commit writer
+    and stats from the incrementally maintained rollups.
+
+    With an `archive` (the Firestore backend), a history page that runs out
+    locally is completed from it: hydration only copies recent messages, so
+    older ones may exist only in Firestore. The archive is only asked when
+    the oldest local message is inside the hydration window, and not again
+    for a user once it had nothing older. Newer pages and delta sync are
+    always answered locally, since every write lands here first.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, archive=None, page_cache=None):
+        self.archive = archive
+        self.page_cache = page_cache
+        self._archive_exhausted = set()  # users with nothing older in the archive
+
+    def add_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        try:
+            self.queue_user(user_id, full_name, username, join_date, invite_link, photo_url).result(timeout=WRITE_TIMEOUT)
+            print(f"✅ User saved: {user_id} - {full_name}")
+            return True
+        except Exception as e:
+            print(f"❌ DB error (add_user): {e}")
+            return False
+
+    def queue_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        return db.queue_user(user_id, full_name, username, join_date, invite_link, photo_url)
+
+    def queue_users(self, rows):
+        # One writer transaction for the whole batch
+        return db.queue_users([tuple(row) + (None,) * (6 - len(row)) for row in rows])
+
+    def get_user(self, user_id):
+        with db_pool.connection() as conn:
+            row = conn.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label '
+                               'FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('user_id', 'full_name', 'username', 'join_date', 'invite_link', 'photo_url', 'label'), row))
+
+    def get_all_users(self):
+        with db_pool.connection() as conn:
+            return conn.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label '
+                                'FROM users').fetchall()
+
+    def set_user_label(self, user_id, label):
+        db.set_user_label(user_id, label)
+
+    def save_message(self, user_id, sender, message, timestamp=None):
+        return self.queue_message(user_id, sender, message, timestamp).result(timeout=WRITE_TIMEOUT)
+
+    def queue_message(self, user_id, sender, message, timestamp=None):
+        return db.queue_message(user_id, sender, message, timestamp)
+
+    def queue_messages(self, rows):
+        # One writer transaction for the whole batch
+        return db.queue_messages(rows)
+
+    def load_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        messages, has_more = db.get_message_page(user_id, limit, before_id, after_id)
+        if after_id is not None or has_more or not self._archive_may_have_older(user_id, messages):
+            return messages, has_more
+        if len(messages) == limit:
+            # Local history ends here; let the next page ask the archive
+            return messages, True
+        try:
+            older_than = messages[-1][0] if messages else before_id
+            older, has_more = self.archive.load_message_page(user_id, limit - len(messages), older_than)
+            if not older:
+                self._archive_exhausted.add(user_id)
+            messages = messages + older
+        except Exception as e:
+            print(f"⚠️ Could not read older messages for user {user_id} from the archive: {e}")
+        return messages, has_more
+
+    def _archive_may_have_older(self, user_id, messages):
+        """Whether history older than the last row of `messages` (a page that ran out
+        locally) could be in the archive"""
+        if self.archive is None or user_id in self._archive_exhausted:
+            return False
+        if not messages:
+            return True
+        # Only hydration leaves history cut short, at HYDRATE_MESSAGE_DAYS
+        oldest_ms = timeutil.to_ms(messages[-1][3])
+        return oldest_ms is None or oldest_ms >= timeutil.minutes_ago_ms(hydrator.HYDRATE_MESSAGE_DAYS * 24 * 60)
+
+    def get_messages_since(self, user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+        return db.get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)
+
+    def queue_outbound_message(self, user_id, message):
+        # Message and delivery commit together, so neither can exist without the other
+        return db.queue_outbound_message(user_id, message)
+
+    def set_delivery_status(self, message_id, user_id, status, error=None):
+        writer.submit(db.set_delivery_status, message_id, user_id, status, error).result(timeout=WRITE_TIMEOUT)
+
+    def record_delivery(self, delivery, status, error=None, retry_at_ms=None):
+        delivery_id, message_id, user_id = delivery[:3]
+        db.queue_delivery_result(delivery_id, message_id, user_id, status, error, retry_at_ms).result(timeout=WRITE_TIMEOUT)
+
+    def get_stats(self):
+        return stats.get_stats()
+
+
+class FirestoreStorage(Storage):
+    """Firestore only. Each write is one atomic batch with its counter
+    increments (FirestoreDAO.apply_events); counts use cached count()
+    aggregations and pages go through the listener-invalidated page cache.
+    """
+
+    name = 'firestore'
+
+    def __init__(self, page_cache=None):
+        self.page_cache = page_cache
+        self._id_lock = threading.Lock()
+        self._last_id = 0
+
+    def _dao(self):
+        import firestore_dao
+        return firestore_dao.dao()
+
+    def _next_message_id(self):
+        # Time-ordered ids (epoch ms * 1000 + instance), sortable like row ids and
+        # below 2**53; the instance part keeps other writers' ids out of the way
+        with self._id_lock:
+            self._last_id = max(self._last_id + 1000, timeutil.now_ms() * 1000 + FIRESTORE_INSTANCE_ID)
+            return self._last_id
+
+    def add_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        try:
+            self._dao().apply_events([('user', {
+                'user_id': user_id, 'full_name': full_name, 'username': username, 'join_date': join_date,
+                'invite_link': invite_link, 'photo_url': photo_url
+            })])
+            return True
+        except Exception as e:
+            print(f"❌ Firestore error (add_user): {e}")
+            return False
+
+    def queue_users(self, rows):
+        fields = ('user_id', 'full_name', 'username', 'join_date', 'invite_link', 'photo_url')
+        events = [('user', dict(zip(fields, tuple(row) + (None,) * (6 - len(row))))) for row in rows]
+
+        def apply():
+            # A new user is three writes (document and two counter shards); batches hold 500
+            for start in range(0, len(events), 150):
+                self._dao().apply_events(events[start:start + 150])
+        return _executor.submit(apply)
+
+    def get_user(self, user_id):
+        return self._dao().get_user(user_id)
+
+    def get_all_users(self):
+        import firebase_config
+        return firebase_config.get_all_users_from_firebase()
+
+    def set_user_label(self, user_id, label):
+        self._dao().update_user(user_id, {'label': label})
+
+    def save_message(self, user_id, sender, message, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        from firestore_dao import MessageIdConflict
+
+        for attempt in range(3):
+            message_id = self._next_message_id()
+            try:
+                self._dao().apply_events([('message', {
+                    'message_id': message_id, 'user_id': user_id, 'sender': sender,
+                    'message': message, 'timestamp': timestamp
+                })])
+                break
+            except MessageIdConflict:
+                # Same id from an instance sharing FIRESTORE_INSTANCE_ID: take the next one
+                if attempt == 2:
+                    raise
+        if self.page_cache is not None:
+            self.page_cache.invalidate(user_id)
+        return message_id
+
+    def set_delivery_status(self, message_id, user_id, status, error=None):
+        self._dao().update_message(message_id, {'delivery_status': status, 'delivery_error': error})
+        if self.page_cache is not None:
+            self.page_cache.invalidate(user_id)
+
+    def load_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        return self._dao().get_message_page(user_id, limit, before_id, after_id)
+
+    def get_messages_since(self, user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+        return self._dao().get_messages_since(user_id, since_id, since_ts, limit, since_ts_id)
+
+    def get_stats(self):
+        import firebase_config
+        return {
+            'total_users': firebase_config.get_total_users_from_firebase(),
+            'active_users': firebase_config.get_active_users_from_firebase(stats.ACTIVE_MINUTES),
+            'total_messages': firebase_config.get_total_messages_from_firebase(),
+            'new_joins_today': firebase_config.get_new_joins_today_from_firebase()
+        }
+
+
+class MemoryStorage(Storage):
+    """Everything in dicts guarded by one lock; messages are kept per user
+    in id order so pages are a bisect, and stats are running counters.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._messages = {}  # user_id -> [(id, sender, message, timestamp, ts_ms)] in id order
+        self._ids = {}       # user_id -> [id] for bisect
+        self._last_active = {}
+        self._joins_by_day = {}
+        self._next_id = 1
+        self._total_messages = 0
+        self._delivery_status = {}  # message id -> (status, error)
+
+    def add_user(self, user_id, full_name, username, join_date, invite_link=None, photo_url=None):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                self._users[user_id] = {'user_id': user_id, 'full_name': full_name, 'username': username,
+                                        'join_date': join_date, 'invite_link': invite_link,
+                                        'photo_url': photo_url, 'label': None}
+                join_ts_ms = timeutil.to_ms(join_date)
+                if join_ts_ms is not None:
+                    day = timeutil.day_key(join_ts_ms)
+                    self._joins_by_day[day] = self._joins_by_day.get(day, 0) + 1
+            else:
+                user.update(invite_link=invite_link, photo_url=photo_url)
+        return True
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return dict(user) if user else None
+
+    def get_all_users(self):
+        with self._lock:
+            return [(u['user_id'], u['full_name'], u['username'], u['join_date'], u['invite_link'],
+                     u['photo_url'], u['label']) for u in self._users.values()]
+
+    def set_user_label(self, user_id, label):
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id]['label'] = label
+
+    def save_message(self, user_id, sender, message, timestamp=None):
+        ts_ms = timeutil.now_ms() if timestamp is None else timeutil.to_ms(timestamp)
+        if timestamp is None:
+            timestamp = timeutil.format_ms(ts_ms)
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+            self._messages.setdefault(user_id, []).append((message_id, sender, message, timestamp, ts_ms))
+            self._ids.setdefault(user_id, []).append(message_id)
+            self._last_active[user_id] = max(self._last_active.get(user_id, 0), ts_ms or 0)
+            self._total_messages += 1
+        return message_id
+
+    def set_delivery_status(self, message_id, user_id, status, error=None):
+        with self._lock:
+            self._delivery_status[message_id] = (status, error)
+
+    def load_message_page(self, user_id, limit=100, before_id=None, after_id=None):
+        with self._lock:
+            rows = self._messages.get(user_id, [])
+            ids = self._ids.get(user_id, [])
+            if after_id is not None:
+                start = bisect.bisect_right(ids, after_id)
+                end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+                page = rows[start:min(end, start + limit)][::-1]
+                has_more = end - start > limit
+            else:
+                end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+                page = rows[max(0, end - limit):end][::-1]
+                has_more = end > limit
+            return [row[:4] + self._delivery_status.get(row[0], (None, None)) for row in page], has_more
+
+    def get_messages_since(self, user_id, since_id=None, since_ts=None, limit=500, since_ts_id=None):
+        mark = (since_ts or 0, db.MAX_ID if since_ts_id is None else since_ts_id)
+        with self._lock:
+            rows = self._messages.get(user_id, [])
+            if since_id is not None:
+                newer = rows[bisect.bisect_right(self._ids.get(user_id, []), since_id):]
+            else:
+                newer = sorted((r for r in rows if (r[4] or 0, r[0]) > mark), key=lambda r: (r[4] or 0, r[0]))
+            return [row + self._delivery_status.get(row[0], (None, None)) for row in newer[:limit]], len(newer) > limit
+
+    def get_stats(self):
+        active_since = timeutil.minutes_ago_ms(stats.ACTIVE_MINUTES)
+        with self._lock:
+            return {
+                'total_users': len(self._users),
+                'active_users': sum(1 for ts in self._last_active.values() if ts >= active_since),
+                'total_messages': self._total_messages,
+                'new_joins_today': self._joins_by_day.get(timeutil.day_key(), 0)
+            }
+
+
+def create(name, firebase_available=False):
+    """Build the backend called `name`"""
+    if name == 'sqlite':
+        archive = FirestoreStorage() if firebase_available else None
+        return SQLiteStorage(archive=archive, page_cache=message_cache.cache)
+    if name == 'firestore':
+        if not firebase_available:
+            raise RuntimeError('STORAGE_BACKEND=firestore needs Firebase')
+        return FirestoreStorage(page_cache=message_cache.cache)
+    if name == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+# Shared backend used by api_simple.py (replaced by configure() at startup)
+backend = SQLiteStorage(page_cache=message_cache.cache)
+
+
+def configure(firebase_available, name=None):
+    """Select the backend for this process; falls back to SQLite if it can't be built"""
+    global backend, BACKEND
+    name = name or BACKEND
+    try:
+        backend = create(name, firebase_available)
+    except Exception as e:
+        print(f"⚠️ Storage backend '{name}' unavailable ({e}), using SQLite")
+        backend = create('sqlite', firebase_available)
+    BACKEND = backend.name
+    print(f"🗄️ Storage backend: {BACKEND}")
+    return backend
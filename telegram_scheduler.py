@@ -0,0 +1,179 @@
+"""
+Rate-limited scheduling of outbound Telegram calls.
+
+Every bot API call goes through TelegramScheduler.call(), which paces it
+with token buckets: one global bucket for the whole bot and one per
+target chat. Calls waiting for the global bucket are served by priority
+(approvals, then welcome DMs, then broadcasts), oldest first within a
+priority. A FloodWait pauses the bucket it most likely came from for
+FloodWait.value seconds and the call is retried, so a burst slows down
+instead of erroring.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+from pyrogram.errors import FloodWait
+
+PRIORITY_APPROVAL = 0
+PRIORITY_WELCOME = 1
+# Admin replies are one-to-one conversation too, so they rank with welcome DMs
+PRIORITY_REPLY = 1
+PRIORITY_BROADCAST = 2
+
+# Calls per second for the whole bot, and how many may go out at once after a quiet spell
+# (a burst above 1 lets more than TELEGRAM_GLOBAL_RATE calls land within one second)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', 1))
+# Calls per second to any single chat
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 1))
+# FloodWait retries per call, and the longest wait worth retrying after (seconds)
+TELEGRAM_FLOOD_RETRIES = int(os.environ.get('TELEGRAM_FLOOD_RETRIES', 3))
+TELEGRAM_MAX_FLOOD_WAIT = float(os.environ.get('TELEGRAM_MAX_FLOOD_WAIT', 300))
+# Idle per-chat buckets are dropped once there are this many
+CHAT_BUCKETS_MAX = 10000
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`; pause() blocks it for FloodWait"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = None
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.burst and not (self.lock and self.lock.locked())
+
+    async def acquire(self):
+        """Wait for a token (callers queue in arrival order)"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            delay = self.delay(time.monotonic())
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.delay(time.monotonic())
+            self.take()
+
+
+class TelegramScheduler:
+    """Paces Telegram API calls on one event loop (the bot's)"""
+
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, burst=TELEGRAM_GLOBAL_BURST,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 flood_retries=TELEGRAM_FLOOD_RETRIES, max_flood_wait=TELEGRAM_MAX_FLOOD_WAIT):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.flood_retries = flood_retries
+        self.max_flood_wait = max_flood_wait
+        self._chats = {}
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wake = None
+        self._task = None
+        self.calls = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    async def call(self, fn, chat_id=None, priority=PRIORITY_BROADCAST):
+        """Await fn() (a function returning a coroutine) once the limits allow it.
+
+        `chat_id` is the chat the call talks to (the DM recipient, say) and
+        adds that chat's limit; calls that don't target one chat pass None.
+        fn is called again on each FloodWait retry.
+        """
+        for attempt in range(self.flood_retries + 1):
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._acquire(priority)
+            try:
+                result = await fn()
+                self.calls += 1
+                return result
+            except FloodWait as e:
+                self.flood_waits += 1
+                self.flood_wait_seconds += e.value
+                if attempt == self.flood_retries or e.value > self.max_flood_wait:
+                    self.failed += 1
+                    raise
+                print(f"⏳ FloodWait {e.value}s ({'chat ' + str(chat_id) if chat_id is not None else 'global'}), retrying")
+                # Within the per-chat limit a flood on a chat call is chat-specific;
+                # anything else slows the whole bot down
+                (self._chat_bucket(chat_id) if chat_id is not None else self.bucket).pause(e.value)
+            except Exception:
+                self.failed += 1
+                raise
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_MAX:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, priority):
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wake.set()
+        await future
+
+    async def _dispatch(self):
+        """Hand out global tokens to the best waiting call"""
+        while True:
+            # Drop callers that were cancelled while waiting
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            delay = self.bucket.delay(time.monotonic())
+            if delay > 0:
+                # Re-pick afterwards: a higher-priority call may arrive meanwhile
+                await asyncio.sleep(delay)
+                continue
+            self.bucket.take()
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+    def status(self):
+        return {
+            'waiting': len(self._waiters),
+            'chats_tracked': len(self._chats),
+            'calls': self.calls,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'paused_for': round(max(0.0, self.bucket.paused_until - time.monotonic()), 1)
+        }
+
+
+# Shared scheduler for the bot's event loop (see bot_runtime.py)
+scheduler = TelegramScheduler()
@@ -0,0 +1,51 @@
+import datetime
+import time
+
+# Text format used in JSON responses and the legacy TEXT columns
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def now_ms():
+    """Current time as integer milliseconds since the epoch"""
+    return time.time_ns() // 1_000_000
+
+
+def to_ms(value):
+    """Parse a local '%Y-%m-%d %H:%M:%S' string into epoch ms (None if unparseable)"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.datetime.strptime(value[:19], TS_FORMAT).timestamp() * 1000)
+    except (TypeError, ValueError):
+        try:
+            return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+        except (TypeError, ValueError):
+            return None
+
+
+def format_ms(ms, fallback=None):
+    """Render epoch ms as a local '%Y-%m-%d %H:%M:%S' string for JSON output"""
+    if ms is None:
+        return fallback
+    return datetime.datetime.fromtimestamp(ms / 1000).strftime(TS_FORMAT)
+
+
+def minutes_ago_ms(minutes):
+    """Epoch ms for `minutes` ago"""
+    return now_ms() - int(minutes * 60_000)
+
+
+def day_bounds_ms(day=None):
+    """[start, end) epoch ms of the given local date (today by default)"""
+    day = day or datetime.date.today()
+    start = datetime.datetime.combine(day, datetime.time.min)
+    end = start + datetime.timedelta(days=1)
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+
+def day_key(ms=None):
+    """Local 'YYYY-MM-DD' for epoch ms (today by default); keys the daily rollups"""
+    moment = datetime.datetime.now() if ms is None else datetime.datetime.fromtimestamp(ms / 1000)
+    return moment.strftime('%Y-%m-%d')